@@ -1,10 +1,15 @@
 """ ATG init""" 
 from .basic import *
+from .analysis_stability import *
 from .diagnostic_db import *
 from .indices import *
 from .processing_distances import *
 from .processing_esa import *
+from .processing_indices import *
 from .processing_osm import *
+from .utils_cache import *
+from .utils_distances import *
+from .utils_grid import *
 from .utils_projection import *
 from .utils_psql import *
 from .utils_raster import *
@@ -0,0 +1,461 @@
+#Import standard libraries needed for the Data Analysis
+from .basic import *
+from .utils_psql import *
+from .utils_grid import *
+from scipy.stats import kendalltau
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import datetime
+
+
+"""             Stability of the indices: inequality, rank correlation and targeting overlap             """
+
+def stability_inputs(city:str, filename:str, db_params:dict):
+
+    """
+    Load the wide table with all the indices of a city (from accessibility_index_sweep) and prepare it for the stability analysis
+    -------------------------------------------------------
+
+    Parameters:
+
+    city: name of the city as from DB
+    filename: name of the file with the indices of the city
+    db_params: dictionary with info to access db
+
+    -------------------------------------------------------
+
+    Description:
+
+    Step 1: Identify the cells by their id (if not already in the file).
+    Step 2: Keep only the cells within the city boundary and merge the population of the unmasked grid.
+
+    -------------------------------------------------------
+
+    Return:
+    pandas.DataFrame
+    """
+
+    #Step 1:
+    df=pd.read_csv(filename)
+    pop=query4grid_unmasked(f"{city}", db_params)
+    n_rows=pop['y'].max()
+    if 'id' not in df.columns:
+        df['id']=cell_id(df['x'], df['y'], n_rows)
+    pop['id']=cell_id(pop['x'], pop['y'], n_rows)
+
+    #Step 2:
+    inbound=query4grid(city, db_params)
+    inbound=inbound[inbound['inbound']==1]
+    inbound['id']=cell_id(inbound['x'], inbound['y'], n_rows)
+    df=df[df['id'].isin(inbound['id'])]
+    return pd.merge(df, pd.DataFrame(pop.drop(columns=[pop.geometry.name])), on=['id'], how='left')
+
+
+def adjust_not_computed(values):
+
+    """ Replace the negative values (cells with nothing nearby) of each column of minimum distances with the maximum plus the standard deviation of the column """
+
+    values=np.array(values, dtype=np.float64)
+    if len(values)>1:
+        replacement=np.nanmax(values, axis=0)+np.nanstd(values, axis=0, ddof=1)
+        values=np.where(values<0, replacement, values)
+    return values
+
+
+def gini_columns(values, weights=None):
+
+    """
+    Gini index of each column of values (same as gini() of the stability notebook, for all the columns at once)
+    -------------------------------------------------------
+
+    Parameters:
+
+    values: numpy.ndarray with one row per cell and one column per index
+    weights: numpy.ndarray with the weight (ex: population) of each cell. If None, cells have the same weight
+
+    -------------------------------------------------------
+
+    Return:
+    numpy.ndarray with one element per column
+    """
+
+    values=np.asarray(values, dtype=np.float64)
+    order=np.argsort(values, axis=0)
+    sorted_values=np.take_along_axis(values, order, axis=0)
+    if weights is None:
+        n=len(values)
+        cumx=np.cumsum(sorted_values, axis=0)
+        return (n+1-2*np.sum(cumx, axis=0)/cumx[-1])/n
+    sorted_weights=np.asarray(weights, dtype=np.float64)[order]
+    cumw=np.cumsum(sorted_weights, axis=0)
+    cumxw=np.cumsum(sorted_values*sorted_weights, axis=0)
+    return np.sum(cumxw[1:]*cumw[:-1]-cumxw[:-1]*cumw[1:], axis=0)/(cumxw[-1]*cumw[-1])
+
+
+def rank_columns(values, weights=None):
+
+    """
+    Rank each column once, for the computation of the Kendall tau of all the pairs of columns
+    -------------------------------------------------------
+
+    Parameters:
+
+    values: numpy.ndarray with one row per cell and one column per index
+    weights: numpy.ndarray with the weight of each cell, for the weighted Kendall tau. If None, cells have the same weight
+
+    -------------------------------------------------------
+
+    Return:
+    dictionary with keys 'ranks' (dense ranks, int64, one column per index), 'weights', 'ties' (weight of the pairs tied in each column, only with weights)
+    and 'missing' (True for the columns with missing values)
+    """
+
+    values=np.asarray(values, dtype=np.float64)
+    n_cells, n_columns=values.shape
+    weights=None if weights is None else np.asarray(weights, dtype=np.float64)
+    ranks=np.zeros(values.shape, dtype=np.int64)
+    ties=np.zeros(n_columns)
+    missing=np.isnan(values).any(axis=0)
+    for k in range(n_columns):
+        if missing[k]:
+            continue
+        _, ranks[:,k]=np.unique(values[:,k], return_inverse=True)
+        if weights is not None:
+            ties[k]=tied_pairs(ranks[:,k], weights)
+    return {'ranks':ranks, 'weights':weights, 'ties':ties, 'missing':missing}
+
+
+def tied_pairs(ranks, weights):
+
+    """ Weight of the pairs of cells with the same rank (number of pairs if all the weights are 1) """
+
+    group_weights=np.bincount(ranks, weights=weights)
+    group_squares=np.bincount(ranks, weights=weights*weights)
+    return ((group_weights*group_weights-group_squares)/2).sum()
+
+
+def discordant_pairs(y, weights):
+
+    """
+    Weight of the pairs (i<j) with y[i]>y[j], each pair weighted by the product of the weights.
+    Bottom-up merge sort: at each level, the weight of the elements of the left half of a block moving after an element of the right half 
+    is the difference between the cumulative weights before and after the merge.
+    """
+
+    n=len(y)
+    if n<2:
+        return 0
+    y=np.asarray(y, dtype=np.int64)
+    offset=int(y.max())+1
+    position=np.arange(n)
+    cumulative=np.concatenate([[0], np.cumsum(weights)])
+    total=0
+    width=1
+    while width<n:
+        block=position//(2*width)
+        right=(position%(2*width))>=width
+        #Merge the two halves of each block (stable: left elements first among equal values)
+        order=np.argsort(block*offset+y, kind='stable')
+        merged_position=np.empty(n, dtype=np.int64)
+        merged_position[order]=position
+        weights=weights[order]
+        merged_cumulative=np.concatenate([[0], np.cumsum(weights)])
+        total+=np.sum(weights[merged_position[right]]*(cumulative[position[right]+1]-merged_cumulative[merged_position[right]+1]))
+        y=y[order]
+        cumulative=merged_cumulative
+        width*=2
+    return total
+
+
+def kendall_tau_columns(ranked:dict, k1:int, k2:int):
+
+    """
+    Kendall tau-b between two ranked columns (see rank_columns). 
+    Without weights, same as scipy.stats.kendalltau (as in the stability notebook), computed on the integer ranks.
+    With weights, each pair of cells is weighted by the product of their weights (the tau-b formula with weighted counts of pairs).
+    -------------------------------------------------------
+
+    Return:
+    tuple (tau, p-value). The p-value is only computed without weights
+    """
+
+    if ranked['missing'][k1] or ranked['missing'][k2]:
+        return np.nan, np.nan
+    r1=ranked['ranks'][:,k1]
+    r2=ranked['ranks'][:,k2]
+    weights=ranked['weights']
+    if weights is None:
+        result=kendalltau(r1, r2)
+        return result[0], result[1]
+    
+    n=len(r1)
+    total_weight=weights.sum()
+    total=(total_weight*total_weight-(weights*weights).sum())/2
+    #Cells sorted by both ranks: cells tied in both columns are consecutive
+    order=np.argsort(r1*(int(r2.max(initial=0))+1)+r2, kind='stable')
+    new_pair=np.ones(n, dtype=bool)
+    new_pair[1:]=(r1[order][1:]!=r1[order][:-1]) | (r2[order][1:]!=r2[order][:-1])
+    both_ties=tied_pairs(np.cumsum(new_pair)-1, weights[order])
+    con_minus_dis=total-ranked['ties'][k1]-ranked['ties'][k2]+both_ties-2*discordant_pairs(r2[order], weights[order])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tau=con_minus_dis/np.sqrt(total-ranked['ties'][k1])/np.sqrt(total-ranked['ties'][k2])
+    return (min(1., max(-1., tau)) if np.isfinite(tau) else np.nan), np.nan
+
+
+def kendall_tau_matrix(df:pd.DataFrame, columns:list, weight:str=None):
+
+    """
+    Kendall rank correlation (tau-b) between all the pairs of columns
+    -------------------------------------------------------
+
+    Parameters:
+
+    df: table with one row per cell
+    columns: columns to compare (ex: BetterThanEqual of the indices)
+    weight: if provided, column with the weight of each cell (ex: 'population') for the weighted Kendall tau
+
+    -------------------------------------------------------
+
+    Return:
+    tuple of pandas.DataFrame (tau, p-value), indexed by columns on both axes
+    """
+
+    ranked=rank_columns(df[columns].to_numpy(dtype=np.float64), None if weight is None else df[weight].fillna(0).to_numpy(dtype=np.float64))
+    tau=np.eye(len(columns))
+    pvalue=np.zeros((len(columns), len(columns)))
+    for k1 in range(len(columns)):
+        for k2 in range(k1+1, len(columns)):
+            tau[k1,k2], pvalue[k1,k2]=kendall_tau_columns(ranked, k1, k2)
+            tau[k2,k1], pvalue[k2,k1]=tau[k1,k2], pvalue[k1,k2]
+    return pd.DataFrame(tau, index=columns, columns=columns), pd.DataFrame(pvalue, index=columns, columns=columns)
+
+
+def targeting_overlap(selected, population, columns:list):
+
+    """
+    Overlap between the cells selected by each pair of columns
+    -------------------------------------------------------
+
+    Parameters:
+
+    selected: boolean numpy.ndarray with one row per cell and one column per index (True for the targeted cells)
+    population: numpy.ndarray with the population of each cell
+    columns: names of the columns
+
+    -------------------------------------------------------
+
+    Description:
+
+    Population and number of cells selected by both columns of each pair are computed for all the pairs at once with a matrix product.
+    Same outputs as stable_naive_targeting and stable_mostdisadvantaged_targeting of the stability notebook:
+    share of the population selected by both among the population selected by at least one, population selected by both and by at least one,
+    average population of the cells selected by both and of the cells selected by only one of the two.
+
+    -------------------------------------------------------
+
+    Return:
+    dictionary of pandas.DataFrame indexed by columns on both axes, with keys 'stable', 'stable_population', 'total_population', 'density_stable', 'density_unstable'
+    """
+
+    selected=np.asarray(selected, dtype=np.float64)
+    has_population=np.isnan(population)==False
+    population=np.where(has_population, population, 0)
+    both_population=(selected*population[:,None]).T@selected
+    both_cells=(selected*has_population[:,None]).T@selected
+    single_population=np.diag(both_population)
+    single_cells=np.diag(both_cells)
+    total_population=single_population[:,None]+single_population[None,:]-both_population
+    with np.errstate(divide='ignore', invalid='ignore'):
+        metrics={'stable':both_population/total_population,
+                 'stable_population':both_population,
+                 'total_population':total_population,
+                 'density_stable':both_population/both_cells,
+                 'density_unstable':(single_population[:,None]+single_population[None,:]-2*both_population)/(single_cells[:,None]+single_cells[None,:]-2*both_cells)}
+    return {key:pd.DataFrame(value, index=columns, columns=columns) for key, value in metrics.items()}
+
+
+def naive_targeting_matrices(df:pd.DataFrame, columns:list, x:float, population:str='population'):
+
+    """
+    Overlap of the targeting of the cells with the lowest ranking (as stable_naive_targeting of the stability notebook) for all the pairs of columns.
+    For each column, the cells targeted are the ones with value lower or equal than the smallest value greater or equal than x.
+    -------------------------------------------------------
+
+    Parameters:
+
+    df: table with one row per cell
+    columns: columns to compare (BetterThanEqual of the indices)
+    x: share of population to target (ex: 0.05)
+    population: column with the population of each cell
+
+    -------------------------------------------------------
+
+    Return:
+    see targeting_overlap()
+    """
+
+    values=df[columns].to_numpy(dtype=np.float64)
+    selected=np.zeros(values.shape, dtype=bool)
+    for k in range(len(columns)):
+        unique=np.unique(values[:,k])
+        cutoff=unique[np.searchsorted(unique, x, 'left')]
+        selected[:,k]=(values[:,k]<=cutoff)
+    return targeting_overlap(selected, df[population].to_numpy(dtype=np.float64), columns)
+
+
+def mostdisadvantaged_targeting_matrices(df:pd.DataFrame, columns:list, index_type:str, factor:float=4, population:str='population'):
+
+    """
+    Overlap of the targeting of the most disadvantaged cells (as stable_mostdisadvantaged_targeting of the stability notebook) for all the pairs of columns.
+    For the minimum distance, the cells targeted are the ones with distance larger than factor times the population weighted average distance,
+    for the other indices the cells with index 0.
+    -------------------------------------------------------
+
+    Parameters:
+
+    df: table with one row per cell
+    columns: columns to compare (indices)
+    index_type: 'min_dist' for the minimum distance, otherwise the other indices
+    factor: multiple of the average distance identifying the most disadvantaged cells
+    population: column with the population of each cell
+
+    -------------------------------------------------------
+
+    Return:
+    see targeting_overlap()
+    """
+
+    values=df[columns].to_numpy(dtype=np.float64)
+    weights=df[population].to_numpy(dtype=np.float64)
+    if index_type=='min_dist':
+        values=adjust_not_computed(values)
+        cutoff=factor*(values*weights[:,None]).sum(axis=0)/np.nansum(weights)
+        selected=(values>cutoff)
+    else:
+        selected=(values<=0)
+    return targeting_overlap(selected, weights, columns)
+
+
+def stability_metrics(df:pd.DataFrame, index_groups:dict, naive_shares:list=[0.01, 0.02, 0.03, 0.05, 0.10], factors:list=[3, 4, 5],
+                      population:str='population', weighted_tau:bool=False):
+
+    """
+    Compute all the stability metrics of a city
+    -------------------------------------------------------
+
+    Parameters:
+
+    df: table with one row per cell, the indices, their BetterThanEqual and the population (ex: from stability_inputs)
+    index_groups: dictionary {group name: (index type, list of index columns)}. Index type is 'min_dist', 'exp' or 'per_person'.
+                  Pairs are only compared within each group (ex: {'min_dist':('min_dist', ['min_dist_0.5', 'min_dist_1'])})
+    naive_shares: shares of population for naive_targeting_matrices
+    factors: factors for mostdisadvantaged_targeting_matrices (only for the minimum distance, a single computation for the other indices)
+    population: column with the population of each cell
+    weighted_tau: if True, the Kendall tau is weighted by population
+
+    -------------------------------------------------------
+
+    Return:
+    dictionary {group name: dictionary with keys 'gini' (pandas.Series), 'kendall_tau', 'kendall_tau_pvalue' (pandas.DataFrame),
+                'naive_{x}' and 'mostdisadvantaged_{factor}' (see targeting_overlap)}
+    """
+
+    results={}
+    for group, (index_type, columns) in index_groups.items():
+        ranking_columns=[f'BetterThanEqual_{column}' for column in columns]
+        values=df[columns].to_numpy(dtype=np.float64)
+        if index_type=='min_dist':
+            values=adjust_not_computed(values)
+        result={'gini':pd.Series(gini_columns(values, df[population].to_numpy(dtype=np.float64)), index=columns)}
+        tau, pvalue=kendall_tau_matrix(df, ranking_columns, population if weighted_tau else None)
+        result['kendall_tau']=tau.set_axis(columns, axis=0).set_axis(columns, axis=1)
+        result['kendall_tau_pvalue']=pvalue.set_axis(columns, axis=0).set_axis(columns, axis=1)
+        for x in naive_shares:
+            result[f'naive_{x}']={key:value.set_axis(columns, axis=0).set_axis(columns, axis=1) for key, value in naive_targeting_matrices(df, ranking_columns, x, population).items()}
+        for factor in (factors if index_type=='min_dist' else factors[:1]):
+            result[f'mostdisadvantaged_{factor}']=mostdisadvantaged_targeting_matrices(df, columns, index_type, factor, population)
+        results[group]=result
+    return results
+
+
+def stability_runner_one_city(city:str, index_groups:dict, input_folder:str, output_folder:str, db_params:dict=None,
+                              input_name:str='{city}_stability_allindices.csv', output_name:str='{city}_stability.pickle', **kwargs):
+
+    """
+    Compute the stability metrics of one city and save them to file (see stability_runner)
+    -------------------------------------------------------
+
+    Return:
+    name of the city
+    """
+
+    filename=f"{input_folder}/{input_name.format(city=city)}"
+    if db_params is not None:
+        df=stability_inputs(city, filename, db_params)
+    else:
+        df=pd.read_csv(filename)
+    results=stability_metrics(df, index_groups, **kwargs)
+
+    filename=f"{output_folder}/{output_name.format(city=city)}"
+    tmp_filename=f"{filename}.{os.getpid()}.tmp"
+    with open(tmp_filename, 'wb') as file:
+        pickle.dump(results, file)
+    os.replace(tmp_filename, filename)
+
+    return city
+
+
+def stability_runner(cities_list:list, index_groups:dict, input_folder:str, output_folder:str, db_params:dict=None, n_workers:int=None,
+                     input_name:str='{city}_stability_allindices.csv', output_name:str='{city}_stability.pickle', **kwargs):
+
+    """
+    Compute the stability metrics for a list of cities over a pool of processes.
+    -------------------------------------------------------
+
+    Parameters:
+
+    cities_list: list of cities, named as in the database
+    index_groups: see stability_metrics()
+    input_folder: folder with the indices of each city (from accessibility_index_sweep or indices_runner)
+    output_folder: folder where the results are saved (pickle of the dictionary returned by stability_metrics), one file for each city
+    db_params: if provided, the input is prepared with stability_inputs (cells within the boundary, population from the unmasked grid).
+               Otherwise the input file must already have one row per cell within the boundary and the population
+    n_workers: number of processes. Default to the number of CPUs
+    input_name: name of the input file, formatted with the name of the city
+    output_name: name of the output file, formatted with the name of the city
+    kwargs: parameters of stability_metrics()
+
+    -------------------------------------------------------
+
+    Description:
+
+    Step 1: Identify the cities not yet computed (no output file in output_folder). This allows resuming a crashed run.
+    Step 2: Submit one task per city to a pool of processes.
+    Step 3: Errors are recorded in output_folder/stability_runner_diagnostic.csv, so that the other cities are not affected.
+
+    -------------------------------------------------------
+
+    Return:
+    list of cities that could not be computed
+    """
+
+    #Step 1:
+    os.makedirs(output_folder, exist_ok=True)
+    to_compute=[city for city in cities_list if not os.path.exists(f"{output_folder}/{output_name.format(city=city)}")]
+    print(f"{len(cities_list)-len(to_compute)} cities already computed, {len(to_compute)} to compute.")
+
+    #Step 2:
+    failed=[]
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures={executor.submit(stability_runner_one_city, city, index_groups, input_folder, output_folder, db_params, input_name, output_name, **kwargs):city for city in to_compute}
+        for future in as_completed(futures):
+            city=futures[future]
+            try:
+                future.result()
+                print(f"{datetime.datetime.now()} {city}: done")
+            #Step 3:
+            except Exception as e:
+                failed.append(city)
+                with open(f"{output_folder}/stability_runner_diagnostic.csv", "a") as file:
+                    file.write(city+','+'error: '+str(e).replace('\n', ' ')+'\n')
+
+    return failed
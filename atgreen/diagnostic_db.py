@@ -1,6 +1,6 @@
 from .basic import *
 import subprocess as sp
-from sqlalchemy import create_engine
+from .utils_psql import get_engine
 
     
 def intable_diagnostic(items_to_check:list, table:str, schema:str, column:str, db_params:dict, verbose:bool=False):
@@ -27,7 +27,7 @@ def intable_diagnostic(items_to_check:list, table:str, schema:str, column:str, d
     
     """
     
-    engine=create_engine(f"postgresql+psycopg2://{db_params['db_user']}:{db_params['db_password']}@{db_params['db_host']}:{db_params['db_port']}/{db_params['db_name']}")       
+    engine=get_engine(db_params)
 
     sql =f"""
     SELECT DISTINCT {column} 
@@ -35,7 +35,6 @@ def intable_diagnostic(items_to_check:list, table:str, schema:str, column:str, d
     """ 
     
     items_in_db=[f.replace('.tiff', '')[:f.find('_ntile')] if f.find('_ntile')!=-1 else  f.replace('.tiff', '') for f in list(pd.read_sql(sql,engine)[column])]
-    engine.dispose()
     
     if len(set(items_to_check)-set(items_in_db))>0 or len(set(items_in_db)-set(items_to_check))>0:
         if verbose==True:
@@ -72,7 +71,7 @@ def inschema_diagnostic(table:str, schema:str, db_params:dict, verbose:bool=Fals
     
     """
     
-    engine=create_engine(f"postgresql+psycopg2://{db_params['db_user']}:{db_params['db_password']}@{db_params['db_host']}:{db_params['db_port']}/{db_params['db_name']}")       
+    engine=get_engine(db_params)
 
     sql =f""" 
     SELECT table_name
@@ -81,7 +80,6 @@ def inschema_diagnostic(table:str, schema:str, db_params:dict, verbose:bool=Fals
     """ 
     
     tables=list(pd.read_sql(sql,engine)['table_name'])
-    engine.dispose()
     
     if table not in tables:
         if verbose==True:
@@ -114,7 +112,7 @@ def itemsfromtable_diagnostic(column:str, table:str, schema:str, db_params:dict,
     
     """
 
-    engine=create_engine(f"postgresql+psycopg2://{db_params['db_user']}:{db_params['db_password']}@{db_params['db_host']}:{db_params['db_port']}/{db_params['db_name']}")       
+    engine=get_engine(db_params)
 
     if  len(values_filter)==0:
         sql =f"""
@@ -135,7 +133,6 @@ def itemsfromtable_diagnostic(column:str, table:str, schema:str, db_params:dict,
             WHERE {col_filter} IN {tuple(values_filter)}
             """ 
     col=list(pd.read_sql(sql,engine)[column])
-    engine.dispose()
     return col
 
 
@@ -204,14 +201,13 @@ def distances_diagnostic(name_area:str, verbose:bool=False):
     
     """
     
-    engine=create_engine(f"postgresql+psycopg2://{db_params['db_user']}:{db_params['db_password']}@{db_params['db_host']}:{db_params['db_port']}/{db_params['db_name']}")       
+    engine=get_engine(db_params)
 
     sql =f"""
         SELECT * 
         FROM distances."{name_area}"
     """ 
     df=pd.read_sql(sql,engine)
-    engine.dispose()
 
     if len(df[(df['walk_minutes'].isnull()==False) & ((df['geodesic_minutes']-df['walk_minutes'])>5)])>0:
         if verbose==True:
@@ -248,13 +244,12 @@ def queryDistancesWithLimit(city:str , which_distances:str, db_params: dict, lim
 
     
     dist_dict={'street-network':'walk_minutes', 'geodesic':'geodesic_minutes'}
-    engine=create_engine(f"postgresql+psycopg2://{db_params['db_user']}:{db_params['db_password']}@{db_params['db_host']}:{db_params['db_port']}/{db_params['db_name']}")   
+    engine=get_engine(db_params)
     sql =f"""
         SELECT x_source, y_source, x_dest, y_dest, {dist_dict[which_distances]} as dist
         FROM distances."{city}"
         LIMIT {str(limit)}
         """  
     df=pd.read_sql(sql, engine)
-    engine.dispose()
     
     return df
@@ -1,108 +1,476 @@
 #Import standard libraries needed for the Data Processing and Cleaning
 from .basic import *
 from .utils_psql import *
+from .utils_distances import *
+from .utils_grid import *
 
 
-def accessibility_index_pipeline(city: str, index_params: dict, index_storage_name: str, db_params: dict, min_intersection):
+def accessibility_index_pipeline(city: str, index_params: dict, index_storage_name: str, db_params: dict, min_intersection, cache_dir:str=None, cache_version:str=None, mode:str='python'):
+    # mode='sql' computes the minimum distance and the exposure index in the database (see queryAggregatedIndex), 
+    # transferring one row per cell instead of all the distances. The per-person index is only computed in python.
+    if mode not in ['python', 'sql']:
+        raise Exception("Value for the parameter 'mode' should be in ['python', 'sql']")
+    if mode=='sql' and index_params['index']=='per_person':
+        raise Exception("The per-person index cannot be computed with mode='sql'")
+    
     # Step 1: Load required data
     # Population grid
-    grid=query4grid(city, db_params)
-    n_rows=query4filteredtable('cities_boundary', 'public', db_params, 'city', city).reset_index()['n_rows'][0]
-    grid['id']=grid.apply(lambda x: x['y']+ n_rows*(x['x']-1), axis=1)
+    grid=query4grid(city, db_params, cache_dir, cache_version)
+    n_rows=query4filteredtable('cities_boundary', 'public', db_params, 'city', city, cache_dir=cache_dir, cache_version=cache_version).reset_index()['n_rows'][0]
+    grid['id']=cell_id(grid['x'], grid['y'], n_rows)
                 
     # Green remapped grid from correct data sources
     if index_params['source'] not in ['OSM', 'ESA']:
         raise Exception("Value for the parameter 'source' should be in ['OSM', 'ESA']")
     if index_params['source']=='OSM':
         
-        engine=create_engine(f"postgresql+psycopg2://{db_params['db_user']}:{db_params['db_password']}@{db_params['db_host']}:{db_params['db_port']}/{db_params['db_name']}")
-        sql =f"""SELECT * FROM osm.osm_greencombinations """ 
-        df=pd.read_sql(sql,engine)
-        engine.dispose()
+        df=query4table('osm_greencombinations', 'osm', db_params, cache_dir=cache_dir, cache_version=cache_version)
         prefix=df[df['value']==index_params['green_type']]['key'].values[0]
-        green_on_grid=queryRemappedGreen(city,"osm.osm2grid", f"{str(prefix)}_", index_params['min_park_size'], min_intersection, db_params)
+        tablename, col_prefix="osm.osm2grid", f"{str(prefix)}_"
         
     else:
-        green_on_grid=queryRemappedGreen(city,"esa.esa2grid", f"0_", index_params['min_park_size'], min_intersection, db_params)
+        tablename, col_prefix="esa.esa2grid", f"0_"
        
     # Distances
     #Get distances
     if index_params['distances'] not in ['street-network', 'geodesic']:
         raise Exception("Value for the parameter 'distances' should be in ['street-network', 'geodesic']")
-    distances=queryDistances(city , index_params['distances'], db_params)
-    distances['dist']=distances['dist']/10
     
     # Compute index
     if index_params['index'] not in ['minimum_distance', 'exposure', 'per_person']:
         raise Exception("Value for the parameter 'index' should be in ['minimum_distance', 'exposure', 'per_person]")
+    
+    if mode=='sql':
+        index=queryAggregatedIndex(city, index_params['index'], tablename, col_prefix, index_params['min_park_size'], min_intersection, index_params['distances'], db_params, 
+                                   index_params.get('time_threshold'), index_storage_name)
+        #keep only cells within the bound as sources
+        index=index[index['id'].isin(grid[grid['inbound']==1]['id'])]
+        return index_postprocessing(grid, index, index_params, index_storage_name)
+    
+    green_on_grid=queryRemappedGreen(city, tablename, col_prefix, index_params['min_park_size'], min_intersection, db_params, cache_dir, cache_version)
+    distances=queryDistances(city , index_params['distances'], db_params, cache_dir, cache_version)
+    distances['dist']=distances['dist']/10
+    
+    if index_params['index']=='per_person':
+        cells_unmasked=query4grid_unmasked(city, db_params, cache_dir, cache_version)
+    else:
+        cells_unmasked=None
+    index=compute_index(grid, green_on_grid, distances, index_params, index_storage_name, cells_unmasked, n_rows)
+
+    return index_postprocessing(grid, index, index_params, index_storage_name)
+
+
+def accessibility_index_sweep(city: str, index_params_list: list, db_params: dict, cache_dir:str=None, cache_version:str=None, distances_dir:str=None):
+    
+    """
+    Compute several accessibility indices for the same city loading the input data only once
+    -------------------------------------------------------  
+    
+    Parameters:
+    
+    city: name of the city as from DB
+    index_params_list: list of dictionaries, one for each index to compute. 
+                       Each dictionary has the same keys as the index_params passed to accessibility_index_pipeline(), plus:
+                       'index_storage_name': name of the column where the index is stored
+                       'min_intersection': minimum size (in hectares) of the intersection between cell and park
+    db_params: dictionary with info to access db
+    cache_dir: if provided, directory of the local cache of the input data (see utils_cache)
+    cache_version: version of the source tables (ex: from table_version), used to invalidate the cache. If None, the cached data are used as they are, without accessing the database
+    distances_dir: if provided, directory of the binary distance files (see write_distance_file), named {city}.atgd. 
+                   Distances are read from the file, if available, instead of the database (with the same units, see load_sweep_distances)
+    
+    -------------------------------------------------------  
+    
+    Description:
+    
+    Step 1: Validate the parameters of all the requested indices.
+    Step 2: Call load_sweep_inputs() to load the population grid, the remapped green tables (one per source) and the distances (one per distance type). 
+            Distances are stored as a DistanceMatrix, built once and shared by all the indices.
+            The unmasked grid is only loaded if at least one per-person index is requested.
+    Step 3: Call compute_sweep(). For each requested index, filter the remapped green according to its parameters, compute the index and its post-processing. 
+            Merge the results into a single wide table.
+    
+    -------------------------------------------------------  
+    
+    Return:
+    pandas.DataFrame with column 'id' and, for each index, the columns [index_storage_name, BetterThanEqual_{index_storage_name}, TargetSatisfied_{index_storage_name}]
+    """
+    
+    #Step 1:
+    for index_params in index_params_list:
+        if index_params['source'] not in ['OSM', 'ESA']:
+            raise Exception("Value for the parameter 'source' should be in ['OSM', 'ESA']")
+        if index_params['distances'] not in ['street-network', 'geodesic']:
+            raise Exception("Value for the parameter 'distances' should be in ['street-network', 'geodesic']")
+        if index_params['index'] not in ['minimum_distance', 'exposure', 'per_person']:
+            raise Exception("Value for the parameter 'index' should be in ['minimum_distance', 'exposure', 'per_person]")
+    
+    #Step 2:
+    sweep_inputs=load_sweep_inputs(city, index_params_list, db_params, cache_dir, cache_version, distances_dir)
+    
+    #Step 3:
+    return compute_sweep(sweep_inputs, index_params_list)
+
+
+def load_sweep_inputs(city: str, index_params_list: list, db_params: dict, cache_dir:str=None, cache_version:str=None, distances_dir:str=None):
+    
+    """
+    Load from the database (or from the local cache) all the data required to compute the indices in index_params_list. 
+    This is the only step of accessibility_index_sweep() accessing the database.
+    -------------------------------------------------------  
+    
+    Parameters:
+    
+    see accessibility_index_sweep()
+    
+    -------------------------------------------------------  
+    
+    Return:
+    dictionary with keys 'grid', 'n_rows', 'greencombinations', 'green_tables', 'distances', 'cells_unmasked'
+    """
+    
+    grid=query4grid(city, db_params, cache_dir, cache_version)
+    n_rows=query4filteredtable('cities_boundary', 'public', db_params, 'city', city, cache_dir=cache_dir, cache_version=cache_version).reset_index()['n_rows'][0]
+    grid['id']=cell_id(grid['x'], grid['y'], n_rows)
+    
+    sources=set([index_params['source'] for index_params in index_params_list])
+    greencombinations=None
+    green_tables={}
+    if 'OSM' in sources:
+        greencombinations=query4table('osm_greencombinations', 'osm', db_params, cache_dir=cache_dir, cache_version=cache_version)
+        green_tables['OSM']=queryRemappedGreenTable(city, "osm.osm2grid", db_params, cache_dir, cache_version)
+    if 'ESA' in sources:
+        green_tables['ESA']=queryRemappedGreenTable(city, "esa.esa2grid", db_params, cache_dir, cache_version)
+    
+    distances_dict={}
+    for which_distances in set([index_params['distances'] for index_params in index_params_list]):
+        distances_dict[which_distances]=load_sweep_distances(city, which_distances, n_rows, db_params, cache_dir, cache_version, distances_dir)
+    
+    if 'per_person' in [index_params['index'] for index_params in index_params_list]:
+        cells_unmasked=query4grid_unmasked(city, db_params, cache_dir, cache_version)
+    else:
+        cells_unmasked=None
+    
+    return {'grid':grid, 'n_rows':n_rows, 'greencombinations':greencombinations, 'green_tables':green_tables, 'distances':distances_dict, 'cells_unmasked':cells_unmasked}
+
+
+def load_sweep_distances(city: str, which_distances: str, n_rows: int, db_params: dict, cache_dir:str=None, cache_version:str=None, distances_dir:str=None):
+    
+    """
+    Load the distances of a city as a DistanceMatrix, from the binary distance file if available, otherwise from the database
+    -------------------------------------------------------  
+    
+    Parameters:
+    
+    which_distances: type of distance (geodesic vs street-network)
+    n_rows: number of rows of the grid of the city, checked against the header of the distance file
+    see accessibility_index_sweep() for the other parameters
+    
+    -------------------------------------------------------  
+    
+    Description:
+    
+    Both sources hold the same distances (the database tables are loaded from the distance files, rounded to 0.1) and give the same matrix: 
+    distances are divided by 10, as in accessibility_index_pipeline() and queryAggregatedIndex(), and stored as float64 so that the indices 
+    are the same as the ones computed on the pandas tables.
+    
+    -------------------------------------------------------  
+    
+    Return:
+    DistanceMatrix
+    """
+    
+    #Binary distance file, memory-mapped if not compressed
+    filename=f"{distances_dir}/{city}.atgd"
+    if distances_dir is not None and os.path.exists(filename):
+        if read_distance_header(filename)['n_rows']!=n_rows:
+            raise Exception(f"Grid of {filename} not consistent with the grid of {city}")
+        distances=read_distance_file(filename, {'street-network':'walk_minutes', 'geodesic':'geodesic_minutes'}[which_distances], dtype=np.float64)
+        #Same rounding as when the file is loaded on the database (rows stay sorted, as the transformation is monotonic)
+        return DistanceMatrix(distances.indptr, distances.indices, np.round(distances.data, 1)/10, sorted_rows=distances.sorted_rows)
+    
+    distances=queryDistances(city , which_distances, db_params, cache_dir, cache_version)
+    distances['dist']=distances['dist']/10
+    return DistanceMatrix.from_dataframe(distances, dtype=np.float64)
+
+
+def compute_sweep(sweep_inputs: dict, index_params_list: list):
+    
+    """
+    Compute all the indices in index_params_list from the data loaded by load_sweep_inputs(). No access to the database is required.
+    -------------------------------------------------------  
+    
+    Parameters:
+    
+    sweep_inputs: dictionary returned by load_sweep_inputs()
+    index_params_list: see accessibility_index_sweep()
+    
+    -------------------------------------------------------  
+    
+    Return:
+    see accessibility_index_sweep()
+    """
+    
+    grid=sweep_inputs['grid']
+    greencombinations=sweep_inputs['greencombinations']
+    
+    def green_key(index_params):
+        if index_params['source']=='OSM':
+            prefix=greencombinations[greencombinations['value']==index_params['green_type']]['key'].values[0]
+        else:
+            prefix=0
+        return (index_params['source'], prefix, index_params['min_park_size'], index_params['min_intersection'], index_params['distances'])
+    
+    #Exposure indices differing only by the time threshold are computed at once (see exposure_index_thresholds)
+    exposures={}
+    values=np.zeros((len(grid), len(index_params_list)))
+    for k, index_params in enumerate(index_params_list):
+        index_storage_name=index_params['index_storage_name']
+        key=green_key(index_params)
+        green_on_grid=filterRemappedGreen(sweep_inputs['green_tables'][index_params['source']], f"{str(key[1])}_", index_params['min_park_size'], index_params['min_intersection'])
+        distances=sweep_inputs['distances'][index_params['distances']]
+        if index_params['index']=='exposure' and isinstance(distances, DistanceMatrix):
+            if key not in exposures:
+                thresholds=sorted(set([p['time_threshold'] for p in index_params_list if p['index']=='exposure' and green_key(p)==key]))
+                exposures[key]=exposure_index_thresholds(grid, green_on_grid, distances, thresholds, 'exposure')
+            index=exposures[key][index_params['time_threshold']].rename(columns={'exposure':index_storage_name})
+        else:
+            index=compute_index(grid, green_on_grid, distances, index_params, index_storage_name, sweep_inputs['cells_unmasked'], sweep_inputs['n_rows'])
+        values[:,k]=index_on_grid(grid, index, index_params, index_storage_name)
+    
+    #Ranking of all the indices at once
+    better_than_equal, target_satisfied=index_ranking(values, grid['population'].to_numpy(dtype=np.float64), grid['inbound'].to_numpy(), index_params_list)
+    final={'id':grid['id'].values}
+    for k, index_params in enumerate(index_params_list):
+        index_storage_name=index_params['index_storage_name']
+        final[index_storage_name]=values[:,k]
+        final[f'BetterThanEqual_{index_storage_name}']=better_than_equal[:,k]
+        final[f'TargetSatisfied_{index_storage_name}']=target_satisfied[:,k]
+    
+    return pd.DataFrame(final)
+
+
+def compute_index(grid, green_on_grid, distances, index_params: dict, index_storage_name: str, cells_unmasked=None, n_rows=None):
+    
+    """
+    Compute the index requested in index_params['index'] from the already loaded data
+    -------------------------------------------------------  
+    
+    Parameters:
+    
+    grid: population grid with cell 'id' (from query4grid)
+    green_on_grid: remapped green (from queryRemappedGreen)
+    distances: distances between cells (from queryDistances) or DistanceMatrix, in minutes
+    index_params: dictionary with the parameters of the index. For the per-person index, 'kernel':'sparse' selects per_person_index_sparse()
+    index_storage_name: name of the column where the index is stored
+    cells_unmasked: unmasked population grid (from query4grid_unmasked). Only required for the per-person index
+    n_rows: number of rows of the grid. Only required for the per-person index
+    
+    -------------------------------------------------------  
+    
+    Return:
+    pandas.DataFrame with columns ['id', index_storage_name]
+    """
+    
     if index_params['index']=='minimum_distance':
         index=minimum_distance_index(grid, green_on_grid, distances, index_storage_name)
         
     elif index_params['index']=='exposure':
         index=exposure_index(grid, green_on_grid, distances, index_params['time_threshold'], index_storage_name)
         
+    elif index_params.get('kernel')=='sparse':
+        index=per_person_index_sparse(grid, cells_unmasked, green_on_grid, distances, index_params['time_threshold'], index_storage_name, n_rows)
+        
     else:
-        cells_unmasked=query4grid_unmasked(city, db_params)
         index=per_person_index(grid, cells_unmasked, green_on_grid, distances, index_params['time_threshold'], index_storage_name, n_rows)
+    
+    return index
 
-    #Merge with grid:
-    grid=pd.merge(grid, index, how='left', on=['id'])
-    # if index is per person or exposure, the absence of green in the surrounding area means that the exposure or the index per person is 0
-    if index_params['index']=='minimum_distance':
-        grid[index_storage_name]=grid[index_storage_name].fillna(-2)
-    else:
-        grid[index_storage_name]=grid[index_storage_name].fillna(0)
-    grid.loc[grid['inbound']==0, index_storage_name]=-2
-    grid.loc[grid['population']==0, index_storage_name]=-2
+
+def index_postprocessing(grid, index, index_params: dict, index_storage_name: str):
+    
+    """
+    Merge the index with the grid and compute whether each cell satisfies the target and the share of population with a worse or equal index 
+    -------------------------------------------------------  
+    
+    Parameters:
+    
+    grid: population grid with cell 'id' (from query4grid)
+    index: index as returned by compute_index()
+    index_params: dictionary with the parameters of the index
+    index_storage_name: name of the column where the index is stored
     
-    # Compute additional info, along with index
-    # on whether the area satisfy the target:
-    grid[f'TargetSatisfied_{index_storage_name}']=-2
+    -------------------------------------------------------  
+    
+    Return:
+    pandas.DataFrame with columns ['id', index_storage_name, BetterThanEqual_{index_storage_name}, TargetSatisfied_{index_storage_name}]
+    """
+    
+    values=index_on_grid(grid, index, index_params, index_storage_name)
+    better_than_equal, target_satisfied=index_ranking(values[:,None], grid['population'].to_numpy(dtype=np.float64), grid['inbound'].to_numpy(), [index_params])
+    
+    return pd.DataFrame({'id':grid['id'].values, index_storage_name:values, 
+                         f'BetterThanEqual_{index_storage_name}':better_than_equal[:,0], f'TargetSatisfied_{index_storage_name}':target_satisfied[:,0]})
+
+
+def index_on_grid(grid, index, index_params: dict, index_storage_name: str):
+    
+    """
+    Index of each cell of the grid, in the order of the grid
+    -------------------------------------------------------  
+    
+    Parameters:
+    
+    see index_postprocessing()
+    
+    -------------------------------------------------------  
+    
+    Description:
+    
+    Cells without index value have no green in the surrounding area: the exposure or the index per person is 0, the minimum distance is -2.
+    Cells out of the city boundary or with no population are set to -2.
+    
+    -------------------------------------------------------  
+    
+    Return:
+    numpy.ndarray of float64 with one element per cell of the grid
+    """
+    
+    values=np.full(len(grid), np.nan)
+    pos=pd.Index(grid['id']).get_indexer(index['id'])
+    values[pos[pos>=0]]=index[index_storage_name].to_numpy(dtype=np.float64)[pos>=0]
     if index_params['index']=='minimum_distance':
-        grid.loc[(grid[index_storage_name]>index_params['time_threshold']) & (grid['inbound']==1) & (grid['population']>0) & (grid[index_storage_name]!=-2), f'TargetSatisfied_{index_storage_name}']=0
-        grid.loc[(grid[index_storage_name]<=index_params['time_threshold']) & (grid['inbound']==1) & (grid['population']>0) & (grid[index_storage_name]!=-2), f'TargetSatisfied_{index_storage_name}']=1
-    else :
-        grid.loc[(grid[index_storage_name]<index_params['exposure_target']) & (grid['inbound']==1) & (grid['population']>0) & (grid[index_storage_name]!=-2), f'TargetSatisfied_{index_storage_name}']=0
-        grid.loc[(grid[index_storage_name]>=index_params['exposure_target']) & (grid['inbound']==1) & (grid['population']>0) & (grid[index_storage_name]!=-2), f'TargetSatisfied_{index_storage_name}']=1
-
-    # people in this cell have a better index than x% of population in the city boundary:
-    if  index_params['index']=='minimum_distance':
-        grid['tmp']=grid[index_storage_name]
-        grid.loc[(grid[index_storage_name]==-2) & (grid['population']>0), 'tmp']=grid[index_storage_name].max()+1 #Account for cases with positive population but nothing nearby - set index to -2 normally but here would create problem with the sorting, so replaced with max index value + 1
-        tmp=grid[['tmp','population']].groupby('tmp').sum().reset_index()
-        tmp=tmp.sort_values(by='tmp', ascending=False)
-        tmp['pop_cum']=tmp['population'].cumsum()
-        tmp[f'BetterThanEqual_{index_storage_name}']=tmp['pop_cum']/tmp['population'].sum()
-        grid=pd.merge(grid, tmp[[f'BetterThanEqual_{index_storage_name}', 'tmp']], on='tmp', how='left')
-        grid.loc[grid['population']==0, f'BetterThanEqual_{index_storage_name}']=-2
-
-        grid.loc[grid['population']==0, f'BetterThanEqual_{index_storage_name}']=-2
+        values[np.isnan(values)]=-2
     else:
-        tmp=grid[[f'{index_storage_name}','population']].groupby(f'{index_storage_name}').sum().reset_index()
-        tmp=tmp.sort_values(by=index_storage_name, ascending=True)
-        tmp['pop_cum']=tmp['population'].cumsum()
-        tmp[f'BetterThanEqual_{index_storage_name}']=tmp['pop_cum']/tmp['population'].sum()
-        grid=pd.merge(grid, tmp[[f'BetterThanEqual_{index_storage_name}', f'{index_storage_name}']], on=f'{index_storage_name}', how='left')
-        grid.loc[grid['population']==0, f'BetterThanEqual_{index_storage_name}']=-2
+        values[np.isnan(values)]=0
+    values[(grid['inbound'].to_numpy()==0) | (grid['population'].to_numpy()==0)]=-2
+    return values
+
+
+def index_ranking(values, population, inbound, index_params_list: list):
+    
+    """
+    Compute, for several indices at once, whether each cell satisfies the target and the share of population with a worse or equal index
+    -------------------------------------------------------  
+    
+    Parameters:
+    
+    values: numpy.ndarray with one row per cell and one column per index (from index_on_grid)
+    population: numpy.ndarray with the population of each cell
+    inbound: numpy.ndarray with the flag 'inbound' of each cell
+    index_params_list: list of dictionaries with the parameters of the indices, one for each column of values
     
-    return grid[['id',  index_storage_name, f'BetterThanEqual_{index_storage_name}', f'TargetSatisfied_{index_storage_name}' ]]
+    -------------------------------------------------------  
+    
+    Description:
+    
+    Step 1: Target. Cells within the boundary, with population and with an index value satisfy the target if the minimum distance is lower or equal than time_threshold,
+            or if the exposure (or index per person) is greater or equal than exposure_target. The other cells are set to -2.
+    Step 2: Share of the population of the city with a worse or equal index (see population_share_worse_or_equal). 
+            For the minimum distance, cells with population but nothing nearby are ranked as the worst cells. Cells with no population are set to -2.
+    
+    -------------------------------------------------------  
+    
+    Return:
+    tuple of numpy.ndarray with one row per cell and one column per index (BetterThanEqual, TargetSatisfied)
+    """
+    
+    values=np.asarray(values, dtype=np.float64)
+    lower_is_better=np.array([index_params['index']=='minimum_distance' for index_params in index_params_list], dtype=bool)
+    has_population=(population>0)
+    
+    #Step 1:
+    targets=np.array([index_params['time_threshold'] if index_params['index']=='minimum_distance' else index_params['exposure_target'] for index_params in index_params_list], dtype=np.float64)
+    valid=((inbound==1) & has_population)[:,None] & (values!=-2)
+    satisfied=np.where(lower_is_better, values<=targets, values>=targets)
+    target_satisfied=np.where(valid, satisfied.astype(np.int64), -2)
+    
+    #Step 2:
+    ranked=values
+    if len(values)>0:
+        ranked=np.where((values==-2) & has_population[:,None] & lower_is_better, values.max(axis=0)+1, values)
+    better_than_equal=population_share_worse_or_equal(ranked, population, lower_is_better)
+    better_than_equal[has_population==False]=-2
+    
+    return better_than_equal, target_satisfied
+
+
+def population_share_worse_or_equal(values, population, lower_is_better):
+    
+    """
+    Weighted cumulative distribution of the index values: share of the population with a worse or equal index, for each cell
+    -------------------------------------------------------  
+    
+    Parameters:
+    
+    values: numpy.ndarray with the index of each cell. With several columns, each column is ranked separately
+    population: numpy.ndarray with the population of each cell (weights)
+    lower_is_better: bool, or one bool per column. If True, worse means larger (ex: minimum distance), otherwise smaller (ex: exposure)
+    
+    -------------------------------------------------------  
+    
+    Description:
+    
+    Each column is sorted once (argsort) with worse values first, and the population is accumulated along the sorted values.
+    Cells with equal values take the cumulative population at the end of their run of equal values. Missing values (NaN) are not ranked.
+    
+    -------------------------------------------------------  
+    
+    Return:
+    numpy.ndarray of float64 with the same shape as values
+    """
+    
+    values=np.asarray(values, dtype=np.float64)
+    one_column=(values.ndim==1)
+    if one_column:
+        values=values[:,None]
+    n_cells, n_columns=values.shape
+    lower_is_better=np.broadcast_to(np.asarray(lower_is_better, dtype=bool), (n_columns,))
+    result=np.full(values.shape, np.nan)
+    if n_cells>0:
+        #Worse or equal values are always the ones with lower or equal key
+        keys=np.where(lower_is_better, -values, values)
+        missing=np.isnan(keys)
+        weights=np.where(missing, 0, np.asarray(population, dtype=np.float64)[:,None])
+        order=np.argsort(keys, axis=0, kind='stable')
+        sorted_keys=np.take_along_axis(keys, order, axis=0)
+        cumulative=np.cumsum(np.take_along_axis(weights, order, axis=0), axis=0)
+        
+        #Position of the last cell of each run of equal values
+        run_end=np.ones(values.shape, dtype=bool)
+        run_end[:-1]=(sorted_keys[1:]!=sorted_keys[:-1])
+        last=np.where(run_end, np.arange(n_cells)[:,None], n_cells-1)
+        last=np.minimum.accumulate(last[::-1], axis=0)[::-1]
+        
+        with np.errstate(divide='ignore', invalid='ignore'):
+            share=np.take_along_axis(cumulative, last, axis=0)/cumulative[-1]
+        np.put_along_axis(result, order, share, axis=0)
+        result[missing]=np.nan
+    
+    return result[:,0] if one_column else result
+
 
 def per_person_index(grid, grid_unmasked, green_grid, distances, threshold, index_storage_name, n_rows):
     
-    tmp=distances.copy()
     tmp_grid=grid.copy()
     #Augment grid information with info from population in boundaries to ensure we are able to identify concurrent population also from boundaries 
     grid_unmasked.loc[grid_unmasked['population']==-200, 'population']=0
-    grid_unmasked['id']=grid_unmasked.apply(lambda x: x['y']+ n_rows*(x['x']-1), axis=1)
+    grid_unmasked['id']=cell_id(grid_unmasked['x'], grid_unmasked['y'], n_rows)
     tmp_grid=pd.merge(tmp_grid[['id','inbound']], grid_unmasked[['id','population']], on=['id'], how='left')
     
-    #Create tuple index from combination of x and y
-    tmp=tmp[tmp['source'].isin(tmp_grid[tmp_grid['population']>=0]['id'])]
-    tmp=tmp[tmp['dest'].isin(green_grid[green_grid['green']==1]['id'])]
-    tmp['id_tmp']=tmp[['dest']]
-    #Filter out cells not reachable
-    tmp=tmp[tmp['dist'].isnull()==False]
-    tmp=tmp[tmp['dist']<=threshold]
+    if isinstance(distances, DistanceMatrix):
+        #Select reachable pairs directly on the sparse matrix
+        tmp=distances.to_dataframe(distances.pair_mask(tmp_grid[tmp_grid['population']>=0]['id'], green_grid[green_grid['green']==1]['id'], threshold))
+        tmp['id_tmp']=tmp[['dest']]
+    else:
+        tmp=distances.copy()
+        #Create tuple index from combination of x and y
+        tmp=tmp[tmp['source'].isin(tmp_grid[tmp_grid['population']>=0]['id'])]
+        tmp=tmp[tmp['dest'].isin(green_grid[green_grid['green']==1]['id'])]
+        tmp['id_tmp']=tmp[['dest']]
+        #Filter out cells not reachable
+        tmp=tmp[tmp['dist'].isnull()==False]
+        tmp=tmp[tmp['dist']<=threshold]
     #Make a copy
     tmp_1=tmp.copy() #Copy of distances
     
@@ -130,11 +498,83 @@ def per_person_index(grid, grid_unmasked, green_grid, distances, threshold, inde
     index=tmp[['source', 'si_perperson']].groupby(['source']).sum()
     del [tmp]
     index=index.reset_index().rename(columns={'source':'id', 'si_perperson':index_storage_name})
-    index=index[index[['id']].isin(tmp_grid[tmp_grid['inbound']==1]['id'])]   
+    index=index[index['id'].isin(tmp_grid[tmp_grid['inbound']==1]['id'])]
     return index[['id',index_storage_name]]
 
 
+def per_person_index_sparse(grid, grid_unmasked, green_grid, distances, threshold, index_storage_name, n_rows):
+    
+    """
+    Drop-in alternative to per_person_index working on arrays indexed by cell id instead of merges between frames
+    -------------------------------------------------------  
+    
+    Parameters:
+    
+    see per_person_index(). distances can be a pandas.DataFrame (from queryDistances) or a DistanceMatrix
+    
+    -------------------------------------------------------  
+    
+    Description:
+    
+    Step 1: Population of the concurrent cells (cells of the grid, with population from the unmasked grid to account also for the population outside the boundary)
+            and green area of each cell, as vectors over the cell ids.
+    Step 2: Reachable pairs (concurrent cells as sources, green cells as destinations, distance lower or equal than threshold) selected on the sparse matrix.
+            Pairs within the threshold are found by a binary search in each row (sorted by distance), the other pairs are not scanned.
+    Step 3: Sparse allocation of the population of each source to its reachable green cells, proportionally to their green area 
+            (rounded to the ceiling integer, as in per_person_index), followed by a sparse reduction over the destinations.
+    Step 4: Green per person of each green cell (in m2), summed over the reachable green cells of each source. Only cells within the bound are returned.
+    
+    -------------------------------------------------------  
+    
+    Return:
+    pandas.DataFrame with columns ['id', index_storage_name]
+    """
+    
+    #Step 1:
+    if not isinstance(distances, DistanceMatrix):
+        distances=DistanceMatrix.from_dataframe(distances, dtype=np.float64)
+    population=grid_unmasked['population'].to_numpy(dtype=np.float64)
+    population=pd.Series(np.where(population==-200, 0, population), index=cell_id(grid_unmasked['x'], grid_unmasked['y'], n_rows))
+    grid_population=population.reindex(grid['id'].values).to_numpy()
+    pop=np.full(distances.n_cells, np.nan)
+    in_matrix=(grid['id'].values<distances.n_cells)
+    pop[grid['id'].values[in_matrix]]=grid_population[in_matrix]
+    si=distances.cell_vector(green_grid['id'], green_grid['si'].fillna(0))
+    
+    #Step 2:
+    pairs=distances.pairs_within(threshold)
+    source=distances.row_ids()[pairs]
+    dest=distances.indices[pairs]
+    keep=distances.cell_mask(grid['id'].values[in_matrix][grid_population[in_matrix]>=0])[source] & distances.cell_mask(green_grid[green_grid['green']==1]['id'])[dest]
+    source=source[keep]
+    dest=dest[keep]
+    
+    #Step 3:
+    si_pair=si[dest]
+    si_tot=np.bincount(source, weights=si_pair, minlength=distances.n_cells)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pop_on_dest=np.ceil(pop[source]*(si_pair/si_tot[source])).astype(np.float32)
+    allocated=pop_on_dest>0
+    pop_on_dest=np.bincount(dest[allocated], weights=pop_on_dest[allocated], minlength=distances.n_cells)
+    
+    #Step 4:
+    si_perperson=np.zeros(distances.n_cells, dtype=np.float64)
+    has_pop=pop_on_dest>0
+    si_perperson[has_pop]=si[has_pop]/pop_on_dest[has_pop]*10000 #in mq2
+    index=np.bincount(source, weights=si_perperson[dest], minlength=distances.n_cells)
+    ids=np.unique(source)
+    ids=ids[np.isin(ids, grid[grid['inbound']==1]['id'].values)]
+    return pd.DataFrame({'id':ids.astype(np.int64), index_storage_name:index[ids]})
+
+
 def minimum_distance_index(grid, green_grid, distances, index_storage_name):
+    if isinstance(distances, DistanceMatrix):
+        #Masked row-minimum: cells within the bound as sources, green cells as destinations
+        pair_mask=distances.pair_mask(grid[grid['inbound']==1]['id'], green_grid[green_grid['green']==1]['id'])
+        index=distances.row_min(pair_mask)
+        ids=np.flatnonzero(np.isfinite(index))
+        return pd.DataFrame({'id':ids, index_storage_name:index[ids]})
+    
     tmp=distances.copy()
     tmp_grid=grid.copy()
 
@@ -149,6 +589,10 @@ def minimum_distance_index(grid, green_grid, distances, index_storage_name):
       
 def exposure_index(grid, green_grid, distances, threshold, index_storage_name):
 
+    if isinstance(distances, DistanceMatrix):
+        #Sum of the green area over the pairs sorted by distance, cut at the threshold by a binary search
+        return exposure_index_thresholds(grid, green_grid, distances, [threshold], index_storage_name)[threshold]
+    
     tmp=distances.copy()
     tmp_grid=grid.copy()
     #keep only cells within the bound as sources
@@ -163,3 +607,36 @@ def exposure_index(grid, green_grid, distances, threshold, index_storage_name):
     index=tmp[['source', 'si']].groupby(['source']).sum().reset_index().rename(columns={'source':'id', 'si':index_storage_name})
     return index
      
+
+
+def exposure_index_thresholds(grid, green_grid, distances, thresholds:list, index_storage_name):
+
+    """
+    Exposure index for several time thresholds at once
+    -------------------------------------------------------  
+    
+    Parameters:
+    
+    see exposure_index(). distances must be a DistanceMatrix, thresholds is a list of time thresholds (in minutes)
+    
+    -------------------------------------------------------  
+    
+    Description:
+    
+    The pairs of each source are sorted by distance in the DistanceMatrix, hence the pairs within each threshold are found by a binary search in each row.
+    The green area of the reachable green cells is accumulated over increasing thresholds (see DistanceMatrix.row_sum_thresholds): 
+    each pair is summed once, so that computing all the thresholds costs about the same as computing the largest one.
+    
+    -------------------------------------------------------  
+    
+    Return:
+    dictionary {threshold: pandas.DataFrame with columns ['id', index_storage_name]}
+    """
+    
+    pair_mask=distances.pair_mask(grid[grid['inbound']==1]['id'], green_grid[green_grid['green']==1]['id'])
+    sums=distances.row_sum_thresholds(pair_mask, distances.cell_vector(green_grid['id'], green_grid['si']), thresholds)
+    result={}
+    for threshold, (index, n_dest) in sums.items():
+        ids=np.flatnonzero(n_dest>0)
+        result[threshold]=pd.DataFrame({'id':ids, index_storage_name:index[ids]})
+    return result
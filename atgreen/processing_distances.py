@@ -1,9 +1,54 @@
 #Import standard libraries needed for the Data Processing and Cleaning
 from .basic import *
+from .utils_grid import *
+from .utils_distances import *
 from rtree import index
 from geopy.distance import geodesic
+from pyproj import Geod
 import subprocess
 import datetime
+import json
+
+
+"""             Geodesic distances                                           """
+
+def geodesic_distances(lat_source, long_source, lat_dest, long_dest, method:str='haversine', walking_speed:float=5):
+    
+    """ 
+    Compute the geodesic distances between pairs of points at once, and the corresponding walking time.
+    
+    -------------------------------------------------------  
+    
+    Parameters:
+    lat_source, long_source: coordinates of the origins in EPSG:4326 (numpy.ndarray or pandas.Series)
+    lat_dest, long_dest: coordinates of the destinations in EPSG:4326 (numpy.ndarray or pandas.Series)
+    method: 'haversine' (great-circle distance on a sphere of radius 6371.0088 km) 
+            or 'pyproj' (distance on the WGS84 ellipsoid with pyproj.Geod.inv, equivalent to geopy.distance.geodesic)
+    walking_speed: walking speed in km/h used to convert distances in minutes
+    
+    -------------------------------------------------------  
+    
+    Return: 
+    tuple of numpy.ndarray of float32 (meters, minutes)
+    """
+    
+    if method not in ['haversine', 'pyproj']:
+        raise ValueError("Value for the parameter 'method' should be in ['haversine', 'pyproj']")
+    
+    lat_source=np.asarray(lat_source, dtype=np.float64)
+    long_source=np.asarray(long_source, dtype=np.float64)
+    lat_dest=np.asarray(lat_dest, dtype=np.float64)
+    long_dest=np.asarray(long_dest, dtype=np.float64)
+    
+    if method=='pyproj':
+        _, _, meters=Geod(ellps='WGS84').inv(long_source, lat_source, long_dest, lat_dest)
+    else:
+        lat1, long1, lat2, long2=map(np.radians, [lat_source, long_source, lat_dest, long_dest])
+        a=np.sin((lat2-lat1)/2)**2+np.cos(lat1)*np.cos(lat2)*np.sin((long2-long1)/2)**2
+        meters=2*6371008.8*np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+    
+    minutes=meters*60/(walking_speed*1000)
+    return meters.astype(np.float32), minutes.astype(np.float32)
 
 
 """             Distance Calculation using OSRM                          """
@@ -48,10 +93,116 @@ def osrm_files_creation(filename, folder_input, folder_working, profile):
     else:
         return res
         
+def pairs_cell_ids(df):
+    
+    """ 
+    Integer cell ids of the origins and destinations of a df of pairs (id = y + n_rows*(x-1), see utils_grid), with n_rows the largest row in df.
+    The same df always leads to the same ids, so that they can be used to match the plans of the OSRM runs with the pairs.
+    
+    -------------------------------------------------------  
+    Parameters:
+    
+    df: df with pairs of coordinates to compute distances (columns x_source, y_source, x_dest, y_dest)
+    
+    -------------------------------------------------------  
+
+    Return: 
+    tuple of numpy.ndarray of int64 (source ids, destination ids)
+    """
+
+    n_rows=int(max(df['y_source'].max(), df['y_dest'].max()))
+    return cell_id(df['x_source'], df['y_source'], n_rows), cell_id(df['x_dest'], df['y_dest'], n_rows)
+
+
+def osrm_batches_plan(df, len_vector):
+    
+    """ 
+    Plan all the batches of coordinates needed to compute the missing distances of a city.
+    Each batch is a list of at most len_vector coordinates, made of some origins and all their destinations, whose full distance matrix is computed by OSRM (see one_run_osrm, one_run_osrm_worker).
+    
+    -------------------------------------------------------  
+    Parameters:
+    
+    df: df with pairs of coordinates to compute distances (columns x_source, y_source, lat_source, long_source, x_dest, y_dest, lat_dest, long_dest, walk_durations)
+    len_vector: maximum number of coordinates in a batch. A batch can only be larger when a single origin has more than len_vector-1 destinations
+    
+    -------------------------------------------------------  
+    
+    Description:
+    
+    Step 1: Identify origin-destination distances not yet computed and assign an integer cell id to origins and destinations. 
+            Sort the pairs by origin, so that consecutive origins are close to each other and share most of the destinations.
+    Step 2: Write the origins and their destinations as a single sequence of cell ids [origin 1, destinations of origin 1, origin 2, ...] 
+            and compute for each element the position of the previous occurrence of the same cell. 
+            An element is new in a batch starting at position start if its previous occurrence is before start.
+    Step 3: Pack consecutive origins in batches: the number of distinct coordinates of the batch is the cumulative count of new elements, 
+            so that the end of the batch is found with a search on the origins ends. Only a window of the sequence is scanned for each batch.
+    Step 4: Keep the distinct coordinates of each batch, with their position in the batch.
+    
+    -------------------------------------------------------  
+
+    Return: 
+    pandas.DataFrame with one row for each coordinate of each batch, with columns ['batch', 'index' (position in the batch), 'id', 'long', 'lat', 'origin' (True in the batch where the pairs of the cell as origin are computed)]
+    """
+
+    #Step 1:
+    pending=(df['walk_durations'].isnull()==True).values
+    tmp=df[pending]
+    source, dest=pairs_cell_ids(df)
+    source, dest=source[pending], dest[pending]
+    coords=pd.concat([pd.DataFrame({'id':source, 'long':tmp['long_source'].values, 'lat':tmp['lat_source'].values}),
+                      pd.DataFrame({'id':dest, 'long':tmp['long_dest'].values, 'lat':tmp['lat_dest'].values})]).drop_duplicates(subset='id').set_index('id')
+    order=np.lexsort((dest, source))
+    source, dest=source[order], dest[order]
+    origins, first, counts=np.unique(source, return_index=True, return_counts=True)
+
+    #Step 2:
+    #Position of each origin and each destination in the sequence
+    origin_pos=first+np.arange(len(origins))
+    sequence=np.zeros(len(source)+len(origins), dtype=np.int64)
+    is_origin=np.zeros(len(sequence), dtype=bool)
+    is_origin[origin_pos]=True
+    sequence[is_origin]=origins
+    sequence[~is_origin]=dest
+    ends=origin_pos+counts+1
+    by_cell=np.argsort(sequence, kind='stable')
+    previous=np.full(len(sequence), -1, dtype=np.int64)
+    same=sequence[by_cell][1:]==sequence[by_cell][:-1]
+    previous[by_cell[1:][same]]=by_cell[:-1][same]
+
+    #Step 3:
+    batch=np.zeros(len(sequence), dtype=np.int64)
+    start, n_batch=0, 0
+    while start<len(sequence):
+        window=4*len_vector
+        while True:
+            stop=min(start+window, len(sequence))
+            n_new=np.cumsum(previous[start:stop]<start)
+            first_end=np.searchsorted(ends, start, side='right')
+            last_end=np.searchsorted(ends, stop, side='right')
+            fits=np.searchsorted(n_new[ends[first_end:last_end]-start-1], len_vector, side='right')
+            #If all the origins in the window fit, the window may be too short for the batch
+            if (fits<last_end-first_end) or (stop==len(sequence)):
+                break
+            window=2*window
+        end=ends[first_end+max(fits, 1)-1]
+        batch[start:end]=n_batch
+        start, n_batch=end, n_batch+1
+
+    #Step 4:
+    plan=pd.DataFrame({'batch':batch, 'id':sequence}).drop_duplicates()
+    plan['index']=plan.groupby('batch').cumcount()
+    plan['long']=coords.loc[plan['id'].values, 'long'].values
+    plan['lat']=coords.loc[plan['id'].values, 'lat'].values
+    n_ids=int(sequence.max(initial=0))+1
+    plan['origin']=np.isin(plan['batch'].values*n_ids+plan['id'].values, batch[origin_pos]*n_ids+origins)
+    return plan[['batch', 'index', 'id', 'long', 'lat', 'origin']].reset_index(drop=True)
+
+        
 def coords_vector_identification(df, len_vector, filename, folder_working):
     
     """ 
-    The function generate a list of coordinates x y. The coordinate list are prioritize so that coordinates that appear more frequently in our distance matrix are computed first. 
+    The function generate a list of coordinates x y, corresponding to the first batch planned by osrm_batches_plan.
     
     -------------------------------------------------------  
     Parameters:
@@ -65,33 +216,20 @@ def coords_vector_identification(df, len_vector, filename, folder_working):
     
     Description:
     
-    Step 1: Identify origin-destination distances not yet computed. Sort origins by frequnecy. 
-    Step 2: Iteratively: append the coordinates of the more frequent origin and the coordinates of all destinations associated with this origin. 
-            Repeat until you reach the desired length of the vector.
-    Step 3: Save the coordinates list to txt file
+    Step 1: Plan the batches of coordinates for the distances not yet computed (see osrm_batches_plan) and keep the first one.
+    Step 2: Save the coordinates list to txt file
     
     -------------------------------------------------------  
 
     Return: 
-    pandas.dataframe 
+    pandas.dataframe with columns ['index' (position in the list), 'long', 'lat', 'id' (cell id)]
     """
 
     #Step 1:
-    tmp=df[(df['walk_durations'].isnull()==True)].reset_index(drop=True)
-    tmp1=tmp[['long_source','lat_source','x_dest', 'y_dest']].groupby(['long_source','lat_source']).count().sort_values(by=['x_dest', 'y_dest'], ascending=False).reset_index().drop(columns=['x_dest', 'y_dest']).rename(columns={'long_source':'long','lat_source':'lat'})
+    plan=osrm_batches_plan(df, len_vector)
+    subset=plan[plan['batch']==0][['index', 'long', 'lat', 'id']].reset_index(drop=True)
 
     #Step 2:
-    subset=pd.DataFrame({'long':[], 'lat':[]})
-    i=0
-    while (len(subset)<len_vector) and (i in list(tmp1.index)):
-        subset=pd.concat([subset, tmp1[(tmp1.index==i)][['lat', 'long']]])
-        subset=pd.concat([subset, tmp[((tmp['lat_source']==tmp1.at[i,'lat']) & (tmp['long_source']==tmp1.at[i,'long']))][['lat_dest','long_dest']].rename(columns={'long_dest':'long', 'lat_dest':'lat'})])
-        if len(subset)>2:
-            subset=subset.drop_duplicates()
-        i=i+1        
-
-    #Step 3:
-    subset=subset.reset_index(drop=True).reset_index()
     os.chdir(folder_working)
     np.savetxt(filename, subset[['long','lat']].values, delimiter=',', header='long,lat') 
     return subset
@@ -123,6 +261,97 @@ def one_run_osrm(filename_osm, filename_input, filename_output, working_folder):
     return res
 
     
+class OSRMWorker:
+
+    """
+    Long-lived routing worker for one city - see code in worker.js.
+    The osrm graph is loaded once when the worker is started and batches of coordinates are then sent through a pipe, 
+    getting the durations back as binary float32 arrays. This avoids starting node and reloading the graph for every batch.
+    The osrm files must be available in working_folder (see osrm_files_creation).
+
+    Usage:
+    with OSRMWorker(city, working_folder) as worker:
+        durations=worker.table(coordinates)
+    """
+
+    def __init__(self, filename_osm:str, working_folder:str, script:str='worker.js'):
+        self.process = subprocess.Popen(['node', script, filename_osm], cwd=working_folder, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def table(self, coordinates, sources=None, destinations=None):
+
+        """
+        Compute the walking durations between coordinates.
+
+        -------------------------------------------------------
+
+        Parameters:
+
+        coordinates: array-like of shape (n, 2) with (long, lat) in EPSG:4326
+        sources: positions in coordinates of the origins. If None, all coordinates are used
+        destinations: positions in coordinates of the destinations. If None, all coordinates are used
+
+        -------------------------------------------------------
+
+        Return:
+        numpy.ndarray of float32 of shape (n_sources, n_destinations) with the durations in seconds (NaN for unroutable pairs)
+        """
+
+        request={'coordinates':np.asarray(coordinates, dtype=np.float64).tolist()}
+        if sources is not None:
+            request['sources']=np.asarray(sources, dtype=np.int64).tolist()
+        if destinations is not None:
+            request['destinations']=np.asarray(destinations, dtype=np.int64).tolist()
+        self.process.stdin.write((json.dumps(request)+'\n').encode('utf-8'))
+        self.process.stdin.flush()
+
+        header=self.process.stdout.readline()
+        if header==b'':
+            raise Exception('OSRM worker terminated with code '+str(self.process.poll()))
+        header=json.loads(header)
+        n_bytes=4*header['n_sources']*header['n_destinations']
+        buffer=self.process.stdout.read(n_bytes)
+        if len(buffer)<n_bytes:
+            raise Exception('Incomplete answer from the OSRM worker.')
+        if header['error'] is not None:
+            raise Exception('OSRM error: '+header['error'])
+        return np.frombuffer(buffer, dtype='<f4').reshape(header['n_sources'], header['n_destinations'])
+
+    def close(self):
+
+        """ Stop the worker """
+
+        if self.process.poll() is None:
+            self.process.stdin.close()
+            self.process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def one_run_osrm_worker(worker, subset):
+    
+    """
+    Compute the durations between all the coordinates of subset with a running OSRMWorker. 
+    Equivalent to one_run_osrm, without starting node nor writing the durations to file.
+    
+    -------------------------------------------------------  
+    
+    Parameters:
+    
+    worker: OSRMWorker of the city
+    subset: list of coordinates (from coords_vector_identification)
+    
+    -------------------------------------------------------  
+    
+    Return
+    numpy.ndarray of float32 with the matrix of durations in seconds, to be passed to merge_one_run
+    
+    """
+    return worker.table(subset[['long','lat']].values)
+
 def merge_one_run(df, subset,filename_input, working_folder):
     
     """ 
@@ -132,49 +361,195 @@ def merge_one_run(df, subset,filename_input, working_folder):
     
     Parameters:
     df: list of distances queries provided as a pandas.DataFrame
-    subset: list of coordinates, as submitted to osrm (from coords_vector_identification)
-    city: name of the city
-    filename_input: name of output file from one_run_osrm
+    subset: list of coordinates, as submitted to osrm (from coords_vector_identification or one batch of osrm_batches_plan)
+    filename_input: name of output file from one_run_osrm, or matrix of durations from one_run_osrm_worker
     working_folder: working_folder
     
     -------------------------------------------------------  
 
     Description:
-    Step 1: Read computed durations.
-    Step 2: Merge df and subset to identify position of each origin or destination from subset in df.
-    Step 3: Merge the durations to the df based on the computed positions and update information on the duration (from column value).
-            Repeat swopping origin and destination position (for the foot profile the distance is the same)
-            Keep only relevant columns:
-            [0: origin cell id
-             1: destination cell id
-             2,3: x,y coord of origin
-             4,5: x,y coord of destination
-             'durations': walking distance in seconds]
+    Step 1: Read computed durations as a matrix (pos1 x pos2).
+    Step 2: Identify the position in subset of each origin and destination of df from the cell ids (-1 if not in subset).
+    Step 3: Gather the durations of the pairs in subset directly from the matrix and update the missing durations.
+            Repeat swopping origin and destination position (for the foot profile the distance is the same).
              
     -------------------------------------------------------  
 
     Return: 
-    pandas.DataFrame
+    pandas.DataFrame (df with updated column 'walk_durations', in seconds)
     """
 
     #Step 1:
     os.chdir(working_folder)
-    durations = pd.read_csv(filename_input, delimiter=',', header=None, low_memory=False).reset_index().melt(id_vars='index').rename(columns={'index':'pos1','variable':'pos2' })
+    if isinstance(filename_input, np.ndarray):
+        durations = filename_input
+    else:
+        durations = pd.read_csv(filename_input, delimiter=',', header=None, low_memory=False).apply(pd.to_numeric, errors='coerce').to_numpy(dtype=np.float64)
     #Step 2:
-    df=pd.merge(df, subset,left_on=['lat_source','long_source'],  right_on=['lat','long'], how='left').rename(columns={'index':'pos1'})
-    df=pd.merge(df, subset, left_on=['lat_dest','long_dest'], right_on=['lat','long'], how='left').rename(columns={'index':'pos2'})
-    df=df[['x_source', 'y_source', 'lat_source', 'long_source','x_dest', 'y_dest', 'lat_dest', 'long_dest', 'pos1', 'pos2', 'walk_durations']]
+    source, dest=pairs_cell_ids(df)
+    pos1=pd.Index(subset['id']).get_indexer(source)
+    pos2=pd.Index(subset['id']).get_indexer(dest)
     #Step 3: 
-    df=pd.merge(df, durations, on=['pos1', 'pos2'], how='left')
-    df['walk_durations']=df['walk_durations'].fillna(df['value'])
-    df=df.drop(columns=['value'])
-    df=pd.merge(df, durations, left_on=['pos2', 'pos1'], right_on=['pos1', 'pos2'], how='left')
-    df['walk_durations']=df['walk_durations'].fillna(df['value'])
-    df=df.drop(columns=['value'])
-    df=df[['x_source', 'y_source', 'lat_source', 'long_source','x_dest', 'y_dest', 'lat_dest', 'long_dest', 'walk_durations']]
+    df=df.copy()
+    walk_durations=df['walk_durations'].to_numpy(dtype=np.float64, copy=True)
+    computed=(pos1>=0) & (pos2>=0)
+    for a, b in [(pos1, pos2), (pos2, pos1)]:
+        missing=computed & np.isnan(walk_durations)
+        walk_durations[missing]=durations[a[missing], b[missing]]
+    df['walk_durations']=walk_durations
+    return df
+
+def osrm_blocks_plan(df, block_size, filename_coords, filename_plan, working_folder):
+    
+    """ 
+    Tile the distances to compute in blocks of sources and destinations, to be computed with run_blocks.js (see one_run_osrm_blocks).
+    Differently from coords_vector_identification, only the pairs in df are requested to OSRM and all the pairs are planned at once.
+    
+    -------------------------------------------------------  
+    Parameters:
+    
+    df: df with pairs of coordinates to compute distances (columns x_source, y_source, lat_source, long_source, x_dest, y_dest, lat_dest, long_dest, walk_durations and, optionally, walk_access)
+    block_size: number of sources in each block. The destinations of a block are all the destinations of its sources 
+    filename_coords: name of the file where the list of coordinates is saved
+    filename_plan: name of the file where the blocks are saved (one JSON line per block)
+    working_folder: working_folder
+    
+    -------------------------------------------------------  
+    
+    Description:
+    
+    Step 1: Identify origin-destination distances not yet computed (and with walk_access==1, if available). Assign an integer id to each cell.
+    Step 2: Sort the pairs by source and group consecutive sources in blocks of block_size sources. 
+            As cell ids follow the columns of the grid, sources in the same block are close to each other and share most of the destinations.
+    Step 3: Compute the position of the source and destination of each pair within its block.
+    Step 4: Save the coordinates list and the blocks to file
+    
+    -------------------------------------------------------  
+
+    Return: 
+    pandas.DataFrame with one row for each pair to compute, with columns ['pair' (index of the pair in df), 'block', 'pos_source', 'pos_dest', 'offset' (position of the duration in the output of run_blocks.js)]
+    """
+
+    #Step 1:
+    pending=(df['walk_durations'].isnull()==True)
+    if 'walk_access' in df.columns:
+        pending&=(df['walk_access']==1)
+    tmp=df[pending]
+    source, dest=pairs_cell_ids(df)
+    source, dest=source[pending.values], dest[pending.values]
+    coords=pd.concat([pd.DataFrame({'id':source, 'long':tmp['long_source'].values, 'lat':tmp['lat_source'].values}),
+                      pd.DataFrame({'id':dest, 'long':tmp['long_dest'].values, 'lat':tmp['lat_dest'].values})]).drop_duplicates(subset='id').sort_values(by='id').reset_index(drop=True)
+    source_pos=np.searchsorted(coords['id'].values, source)
+    dest_pos=np.searchsorted(coords['id'].values, dest)
+
+    #Step 2:
+    order=np.lexsort((dest_pos, source_pos))
+    source_pos, dest_pos=source_pos[order], dest_pos[order]
+    pair=np.arange(len(df))[pending.values][order]
+    _, source_rank=np.unique(source_pos, return_inverse=True)
+    block=source_rank//block_size
+
+    #Step 3:
+    blocks=[]
+    pos_source=np.zeros(len(pair), dtype=np.int64)
+    pos_dest=np.zeros(len(pair), dtype=np.int64)
+    offset=np.zeros(len(pair), dtype=np.int64)
+    bounds=np.searchsorted(block, np.arange(block.max()+2 if len(block)>0 else 0))
+    block_offset=0
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        sources_block=np.unique(source_pos[start:end])
+        dests_block=np.unique(dest_pos[start:end])
+        pos_source[start:end]=np.searchsorted(sources_block, source_pos[start:end])
+        pos_dest[start:end]=np.searchsorted(dests_block, dest_pos[start:end])
+        offset[start:end]=block_offset+pos_source[start:end]*len(dests_block)+pos_dest[start:end]
+        block_offset+=len(sources_block)*len(dests_block)
+        blocks.append((sources_block, dests_block))
+    plan=pd.DataFrame({'pair':pair, 'block':block, 'pos_source':pos_source, 'pos_dest':pos_dest, 'offset':offset})
+
+    #Step 4:
+    os.chdir(working_folder)
+    np.savetxt(filename_coords, coords[['long','lat']].values, delimiter=',')
+    with open(filename_plan, 'w') as file:
+        for s, d in blocks:
+            file.write(json.dumps({'sources':s.tolist(), 'destinations':d.tolist()})+'\n')
+    return plan
+
+
+def one_run_osrm_blocks(filename_osm, filename_coords, filename_plan, filename_output, working_folder):
+    
+    """
+    Run OSRM on all the blocks of a plan - see code in run_blocks.js.
+    The osrm graph is loaded once and the durations of each block are appended to filename_output as soon as they are computed.
+    
+    -------------------------------------------------------  
+    
+    Parameters:
+    
+    filename_osm: name of osm.pbf original file
+    filename_coords: name of the coordinates file (from osrm_blocks_plan)
+    filename_plan: name of the plan file (from osrm_blocks_plan)
+    filename_output: name of output file 
+    working_folder: working_folder
+    
+    -------------------------------------------------------  
+    
+    Return
+    Diagnostic code (returncode 1 if any block failed, see merge_osrm_blocks)
+    
+    """
+    os.chdir(working_folder)
+    cmd=f"node run_blocks.js {filename_coords} {filename_osm} {filename_plan} {filename_output}"
+    res=subprocess.run(cmd, shell=True)   
+    return res
+
+
+def merge_osrm_blocks(df, plan, filename_input, working_folder):
+    
+    """ 
+    Assemble the durations computed by one_run_osrm_blocks
+    
+    -------------------------------------------------------
+    
+    Parameters:
+    df: list of distances queries provided as a pandas.DataFrame (as submitted to osrm_blocks_plan)
+    plan: output of osrm_blocks_plan
+    filename_input: name of output file from one_run_osrm_blocks
+    working_folder: working_folder
+    
+    -------------------------------------------------------  
+
+    Description:
+    Step 1: Check the status of the blocks (filename_input.status, written by run_blocks.js): failed blocks are stored as NaN, 
+            hence they are reported as an error instead of being read as unroutable pairs.
+            Memory-map the computed durations (float32, NaN for unroutable pairs).
+    Step 2: Read the duration of each planned pair at its offset and fill the missing walk_durations of df.
+             
+    -------------------------------------------------------  
+
+    Return: 
+    pandas.DataFrame
+    """
+
+    #Step 1:
+    os.chdir(working_folder)
+    n_blocks=int(plan['block'].max())+1 if len(plan)>0 else 0
+    status=open(f"{filename_input}.status").read().splitlines() if os.path.exists(f"{filename_input}.status") else []
+    if len(status)<n_blocks:
+        raise Exception('Incomplete output from run_blocks.js.')
+    failed=[line for line in status[:n_blocks] if line!='ok']
+    if len(failed)>0:
+        raise Exception(f"{len(failed)} blocks failed in run_blocks.js ({failed[0]}).")
+    durations=np.memmap(filename_input, dtype=np.float32, mode='r') if os.path.getsize(filename_input)>0 else np.zeros(0, dtype=np.float32)
+    if len(durations)<(plan['offset'].max()+1 if len(plan)>0 else 0):
+        raise Exception('Incomplete output from run_blocks.js.')
+    #Step 2:
+    df=df.copy()
+    walk_durations=df['walk_durations'].to_numpy(dtype=np.float64, copy=True)
+    walk_durations[plan['pair'].values]=durations[plan['offset'].values]
+    df['walk_durations']=walk_durations
     return df
 
-def osrm_files_deletion(filename_osm, filename_coords, filename_dur , working_folder):
+def osrm_files_deletion(filename_osm, filename_coords, filename_dur , working_folder, filename_plan=None):
     
     """ 
     Delete files created to compute distances
@@ -202,13 +577,302 @@ def osrm_files_deletion(filename_osm, filename_coords, filename_dur , working_fo
     res=subprocess.run(cmd, shell=True)
     if res.returncode!=0:
         raise Exception('Unable to delete file.')
-    #Remove other ancillary files
-    cmd=f"rm {filename_coords}"
-    res=subprocess.run(cmd, shell=True)
-    if res.returncode!=0:
-        raise Exception('Unable to delete file.')
-    cmd=f"rm {filename_dur}"
-    res=subprocess.run(cmd, shell=True) 
-    if res.returncode!=0:
-        raise Exception('Unable to delete file.')
+    #Remove other ancillary files (if any)
+    if filename_dur is not None and os.path.exists(f"{filename_dur}.status"):
+        os.remove(f"{filename_dur}.status")
+    for filename in [filename_coords, filename_dur, filename_plan]:
+        if filename is not None:
+            cmd=f"rm {filename}"
+            res=subprocess.run(cmd, shell=True) 
+            if res.returncode!=0:
+                raise Exception('Unable to delete file.')
+
+
+"""             Persistent store of the computed distances                  """
+
+#Record of the store: position of the origin and destination in the grid and walking duration in seconds (NaN if OSRM could not route the pair)
+PAIR_STORE_DTYPE=np.dtype([('x_source', '<i4'), ('y_source', '<i4'), ('x_dest', '<i4'), ('y_dest', '<i4'), ('walk_durations', '<f4')])
+
+def pair_store_filename(store_dir:str, city:str, profile:str):
+    
+    """ Name of the file storing the computed distances of a city for a routing profile """
+    
+    return f"{store_dir}/{city}_{profile}.pairs"
+
+
+def pair_store_append(filename:str, pairs:pd.DataFrame):
+    
+    """ 
+    Append computed distances to the store. The file is only appended to and synced to disk, so that a crash loses at most the batch being written
+    (a partially written record is dropped by the next append).
     
+    -------------------------------------------------------  
+    Parameters:
+    
+    filename: name of the store (from pair_store_filename)
+    pairs: pandas.DataFrame with columns x_source, y_source, x_dest, y_dest, walk_durations
+    
+    -------------------------------------------------------  
+
+    Return: 
+    empty
+    """
+
+    records=np.zeros(len(pairs), dtype=PAIR_STORE_DTYPE)
+    for col in PAIR_STORE_DTYPE.names:
+        records[col]=pairs[col].values
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    with open(filename, 'ab') as file:
+        #Drop a partially written last record, if any
+        file.truncate(file.tell()//PAIR_STORE_DTYPE.itemsize*PAIR_STORE_DTYPE.itemsize)
+        file.write(records.tobytes())
+        file.flush()
+        os.fsync(file.fileno())
+
+
+def pair_store_read(filename:str):
+    
+    """ 
+    Read the computed distances from the store. A partially written last record (after a crash) is ignored.
+    
+    -------------------------------------------------------  
+    Parameters:
+    
+    filename: name of the store (from pair_store_filename)
+    
+    -------------------------------------------------------  
+
+    Return: 
+    pandas.DataFrame with columns x_source, y_source, x_dest, y_dest, walk_durations (in seconds)
+    """
+
+    if not os.path.exists(filename):
+        return pd.DataFrame(np.zeros(0, dtype=PAIR_STORE_DTYPE))
+    n_records=os.path.getsize(filename)//PAIR_STORE_DTYPE.itemsize
+    return pd.DataFrame(np.fromfile(filename, dtype=PAIR_STORE_DTYPE, count=n_records))
+
+
+def pair_store_lookup(df, filename:str):
+    
+    """ 
+    Fill the missing walk_durations of df with the distances already in the store.
+    As for merge_one_run, if a pair is not in the store the reverse pair is used (for the foot profile the distance is the same).
+    
+    -------------------------------------------------------  
+    Parameters:
+    
+    df: df with pairs of coordinates to compute distances (columns x_source, y_source, x_dest, y_dest, walk_durations)
+    filename: name of the store (from pair_store_filename)
+    
+    -------------------------------------------------------  
+
+    Return: 
+    tuple (df with updated column 'walk_durations', boolean numpy.ndarray with True for the pairs found in the store)
+    """
+
+    keys=['x_source', 'y_source', 'x_dest', 'y_dest']
+    store=pair_store_read(filename).drop_duplicates(subset=keys, keep='last')
+    store_index=pd.MultiIndex.from_frame(store[keys])
+    df=df.copy()
+    walk_durations=df['walk_durations'].to_numpy(dtype=np.float64, copy=True)
+    found=np.zeros(len(df), dtype=bool)
+    for cols in [keys, ['x_dest', 'y_dest', 'x_source', 'y_source']]:
+        pos=store_index.get_indexer(pd.MultiIndex.from_frame(df[cols].astype(np.int32), names=keys))
+        new=(pos>=0) & (found==False)
+        walk_durations[new]=np.where(np.isnan(walk_durations[new]), store['walk_durations'].values[pos[new]], walk_durations[new])
+        found|=new
+    df['walk_durations']=walk_durations
+    return df, found
+
+
+def osrm_resumable_run(df, city:str, profile:str, store_dir:str, worker, len_vector:int=2000):
+    
+    """ 
+    Compute the walking durations of a city, resuming from the distances already in the store.
+    Only the pairs not yet in the store are sent to OSRM, so that a crashed run can be restarted and new cells (ex: after a change of the buffer) 
+    can be added without recomputing the existing pairs.
+    
+    -------------------------------------------------------  
+    Parameters:
+    
+    df: df with pairs of coordinates to compute distances (columns x_source, y_source, lat_source, long_source, x_dest, y_dest, lat_dest, long_dest and, optionally, walk_access)
+    city: name of the city
+    profile: profile for the routing
+    store_dir: directory of the store
+    worker: OSRMWorker of the city
+    len_vector: maximum number of coordinates in a batch (see osrm_batches_plan)
+    
+    -------------------------------------------------------  
+    
+    Description:
+    
+    Step 1: Fill the durations already in the store and identify the missing pairs (with walk_access==1, if available).
+    Step 2: Plan the batches for the missing pairs (see osrm_batches_plan). Each pair is computed in the batch of its origin.
+    Step 3: For each batch, compute the durations with the worker, gather the durations of the pairs of the batch 
+            (from the reverse pair if OSRM could not route the pair) and append them to the store.
+    
+    -------------------------------------------------------  
+
+    Return: 
+    pandas.DataFrame (df with column 'walk_durations', in seconds)
+    """
+
+    #Step 1:
+    if 'walk_durations' not in df.columns:
+        df=df.assign(walk_durations=np.nan)
+    filename=pair_store_filename(store_dir, city, profile)
+    df, found=pair_store_lookup(df, filename)
+    pending=(found==False)
+    if 'walk_access' in df.columns:
+        pending&=(df['walk_access']==1).values
+    print(str(city)+", pairs in store: "+str(found.sum())+", missing pairs: "+str(pending.sum()))
+    if pending.sum()==0:
+        return df
+
+    #Step 2:
+    tmp=df[pending].assign(walk_durations=np.nan)
+    plan=osrm_batches_plan(tmp, len_vector)
+    source, dest=pairs_cell_ids(tmp)
+    origin_batch=plan[plan['origin']==True].set_index('id')['batch']
+    pair_batch=origin_batch.loc[source].values
+    pair_order=np.argsort(pair_batch, kind='stable')
+    bounds=np.searchsorted(pair_batch[pair_order], np.arange(plan['batch'].max()+2))
+
+    #Step 3:
+    walk_durations=df['walk_durations'].to_numpy(dtype=np.float64, copy=True)
+    pending_pos=np.where(pending)[0]
+    for b, subset in plan.groupby('batch', sort=True):
+        durations=worker.table(subset[['long','lat']].values)
+        pairs=pair_order[bounds[b]:bounds[b+1]]
+        pos1=pd.Index(subset['id']).get_indexer(source[pairs])
+        pos2=pd.Index(subset['id']).get_indexer(dest[pairs])
+        values=durations[pos1, pos2]
+        values=np.where(np.isnan(values), durations[pos2, pos1], values)
+        walk_durations[pending_pos[pairs]]=values
+        pair_store_append(filename, tmp.iloc[pairs][['x_source', 'y_source', 'x_dest', 'y_dest']].assign(walk_durations=values))
+    df['walk_durations']=walk_durations
+    return df
+
+
+"""             Binary per-city distance files                               """
+
+def write_distance_file(df, filename:str, n_rows:int, n_cols:int, columns:dict={'walk_minutes':10, 'geodesic_minutes':10}, codec:str='zstd', block_size:int=1048576):
+    
+    """ 
+    Save the distances of a city to a binary distance file (read back with read_distance_file). 
+    The file is first written to a temporary file and then moved, so that readers never see partial files.
+    
+    -------------------------------------------------------  
+    Parameters:
+    
+    df: df with the distances (columns x_source, y_source, x_dest, y_dest and the columns in columns)
+    filename: name of the distance file
+    n_rows: number of rows of the grid
+    n_cols: number of columns of the grid
+    columns: dictionary {column: scale}. Each column is stored as uint16 round(value*scale) (ex: scale 10 stores minutes as tenths of minute)
+    codec: 'zstd', 'lz4' or 'none'. Files with codec 'none' are memory-mapped when read
+    block_size: number of elements of each compressed block
+    
+    -------------------------------------------------------  
+    
+    Description:
+    
+    Step 1: Identify source and destination by their cell id (id = y + n_rows*(x-1)) and convert the distances to uint16 (NaN to DISTANCE_FILE_MISSING).
+    Step 2: Sort the pairs by source and, within each source, by the first column (as in DistanceMatrix), and build the CSR structure.
+    Step 3: Write the header (grid dimensions, codec, columns and position of the sections) and the sections.
+    
+    -------------------------------------------------------  
+
+    Return: 
+    empty
+    """
+
+    if codec not in ['zstd', 'lz4', 'none']:
+        raise Exception("Value for the parameter 'codec' should be in ['zstd', 'lz4', 'none']")
+    
+    #Step 1:
+    if not (cell_in_grid(df['x_source'], df['y_source'], n_rows, n_cols).all() and cell_in_grid(df['x_dest'], df['y_dest'], n_rows, n_cols).all()):
+        raise Exception("Cells outside the grid")
+    n_cells=n_rows*n_cols+1
+    source=cell_id(df['x_source'], df['y_source'], n_rows)
+    dest=cell_id(df['x_dest'], df['y_dest'], n_rows).astype(np.int32)
+    values={}
+    for column, scale in columns.items():
+        value=np.round(df[column].to_numpy(dtype=np.float64)*scale)
+        if (value[np.isnan(value)==False]>=DISTANCE_FILE_MISSING).any() or (value<0).any():
+            raise Exception(f"Values of {column} out of range for scale {scale}")
+        values[column]=np.where(np.isnan(value), DISTANCE_FILE_MISSING, value).astype(np.uint16)
+    
+    #Step 2:
+    sorted_by=list(columns)[0] if len(columns)>0 else None
+    order=np.lexsort((values[sorted_by], source)) if sorted_by is not None else np.argsort(source, kind='stable')
+    indptr=np.zeros(n_cells+1, dtype=np.int64)
+    indptr[1:]=np.cumsum(np.bincount(source, minlength=n_cells))
+    sections={'indptr':indptr, 'indices':dest[order]}
+    for column in columns:
+        sections[column]=values[column][order]
+    
+    #Step 3:
+    #Sections are first encoded, so that their position is known when the header is written
+    encoded={}
+    for name, section in sections.items():
+        if codec=='none':
+            encoded[name]=[(section.tobytes(), len(section))]
+        else:
+            encoded[name]=[(pa.compress(section[i:i+block_size].tobytes(), codec=codec, asbytes=True), len(section[i:i+block_size])) for i in range(0, len(section), block_size)]
+    
+    header={'n_rows':int(n_rows), 'n_cols':int(n_cols), 'n_cells':int(n_cells), 'n_pairs':int(len(dest)), 'codec':codec, 'sorted_by':sorted_by, 
+            'columns':{column:scale for column, scale in columns.items()}, 'sections':{}}
+    #The length of the header depends on the offsets: offsets are computed from an upper bound of the header length
+    header_length=len(json.dumps(header))+sum([128+len(name)+48*len(blocks) for name, blocks in encoded.items()])
+    offset=-(-(len(DISTANCE_FILE_MAGIC)+8+header_length)//DISTANCE_FILE_ALIGNMENT)*DISTANCE_FILE_ALIGNMENT
+    for name, blocks in encoded.items():
+        header['sections'][name]={'dtype':sections[name].dtype.str, 'offset':offset, 'length':int(len(sections[name])), 'blocks':[]}
+        for block, length in blocks:
+            header['sections'][name]['blocks'].append([offset, len(block), length])
+            offset+=len(block)
+        offset=-(-offset//DISTANCE_FILE_ALIGNMENT)*DISTANCE_FILE_ALIGNMENT
+    header_bytes=json.dumps(header).encode('utf-8')
+    if len(header_bytes)>header_length:
+        raise Exception("Header of the distance file larger than expected")
+    
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    tmp_filename=f"{filename}.{os.getpid()}.tmp"
+    with open(tmp_filename, 'wb') as file:
+        file.write(DISTANCE_FILE_MAGIC)
+        file.write(np.array([len(header_bytes)], dtype='<u8').tobytes())
+        file.write(header_bytes)
+        for name, blocks in encoded.items():
+            for (block, length), (offset, size, _) in zip(blocks, header['sections'][name]['blocks']):
+                file.seek(offset)
+                file.write(block)
+        file.truncate(max([file.tell()]+[section['offset'] for section in header['sections'].values()]))
+    os.replace(tmp_filename, filename)
+
+
+def distance_file2dataframe(filename:str):
+    
+    """ 
+    Read all the pairs of a distance file as a table (ex: to load the distances on the database)
+    
+    -------------------------------------------------------  
+    Parameters:
+    
+    filename: name of the distance file (see write_distance_file)
+    
+    -------------------------------------------------------  
+
+    Return: 
+    pandas.DataFrame with columns x_source, y_source, x_dest, y_dest and the distance columns of the file (NaN for missing values)
+    """
+
+    header=read_distance_header(filename)
+    indptr=read_distance_section(filename, header, 'indptr')
+    source=np.repeat(np.arange(header['n_cells'], dtype=np.int64), np.diff(indptr))
+    df=pd.DataFrame()
+    df['x_source'], df['y_source']=cell_xy(source, header['n_rows'])
+    df['x_dest'], df['y_dest']=cell_xy(read_distance_section(filename, header, 'indices'), header['n_rows'])
+    for column, scale in header['columns'].items():
+        values=read_distance_section(filename, header, column)
+        df[column]=np.where(values==DISTANCE_FILE_MISSING, np.nan, values/scale)
+    return df
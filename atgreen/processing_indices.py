@@ -0,0 +1,115 @@
+#Import standard libraries needed for the Data Processing and Cleaning
+from .basic import *
+from .indices import *
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import datetime
+
+
+"""             Multi-city computation of the accessibility indices              """
+
+#Semaphore limiting the number of workers reading from the database at the same time (set in each worker by indices_runner_init)
+_db_semaphore=None
+
+def indices_runner_init(db_semaphore):
+
+    """ Initialize a worker of indices_runner """
+
+    global _db_semaphore
+    _db_semaphore=db_semaphore
+
+
+def indices_runner_one_city(city:str, index_params_list:list, db_params:dict, output_folder:str, output_name:str='{city}_indices.csv', cache_dir:str=None, cache_version:str=None, distances_dir:str=None):
+
+    """
+    Compute the indices for one city and save them to file.
+    The results are first written to a temporary file and then moved, so that only complete results are saved.
+    -------------------------------------------------------
+
+    Parameters:
+
+    see indices_runner()
+
+    -------------------------------------------------------
+
+    Return:
+    name of the city
+    """
+
+    #Only one worker at a time per semaphore slot accesses the database.
+    #The connections of the pool are closed once the data is loaded, so that idle workers do not keep connections open
+    if _db_semaphore is not None:
+        with _db_semaphore:
+            try:
+                sweep_inputs=load_sweep_inputs(city, index_params_list, db_params, cache_dir, cache_version, distances_dir)
+            finally:
+                if db_params is not None:
+                    get_engine(db_params).dispose()
+    else:
+        sweep_inputs=load_sweep_inputs(city, index_params_list, db_params, cache_dir, cache_version, distances_dir)
+    final=compute_sweep(sweep_inputs, index_params_list)
+
+    filename=f"{output_folder}/{output_name.format(city=city)}"
+    tmp_filename=f"{filename}.{os.getpid()}.tmp"
+    final.to_csv(tmp_filename, index=False)
+    os.replace(tmp_filename, filename)
+
+    return city
+
+
+def indices_runner(cities_list:list, index_params_list:list, db_params:dict, output_folder:str, n_workers:int=None, max_db_connections:int=4, output_name:str='{city}_indices.csv', cache_dir:str=None, cache_version:str=None, distances_dir:str=None):
+
+    """
+    Compute the accessibility indices for a list of cities over a pool of processes.
+    -------------------------------------------------------
+
+    Parameters:
+
+    cities_list: list of cities, named as in the database
+    index_params_list: list of dictionaries with the parameters of the indices (see accessibility_index_sweep)
+    db_params: dictionary with info to access db
+    output_folder: folder where the results are saved, one file for each city
+    n_workers: number of processes. Default to the number of CPUs
+    max_db_connections: maximum number of processes loading data from the database at the same time. Each process closes its connections after loading, hence this also bounds the number of open connections
+    output_name: name of the output file, formatted with the name of the city
+    cache_dir: if provided, directory of the local cache of the input data (see utils_cache)
+    cache_version: version of the source tables (ex: from table_version), used to invalidate the cache. If None, the cached data are used as they are, without accessing the database
+    distances_dir: if provided, directory of the binary distance files (see accessibility_index_sweep)
+
+    -------------------------------------------------------
+
+    Description:
+
+    Step 1: Identify the cities not yet computed (no output file in output_folder). This allows resuming a crashed run.
+    Step 2: Submit one task per city to a pool of processes. Each task loads the data for the city (with at most max_db_connections tasks loading at the same time),
+            computes all the indices at once with compute_sweep() and saves the results.
+    Step 3: Errors are recorded in output_folder/indices_runner_diagnostic.csv, so that the other cities are not affected.
+
+    -------------------------------------------------------
+
+    Return:
+    list of cities that could not be computed
+    """
+
+    #Step 1:
+    os.makedirs(output_folder, exist_ok=True)
+    to_compute=[city for city in cities_list if not os.path.exists(f"{output_folder}/{output_name.format(city=city)}")]
+    print(f"{len(cities_list)-len(to_compute)} cities already computed, {len(to_compute)} to compute.")
+
+    #Step 2:
+    failed=[]
+    db_semaphore=multiprocessing.Semaphore(max_db_connections)
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=indices_runner_init, initargs=(db_semaphore,)) as executor:
+        futures={executor.submit(indices_runner_one_city, city, index_params_list, db_params, output_folder, output_name, cache_dir, cache_version, distances_dir):city for city in to_compute}
+        for future in as_completed(futures):
+            city=futures[future]
+            try:
+                future.result()
+                print(f"{datetime.datetime.now()} {city}: done")
+            #Step 3:
+            except Exception as e:
+                failed.append(city)
+                with open(f"{output_folder}/indices_runner_diagnostic.csv", "a") as file:
+                    file.write(city+','+'error: '+str(e).replace('\n', ' ')+'\n')
+
+    return failed
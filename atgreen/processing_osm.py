@@ -3,6 +3,10 @@ from .basic import *
 from shapely.geometry import Polygon, Point, LineString, MultiPolygon, shape, mapping
 from shapely.ops import linemerge, polygonize
 import osmium
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from .utils_grid import *
+from .utils_cache import *
 
 
 """ Class to extract from the osm.pbf file """
@@ -66,13 +70,59 @@ class WayFindFeature(osmium.SimpleHandler):
                 else:
                     self.ways.append(LineString(nodes))
 
+""" Method to extract way based on key:value pairs, storing the coordinates in flat arrays """
+class WayFindFeatureArrays(osmium.SimpleHandler):
+    def __init__(self, features):
+        osmium.SimpleHandler.__init__(self)
+        self.coords = array('d')
+        self.n_nodes = array('q')
+        self.key = []
+        self.value = []
+        self.way_id = []
+        self.access = []
+        self.name = []
+        self.features = {key:set(values) for key, values in features.items()}
+
+    def way(self, w):
+        """ 
+        Same as WayFindFeature, but the coordinates of the nodes are appended to a flat array (long, lat, long, lat, ...) together with the number of nodes of each way, 
+        so that the geometries can be built at once at the end of the scan (see geometries_from_arrays).
+        Tag values are matched with a set lookup.
+        """
+        tags = w.tags
+        for key, values in self.features.items():
+            if (key in tags and tags[key] in values):
+                n_nodes = 0
+                for n in w.nodes:
+                    if n.location.valid():
+                        self.coords.append(n.lon)
+                        self.coords.append(n.lat)
+                        n_nodes += 1
+                if n_nodes==0:
+                    continue
+                self.n_nodes.append(n_nodes)
+                self.key.append(key)
+                self.value.append(tags[key])
+                self.way_id.append(w.id)
+                self.access.append(tags.get('access', ''))
+                self.name.append(tags.get('name', ''))
+
+    def geometries(self):
+        """ Build the geometries of all the extracted ways """
+        return geometries_from_arrays(np.frombuffer(self.coords, dtype=np.float64).reshape(-1, 2), np.frombuffer(self.n_nodes, dtype=np.int64))
+
+
 """ Extract way based on id  """                 
 class WayFind(osmium.SimpleHandler):
     def __init__(self, id_find):
         osmium.SimpleHandler.__init__(self)
-        self.ways = []
         self.ways_id = []
-        self.id_find=id_find
+        self.coords = array('d')
+        self.n_nodes = array('q')
+        #Number of times each id is requested (a way can be member of more than one relation)
+        self.id_find = {}
+        for i in id_find:
+            self.id_find[i] = self.id_find.get(i, 0) + 1
 
     def way(self, w):
         """ 
@@ -80,22 +130,91 @@ class WayFind(osmium.SimpleHandler):
           This is used to reconstruct the geometry of relations (by extracting all relation members)
           Ways are treated as Polygon - if first node is identical to the last node - 
           or LineString - if first node is different from last node.
+          The ids are matched with a hash lookup and the coordinates are stored in flat arrays (see WayFindFeatureArrays). 
+          A way is stored once for each time its id is requested.
           Stored attributes for each way are: 
           - osm id
           - geometry
         """
-        for i in self.id_find:
-            if w.id==i: 
+        repeat = self.id_find.get(w.id, 0)
+        if repeat>0:
+            coords = []
+            for n in w.nodes:
+                if n.location.valid():
+                    coords.append(n.lon)
+                    coords.append(n.lat)
+            if len(coords)==0:
+                return
+            for _ in range(repeat):
                 self.ways_id.append(w.id)
-                nodes = []
-                for n in w.nodes:  
-                    x = osmium.geom.Coordinates(n.location).x
-                    y = osmium.geom.Coordinates(n.location).y
-                    nodes.append(Point(x,y))
-                if nodes[0]==nodes[-1]:
-                    self.ways.append(Polygon(nodes))
-                else:
-                    self.ways.append(LineString(nodes))
+                self.coords.extend(coords)
+                self.n_nodes.append(len(coords)//2)
+
+    @property
+    def ways(self):
+        """ Geometries of the extracted ways """
+        return list(geometries_from_arrays(np.frombuffer(self.coords, dtype=np.float64).reshape(-1, 2), np.frombuffer(self.n_nodes, dtype=np.int64)))
+
+
+""" Extract ways with key:value pairs and members of relations in the same scan """
+class WayFindFeatureAndMembers(osmium.SimpleHandler):
+    def __init__(self, features, id_find):
+        osmium.SimpleHandler.__init__(self)
+        self.features_ways = WayFindFeatureArrays(features)
+        self.members_ways = WayFind(id_find)
+
+    def way(self, w):
+        """ 
+        Scan the osm-pbf file once, passing each way both to WayFindFeatureArrays (ways with key:value pairs) 
+        and to WayFind (members of the relations with key:value pairs).
+        """
+        self.features_ways.way(w)
+        self.members_ways.way(w)
+
+
+""" Mark the grid cells touched by ways with key:value pairs """
+class WayMarkCells(osmium.SimpleHandler):
+    def __init__(self, features, cells_tree, cells_id, n_cells, drop_private=True, batch_size=1000000):
+        osmium.SimpleHandler.__init__(self)
+        self.features = {key:set(values) for key, values in features.items()}
+        self.cells_tree = cells_tree
+        self.cells_id = cells_id
+        self.accessible = np.zeros(n_cells, dtype=bool)
+        self.drop_private = drop_private
+        self.batch_size = batch_size
+        self.coords = array('d')
+        self.n_nodes = array('q')
+
+    def way(self, w):
+        """ 
+        Scan the osm-pbf file and mark the cells intersecting ways with key:value pairs. 
+        Ways are not stored: their coordinates are buffered and, every batch_size nodes, the geometries of the buffered ways are built at once 
+        (see geometries_from_arrays) and matched with the cells through the STRtree of the grid.
+        """
+        for key, values in self.features.items():
+            if (key in w.tags and w.tags[key] in values):
+                if self.drop_private==True and w.tags.get('access') in ('no', 'private'):
+                    return
+                n_nodes = 0
+                for n in w.nodes:
+                    if n.location.valid():
+                        self.coords.append(n.lon)
+                        self.coords.append(n.lat)
+                        n_nodes += 1
+                if n_nodes>0:
+                    self.n_nodes.append(n_nodes)
+                if len(self.coords)>=2*self.batch_size:
+                    self.flush()
+                return
+
+    def flush(self):
+        """ Mark the cells intersecting the buffered ways and empty the buffer """
+        if len(self.n_nodes)>0:
+            geometries = geometries_from_arrays(np.frombuffer(self.coords, dtype=np.float64).reshape(-1, 2), np.frombuffer(self.n_nodes, dtype=np.int64))
+            _, cells = self.cells_tree.query(geometries, predicate='intersects')
+            self.accessible[self.cells_id[cells]] = True
+        self.coords = array('d')
+        self.n_nodes = array('q')
 
 
 """ Find relations based on [key:value] pairs """
@@ -143,6 +262,47 @@ class RelationFindFeature(osmium.SimpleHandler):
                         
 
                                                 
+""" Define function to build geometries of ways from their coordinates """
+
+def geometries_from_arrays(coords:np.ndarray, n_nodes:np.ndarray):
+    
+    """ 
+    Build the geometries of many ways at once from their coordinates, following the rules of WayFindFeature: 
+    Point if the way has one node, Polygon if first node is identical to the last node, LineString otherwise.
+    Closed ways with less than 4 nodes (not valid polygons) are built as LineString.
+    
+    -------------------------------------------------------  
+        
+    Parameters:
+    
+    coords: numpy.ndarray of shape (n, 2) with the (long, lat) of the nodes of all the ways, one way after the other
+    n_nodes: numpy.ndarray with the number of nodes of each way
+                   
+    -------------------------------------------------------  
+    
+    Return: 
+    numpy.ndarray of shapely.geometry, one for each way
+    """
+    
+    n_nodes=np.asarray(n_nodes, dtype=np.int64)
+    geometries=np.empty(len(n_nodes), dtype=object)
+    way=np.repeat(np.arange(len(n_nodes)), n_nodes)
+    first=np.concatenate([[0], np.cumsum(n_nodes)[:-1]]).astype(np.int64)
+    last=first+n_nodes-1
+    closed=(n_nodes>=4) & np.all(coords[first]==coords[last], axis=1)
+    points=(n_nodes==1)
+    lines=(points==False) & (closed==False)
+    
+    geometries[points]=shapely.points(coords[first[points]])
+    if closed.any():
+        nodes=closed[way]
+        geometries[closed]=shapely.polygons(shapely.linearrings(coords[nodes], indices=np.unique(way[nodes], return_inverse=True)[1]))
+    if lines.any():
+        nodes=lines[way]
+        geometries[lines]=shapely.linestrings(coords[nodes], indices=np.unique(way[nodes], return_inverse=True)[1])
+    return geometries
+
+
 """ Define function to associate a geometry to each relation, based on the geometry of its members """
 
 def get_geometry_one_rel(rel:str, relations_gdf:gpd.geodataframe):
@@ -167,9 +327,7 @@ def get_geometry_one_rel(rel:str, relations_gdf:gpd.geodataframe):
     Description:
     
     Step 1: Generate lists of members based on their role (inner/outer) and their topology (LineString/Polygon)
-    Step 2: Use shapely Linemerge on the list of LineStrings (from STEP 1), to identifying overlapping linestring and reconstruct unique geometries. If the merge LineString are not LineRings (first node!= last node), close them (important in case the initial osm-pbf extraction removed members). Finally polygonize the resulting geometries and add to the list of inner/outer polygons. 
-    Step 3: Loop through the outer polygons subtracting the inner polygons and appending to the list of final geometries.
-    Step 4: Define the final Polygon or MultiPolygon (based on the number of reconstructed geometries from Step 3)
+    Step 2: Assemble the members with get_geometry_members()
     
     -------------------------------------------------------  
     
@@ -184,6 +342,40 @@ def get_geometry_one_rel(rel:str, relations_gdf:gpd.geodataframe):
     inner_polygons=relations_gdf[(relations_gdf['rel_id']==rel) & (relations_gdf.geometry.type=='Polygon') & (relations_gdf.way_role=='inner')].geometry.to_list()
     
     #Step 2:
+    return get_geometry_members(outer_linestrings, inner_linestrings, outer_polygons, inner_polygons)
+
+
+def get_geometry_members(outer_linestrings:list, inner_linestrings:list, outer_polygons:list, inner_polygons:list):
+    
+    """ 
+    Reconstruct geometry of a relation from the geometries of its members, split by role (inner/outer) and topology (LineString/Polygon).
+    The information on how to assemble a MultiPolygon from its component LineStrings and Polygons, is available here: https://wiki.openstreetmap.org/wiki/Relation:multipolygon/Algorithm.
+    
+    -------------------------------------------------------  
+        
+    Parameters:
+    
+    outer_linestrings, inner_linestrings: lists of LineString members with role outer/inner
+    outer_polygons, inner_polygons: lists of Polygon members with role outer/inner
+                   
+    -------------------------------------------------------  
+                   
+    Description:
+    
+    Step 1: Use shapely Linemerge on the list of LineStrings, to identifying overlapping linestring and reconstruct unique geometries. If the merge LineString are not LineRings (first node!= last node), close them (important in case the initial osm-pbf extraction removed members). Finally polygonize the resulting geometries and add to the list of inner/outer polygons. 
+    Step 2: Loop through the outer polygons subtracting the inner polygons and appending to the list of final geometries.
+    Step 3: Define the final Polygon or MultiPolygon (based on the number of reconstructed geometries from Step 2)
+    
+    -------------------------------------------------------  
+    
+    Return: 
+    shapely.geometry
+    """
+    
+    outer_polygons=list(outer_polygons)
+    inner_polygons=list(inner_polygons)
+
+    #Step 1:
     merged_outer_linestrings = linemerge(outer_linestrings)
     merged_inner_linestrings = linemerge(inner_linestrings)
     
@@ -207,7 +399,7 @@ def get_geometry_one_rel(rel:str, relations_gdf:gpd.geodataframe):
                 merged_inner_linestring=linemerge([merged_inner_linestring, LineString([(merged_inner_linestring.coords.xy[0][0], merged_inner_linestring.coords.xy[1][0]), (merged_inner_linestring.coords.xy[0][-1], merged_inner_linestring.coords.xy[1][-1])])])
             inner_polygons+=list(polygonize(merged_inner_linestring))
     
-    #Step 3:
+    #Step 2:
     final_geom = []
 
     for outer_polygon in outer_polygons:
@@ -220,7 +412,7 @@ def get_geometry_one_rel(rel:str, relations_gdf:gpd.geodataframe):
         elif outer_polygon.geom_type == "MultiPolygon":
             final_geom.extend(list(outer_polygon.geoms))
     
-    # Step 4
+    #Step 3:
     if len(final_geom) == 1:
         geometry = final_geom[0]
     else:
@@ -229,7 +421,7 @@ def get_geometry_one_rel(rel:str, relations_gdf:gpd.geodataframe):
     return geometry
 
 
-def generate_relation_geom(relations_gdf:gpd.geodataframe, filename:str):
+def generate_relation_geom(relations_gdf:gpd.geodataframe, filename:str, n_jobs:int=None, relations_ways=None):
     
     """ 
     General function to be applied to the geopandas.GeoDataFrame with info on relation, to reconstruct the geometry of each relation.
@@ -247,12 +439,14 @@ def generate_relation_geom(relations_gdf:gpd.geodataframe, filename:str):
                    'way_id': id of the member. It can be either a linestring or a polygon
                    'way_role': role of the member in the relation
     filename: osm.pbf source file 
+    n_jobs: if larger than 1, the geometries of the relations are reconstructed over a pool of n_jobs processes
+    relations_ways: WayFind already applied to the osm.pbf file for the members of the relations (ex: by multiCityExtraction). If None, WayFind is applied to filename
     -------------------------------------------------------  
 
     Description:
     
     Step 1: Call WayFind to extract the geometry of all relations members in your GeoDataFrame from your osm.pbf extract. Store them in a geopandas.GeoDataFrame. Merge the geometry into the original geopandas.GeoDataFrame. Drop members with no geometry (if member is outside of extract for instance).
-    Step 2: For each relation, call get_geometry_one_rel to reconstruct the geometry. Store the other relation-level information. 
+    Step 2: Group the members by relation, split by role and topology, and call get_geometry_members to reconstruct the geometry of each relation. Store the other relation-level information (from the first member). 
     Step 3: Generate final geopandas.GeoDataFrame. Buffer the geometries to make them valid (with 0 buffer). Add column 'osm_element' specifying that the element is a relation.
     
     -------------------------------------------------------  
@@ -262,8 +456,9 @@ def generate_relation_geom(relations_gdf:gpd.geodataframe, filename:str):
     """
     
     #Step 1: 
-    relations_ways = WayFind(relations_gdf.way_id.to_list())
-    relations_ways.apply_file(filename, locations = True,idx='flex_mem' )
+    if relations_ways is None:
+        relations_ways = WayFind(relations_gdf.way_id.to_list())
+        relations_ways.apply_file(filename, locations = True,idx='flex_mem' )
     relations_ways_gdf = gpd.GeoDataFrame( {'way_id': relations_ways.ways_id, 'geometry': relations_ways.ways}, crs='EPSG:4326', geometry='geometry')
 
     #merge geometries
@@ -271,18 +466,25 @@ def generate_relation_geom(relations_gdf:gpd.geodataframe, filename:str):
     relations_gdf=relations_gdf[(relations_gdf.geometry.is_empty==False) & (relations_gdf.geometry!=None)]
     
     #Step 2: 
-    rel_id=[]
-    rel_value=[]
-    rel_key=[]
-    rel_name=[]
-    rel_geometry=[]
-    for rel in relations_gdf['rel_id'].unique():
-        rel_id.append(rel)
-        rel_value.append(relations_gdf[relations_gdf['rel_id']==rel]['osm_value'].values[0])
-        rel_key.append(relations_gdf[relations_gdf['rel_id']==rel]['osm_key'].values[0])
-        rel_name.append(relations_gdf[relations_gdf['rel_id']==rel]['osm_name'].values[0])
-        # Call get_geometry_one_rel to reconstruct the geometry
-        rel_geometry.append(get_geometry_one_rel(rel, relations_gdf))
+    #Split the members once by topology and role, then group them by relation (groups keep the order of the relations and of their members)
+    geom_type=relations_gdf.geometry.geom_type.values
+    way_role=relations_gdf['way_role'].values
+    geometries=relations_gdf.geometry.values
+    splits=[(geom_type=='LineString') & (way_role=='outer'), (geom_type=='LineString') & (way_role=='inner'),
+            (geom_type=='Polygon') & (way_role=='outer'), (geom_type=='Polygon') & (way_role=='inner')]
+    groups=relations_gdf.groupby('rel_id', sort=False).indices
+    rel_id=list(groups.keys())
+    first=np.array([positions[0] for positions in groups.values()], dtype=np.int64)
+    rel_value=relations_gdf['osm_value'].values[first]
+    rel_key=relations_gdf['osm_key'].values[first]
+    rel_name=relations_gdf['osm_name'].values[first]
+    members=[[list(geometries[positions[split[positions]]]) for split in splits] for positions in groups.values()]
+    # Call get_geometry_members to reconstruct the geometry
+    if n_jobs is not None and n_jobs>1 and len(members)>1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            rel_geometry=list(executor.map(get_geometry_members, *zip(*members), chunksize=max(1, len(members)//(4*n_jobs))))
+    else:
+        rel_geometry=[get_geometry_members(*member) for member in members]
     
     #Step 3: 
     final=gpd.GeoDataFrame({'osm_id':rel_id,'osm_value':rel_value, 'osm_key':rel_key, 'osm_name':rel_name, 'geometry':rel_geometry }, geometry='geometry', crs='EPSG:4326')
@@ -292,7 +494,7 @@ def generate_relation_geom(relations_gdf:gpd.geodataframe, filename:str):
     
     return final
 
-def waysExtraction(filename:str, features:dict, drop_private:bool=True, drop_linestring:bool=True): 
+def waysExtraction(filename:str, features:dict, drop_private:bool=True, drop_linestring:bool=True, fast:bool=True): 
     
     """ 
     Pipeline to extract ways with specific key:value pairs
@@ -305,6 +507,8 @@ def waysExtraction(filename:str, features:dict, drop_private:bool=True, drop_lin
     features: dictionary of key-value pairs
     drop_private: if we want to drop elements with tags 'access' in ['no', 'private']
     drop_linestring: if we want to drop linestring element (open ways)
+    fast: if True, the coordinates are collected in flat arrays and the geometries are built at once with shapely (WayFindFeatureArrays), 
+          otherwise one geometry is built for each way while scanning the file (WayFindFeature). The two modes return the same ways
     
     -------------------------------------------------------  
                   
@@ -312,10 +516,38 @@ def waysExtraction(filename:str, features:dict, drop_private:bool=True, drop_lin
     """
 
 
-    ways = WayFindFeature(features)
-    ways.apply_file(filename,locations = True,idx='flex_mem' )
+    if fast==True:
+        ways = WayFindFeatureArrays(features)
+        ways.apply_file(filename,locations = True,idx='flex_mem' )
+        geometries = ways.geometries()
+    else:
+        ways = WayFindFeature(features)
+        ways.apply_file(filename,locations = True,idx='flex_mem' )
+        geometries = ways.ways
+    
+    return ways2gdf(ways, geometries, drop_private, drop_linestring)
+
+def ways2gdf(ways, geometries, drop_private:bool=True, drop_linestring:bool=True):
+    
+    """ 
+    Create the geopandas.GeoDataFrame of the ways extracted with WayFindFeature or WayFindFeatureArrays
+    
+    -------------------------------------------------------  
+        
+    Parameters:
+    
+    ways: handler applied to the osm.pbf file
+    geometries: geometries of the ways
+    drop_private: if we want to drop elements with tags 'access' in ['no', 'private']
+    drop_linestring: if we want to drop linestring element (open ways)
+    
+    -------------------------------------------------------  
+                  
+    Return: geopandas.GeoDataFrame
+    """
+    
     #create gdf with the geometry of the selected ways
-    ways_osm = gpd.GeoDataFrame( {'geometry': ways.ways,'osm_key': ways.key ,'osm_value': ways.value, 'access':ways.access, 'osm_name':ways.name, 'osm_id':ways.way_id}, crs='EPSG:4326')
+    ways_osm = gpd.GeoDataFrame( {'geometry': geometries,'osm_key': ways.key ,'osm_value': ways.value, 'access':ways.access, 'osm_name':ways.name, 'osm_id':ways.way_id}, crs='EPSG:4326')
     ways_osm=ways_osm[ways_osm.geometry.type!=Point]
     #Drop if access is forbidden
     if drop_private==True:
@@ -327,7 +559,7 @@ def waysExtraction(filename:str, features:dict, drop_private:bool=True, drop_lin
     
     return gdf
 
-def relationsExtraction(filename:str,  features:dict, drop_private:bool=True, drop_linestring:bool=True):
+def relationsExtraction(filename:str,  features:dict, drop_private:bool=True, drop_linestring:bool=True, n_jobs:int=None):
     
     """
     Pipeline to extract ways with specific key:value pairs
@@ -338,6 +570,7 @@ def relationsExtraction(filename:str,  features:dict, drop_private:bool=True, dr
     features: dictionary of key-value pairs
     drop_private: if we want to drop elements with tags 'access' in ['no', 'private']
     drop_linestring: if we want to drop linestring element (open ways)
+    n_jobs: number of processes used to reconstruct the geometries of the relations (see generate_relation_geom)
     
     -------------------------------------------------------  
     
@@ -345,15 +578,15 @@ def relationsExtraction(filename:str,  features:dict, drop_private:bool=True, dr
     geopandas.GeoDataFrame
     """
     
-    #Extract relations with relevant tags:
+    #Extract relations with relevant tags (only relations are read, no need for node locations):
     relations = RelationFindFeature(features)
-    relations.apply_file(filename,locations = True,idx='flex_mem' )
+    relations.apply_file(filename)
 
     #create gdf with the geometry of the selected ways
     relations_gdf = gpd.GeoDataFrame( {'rel_id': relations.relation_id, 'osm_key': relations.key, 'osm_value': relations.value, 'way_id': relations.way_ref,'way_role': relations.way_role,'way_type': relations.way_type ,'osm_name': relations.name})
 
     if len(relations_gdf)>0:
-        gdf=generate_relation_geom(relations_gdf, filename)
+        gdf=generate_relation_geom(relations_gdf, filename, n_jobs)
         return gdf
     else:
         print('No relations for selected features')
@@ -361,3 +594,104 @@ def relationsExtraction(filename:str,  features:dict, drop_private:bool=True, dr
         return gdf
 
 
+def streetsAccessibility(filename:str, features:dict, grid:gpd.geodataframe, n_rows:int, drop_private:bool=True):
+    
+    """ 
+    Identify the cells of the grid touched by the ways with specific key:value pairs (ex: the streets walkable with the foot profile of OSRM).
+    Equivalent to a spatial join between the grid and the output of waysExtraction(filename, features, drop_private, False), 
+    without storing the geometries of the ways.
+    
+    -------------------------------------------------------  
+        
+    Parameters:
+    
+    filename: osm.pbf source file 
+    features: dictionary of key-value pairs
+    grid: geopandas.GeoDataFrame with the cells of the grid (columns x, y and geometry, in EPSG:4326)
+    n_rows: number of rows of the grid
+    drop_private: if we want to ignore elements with tags 'access' in ['no', 'private']
+    
+    -------------------------------------------------------  
+    
+    Description:
+    
+    Step 1: Build the STRtree of the cells of the grid.
+    Step 2: Stream the ways of the osm.pbf file with WayMarkCells, marking the cells they intersect.
+    
+    -------------------------------------------------------  
+                  
+    Return: numpy.ndarray of bool indexed by cell id (id = y + n_rows*(x-1)), True for the cells touched by at least one way
+    """
+
+    #Step 1:
+    cells_id=cell_id(grid['x'], grid['y'], n_rows)
+    cells_tree=shapely.STRtree(grid.geometry.values)
+
+    #Step 2:
+    cells=WayMarkCells(features, cells_tree, cells_id, int(cells_id.max())+1, drop_private)
+    cells.apply_file(filename, locations=True, idx='flex_mem')
+    cells.flush()
+    
+    return cells.accessible
+
+
+def multiCityExtraction(filename:str, features:dict, boundaries:gpd.geodataframe, drop_private:bool=True, drop_linestring:bool=True, n_jobs:int=None, output_folder:str=None):
+    
+    """ 
+    Extract ways and relations with specific key:value pairs for many cities at once, reading a single large osm.pbf file (ex: continent extract) 
+    instead of one pre-cut file per city.
+    
+    -------------------------------------------------------  
+        
+    Parameters:
+    
+    filename: osm.pbf source file, covering all the cities
+    features: dictionary of key-value pairs
+    boundaries: geopandas.GeoDataFrame with columns 'city' and geometry (EPSG:4326), for instance from query4citiesboundary (with a buffer)
+    drop_private: if we want to drop elements with tags 'access' in ['no', 'private']
+    drop_linestring: if we want to drop linestring element (open ways)
+    n_jobs: number of processes used to reconstruct the geometries of the relations (see generate_relation_geom)
+    output_folder: if provided, the elements of each city are also saved to output_folder/{city}.arrow (see utils_cache, read with read_cache)
+    
+    -------------------------------------------------------  
+    
+    Description:
+    
+    Step 1: Scan the relations of the file (no node locations needed) with RelationFindFeature.
+    Step 2: Scan the ways of the file once with WayFindFeatureAndMembers, extracting both the ways with key:value pairs and the members of the relations.
+    Step 3: Build the ways (as in waysExtraction) and the relations (as in relationsExtraction).
+    Step 4: Route each element to every city whose boundary it intersects, with the STRtree of the boundaries.
+    
+    -------------------------------------------------------  
+                  
+    Return: dictionary {city: geopandas.GeoDataFrame}, with the same columns as waysExtraction and relationsExtraction concatenated
+    """
+
+    #Step 1:
+    relations = RelationFindFeature(features)
+    relations.apply_file(filename)
+    relations_gdf = gpd.GeoDataFrame( {'rel_id': relations.relation_id, 'osm_key': relations.key, 'osm_value': relations.value, 'way_id': relations.way_ref,'way_role': relations.way_role,'way_type': relations.way_type ,'osm_name': relations.name})
+
+    #Step 2:
+    ways = WayFindFeatureAndMembers(features, relations.way_ref)
+    ways.apply_file(filename, locations=True, idx='flex_mem')
+
+    #Step 3:
+    gdfs_list=[ways2gdf(ways.features_ways, ways.features_ways.geometries(), drop_private, drop_linestring)]
+    if len(relations_gdf)>0:
+        gdfs_list.append(generate_relation_geom(relations_gdf, filename, n_jobs, ways.members_ways))
+    gdf=pd.concat(gdfs_list).reset_index(drop=True)
+
+    #Step 4:
+    tree=shapely.STRtree(boundaries.geometry.values)
+    elements, cities=tree.query(gdf.geometry.values, predicate='intersects')
+    routed=pd.DataFrame({'element':elements, 'city':boundaries['city'].values[cities]}).drop_duplicates()
+    groups=routed.groupby('city').indices
+    extracted={}
+    for city in pd.unique(boundaries['city']):
+        positions=np.sort(routed['element'].values[groups[city]]) if city in groups else np.zeros(0, dtype=np.int64)
+        extracted[city]=gdf.iloc[positions].reset_index(drop=True)
+        if output_folder is not None:
+            write_cache(extracted[city], f"{output_folder}/{city}.arrow")
+    
+    return extracted
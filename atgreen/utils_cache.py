@@ -0,0 +1,100 @@
+#Import standard libraries needed for the Data Processing and Cleaning
+from .basic import *
+import hashlib
+import pyarrow as pa
+import pyarrow.feather as feather
+
+
+#########################################################################################
+###                                   Cache utils                                     ###
+###    Optional on-disk cache of the per-city inputs read from the database.          ###
+###    Tables are stored as uncompressed Arrow IPC (feather) files, so that they can  ###
+###    be memory-mapped on reuse. Geometries are stored as WKB.                       ###
+###    Cached files are never checked against the database: a run with a filled      ###
+###    cache does not access it. To invalidate the cache when the source tables       ###
+###    change, pass as cache_version an explicit version or the content hash of the   ###
+###    tables from table_version (ex: cache_version=table_version(['osm.osm2grid'],   ###
+###    db_params)): a new version leads to new cache files.                           ###
+#########################################################################################
+
+def cache_filename(cache_dir:str, name:str, params:list, version:str=None):
+
+    """
+    Define the name of the cache file for a query
+    -------------------------------------------------------
+
+    Parameters:
+
+    cache_dir: directory of the cache
+    name: name of the query (ex: name of the function)
+    params: list of parameters identifying the query (ex: city name)
+    version: version of the source tables (see table_version). A different version leads to a different file, hence invalidating the cache. None for no version
+
+    -------------------------------------------------------
+
+    Return:
+    str
+    """
+
+    key=hashlib.md5(repr([name, [str(p) for p in params], str(version) if version is not None else '']).encode('utf-8')).hexdigest()[:16]
+    return f"{cache_dir}/{name}_{key}.arrow"
+
+
+def write_cache(df:pd.DataFrame, filename:str):
+
+    """
+    Save a table to the cache. The file is first written to a temporary file and then moved, so that readers never see partial files.
+    -------------------------------------------------------
+
+    Parameters:
+
+    df: pandas.DataFrame or geopandas.GeoDataFrame
+    filename: name of the cache file (from cache_filename)
+
+    -------------------------------------------------------
+
+    Return:
+    empty
+    """
+
+    metadata={}
+    if isinstance(df, gpd.GeoDataFrame):
+        geometry=df.geometry.name
+        metadata={b'geometry':geometry.encode('utf-8'), b'crs':(df.crs.to_string() if df.crs is not None else '').encode('utf-8')}
+        df=pd.DataFrame(df)
+        df[geometry]=shapely.to_wkb(df[geometry].values)
+    table=pa.Table.from_pandas(df, preserve_index=False)
+    table=table.replace_schema_metadata({**(table.schema.metadata or {}), **metadata})
+
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    tmp_filename=f"{filename}.{os.getpid()}.tmp"
+    feather.write_feather(table, tmp_filename, compression='uncompressed')
+    os.replace(tmp_filename, filename)
+
+
+def read_cache(filename:str):
+
+    """
+    Read a table from the cache, memory-mapping the file
+    -------------------------------------------------------
+
+    Parameters:
+
+    filename: name of the cache file (from cache_filename)
+
+    -------------------------------------------------------
+
+    Return:
+    pandas.DataFrame or geopandas.GeoDataFrame (if the cached table had a geometry)
+    """
+
+    table=feather.read_table(filename, memory_map=True)
+    metadata=table.schema.metadata or {}
+    df=table.to_pandas()
+    if b'geometry' in metadata:
+        geometry=metadata[b'geometry'].decode('utf-8')
+        crs=metadata[b'crs'].decode('utf-8')
+        df[geometry]=shapely.from_wkb(df[geometry].values)
+        df=gpd.GeoDataFrame(df, geometry=geometry, crs=crs if crs!='' else None)
+    return df
+
@@ -0,0 +1,367 @@
+#Import standard libraries needed for the Data Processing and Cleaning
+from .basic import *
+from scipy import sparse
+import pyarrow as pa
+import json
+
+
+""" Compressed representation of the distances between the cells of one city """
+
+class DistanceMatrix:
+
+    """
+    Sparse origin-destination matrix stored in compressed sparse row (CSR) format.
+    Rows are source cell ids and columns are destination cell ids (id = y + n_rows*(x-1)).
+    Only reachable pairs are stored: pairs with missing distance are dropped when the matrix is built.
+    The pairs of each source are sorted by increasing distance (see sort_rows), so that the pairs within a time threshold 
+    are a prefix of each row, found by a binary search (see row_cutoff).
+
+    Attributes:
+    indptr: int64 array of length n_cells+1. The destinations of source i are stored in indices[indptr[i]:indptr[i+1]]
+    indices: int32 array with the destination cell ids
+    data: float array with the distances (in minutes). float32 by default, float64 when the exact values are needed (see row_min)
+    sorted_rows: True if the pairs of each source are sorted by increasing distance
+    """
+
+    def __init__(self, indptr, indices, data, sorted_rows:bool=False):
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        data = np.asarray(data)
+        self.data = data if data.dtype in (np.float32, np.float64) else data.astype(np.float32)
+        self.n_cells = len(self.indptr)-1
+        self.sorted_rows = sorted_rows
+        self._row_ids = None
+
+    @classmethod
+    def from_dataframe(cls, distances:pd.DataFrame, n_cells:int=None, dtype=np.float32):
+
+        """
+        Build the matrix from a long table of distances.
+
+        -------------------------------------------------------
+
+        Parameters:
+
+        distances: pandas.DataFrame with columns ['source', 'dest', 'dist'] (as from queryDistances)
+        n_cells: number of rows and columns of the matrix, it must be larger than any cell id. Default to the maximum cell id + 1
+        dtype: type of the stored distances. np.float32 halves the memory, np.float64 keeps the exact values of the table
+
+        -------------------------------------------------------
+
+        Return:
+        DistanceMatrix
+        """
+
+        #Drop unreachable pairs
+        distances=distances[distances['dist'].isnull()==False]
+        source=distances['source'].to_numpy(dtype=np.int64)
+        dest=distances['dest'].to_numpy(dtype=np.int32)
+        dist=distances['dist'].to_numpy(dtype=dtype)
+        if n_cells is None:
+            n_cells=int(max(source.max(initial=-1), dest.max(initial=-1)))+1
+
+        #Sort by source and, within each source, by distance
+        order=np.lexsort((dist, source))
+        indptr=np.zeros(n_cells+1, dtype=np.int64)
+        indptr[1:]=np.cumsum(np.bincount(source, minlength=n_cells))
+
+        return cls(indptr, dest[order], dist[order], sorted_rows=True)
+
+    def sort_rows(self):
+
+        """ Sort the pairs of each source by increasing distance (in place, only if not already sorted) """
+
+        if not self.sorted_rows:
+            order=np.lexsort((self.data, self.row_ids()))
+            self.indices=self.indices[order]
+            self.data=self.data[order]
+            self.sorted_rows=True
+        return self
+
+    def row_cutoff(self, threshold):
+
+        """
+        End of the pairs within the threshold for each source, found by a binary search within each row (all the rows are searched at once).
+        The pairs of source i with distance lower or equal than threshold are stored in indices[indptr[i]:row_cutoff(threshold)[i]]
+
+        Return:
+        numpy.ndarray of int64 of length n_cells
+        """
+
+        self.sort_rows()
+        lo=self.indptr[:-1].copy()
+        hi=self.indptr[1:].copy()
+        rows=np.flatnonzero(lo<hi)
+        while len(rows)>0:
+            mid=(lo[rows]+hi[rows])//2
+            within=self.data[mid]<=threshold
+            lo[rows[within]]=mid[within]+1
+            hi[rows[~within]]=mid[~within]
+            rows=rows[lo[rows]<hi[rows]]
+        return lo
+
+    def pairs_within(self, threshold):
+
+        """ Positions of the stored pairs with distance lower or equal than threshold, without scanning the pairs beyond the threshold """
+
+        start=self.indptr[:-1]
+        lengths=self.row_cutoff(threshold)-start
+        return np.repeat(start-np.cumsum(lengths)+lengths, lengths)+np.arange(lengths.sum(), dtype=np.int64)
+
+    def row_ids(self):
+
+        """ Source cell id of each stored pair """
+
+        if self._row_ids is None:
+            self._row_ids = np.repeat(np.arange(self.n_cells, dtype=np.int32), np.diff(self.indptr))
+        return self._row_ids
+
+    def cell_mask(self, ids):
+
+        """ Boolean vector over the cell ids, True for the cells in ids """
+
+        ids=np.asarray(ids, dtype=np.int64)
+        mask=np.zeros(self.n_cells, dtype=bool)
+        mask[ids[(ids>=0) & (ids<self.n_cells)]]=True
+        return mask
+
+    def cell_vector(self, ids, values):
+
+        """ Vector over the cell ids, summing the values reported for the same cell """
+
+        ids=np.asarray(ids, dtype=np.int64)
+        values=np.asarray(values, dtype=np.float64)
+        keep=(ids>=0) & (ids<self.n_cells)
+        return np.bincount(ids[keep], weights=values[keep], minlength=self.n_cells)
+
+    def pair_mask(self, sources=None, dests=None, threshold=None):
+
+        """
+        Boolean mask over the stored pairs (rows are sorted first if needed, so that the mask stays valid for row_cutoff).
+
+        -------------------------------------------------------
+
+        Parameters:
+
+        sources: cell ids to keep as sources. If None, all sources are kept
+        dests: cell ids to keep as destinations. If None, all destinations are kept
+        threshold: if provided, only keep pairs with distance lower or equal than threshold
+
+        -------------------------------------------------------
+
+        Return:
+        numpy.ndarray of bool with one element for each stored pair
+        """
+
+        self.sort_rows()
+        mask=np.ones(len(self.data), dtype=bool)
+        if sources is not None:
+            mask&=self.cell_mask(sources)[self.row_ids()]
+        if dests is not None:
+            mask&=self.cell_mask(dests)[self.indices]
+        if threshold is not None:
+            mask&=self.data<=threshold
+        return mask
+
+    def row_min(self, pair_mask):
+
+        """
+        Minimum distance of each source over the pairs in pair_mask.
+
+        The minimum is one of the stored distances, returned as float64 with no rounding: 
+        it is exactly the minimum of the original distances if the matrix stores float64 data, the float32 approximation of it otherwise.
+
+        Return:
+        numpy.ndarray (float64) of length n_cells, with np.inf for sources with no pair in the mask
+        """
+
+        values=np.where(pair_mask, self.data, self.data.dtype.type(np.inf))
+        result=np.full(self.n_cells, np.inf, dtype=self.data.dtype)
+        nonempty=np.diff(self.indptr)>0
+        if nonempty.any():
+            result[nonempty]=np.minimum.reduceat(values, self.indptr[:-1][nonempty])
+        return result.astype(np.float64)
+
+    def row_sum(self, pair_mask, weights):
+
+        """
+        Sparse matrix-vector product between the pairs in pair_mask and a vector of weights over the destination cells.
+        weights must have length n_cells (see cell_vector).
+
+        Return:
+        numpy.ndarray of length n_cells with the sum of the weights of the destinations of each source
+        numpy.ndarray of length n_cells with the number of destinations of each source
+        """
+
+        matrix=sparse.csr_matrix((pair_mask.astype(np.float32), self.indices, self.indptr), shape=(self.n_cells, self.n_cells))
+        result=matrix@np.column_stack([weights, np.ones(self.n_cells)])
+        return result[:,0], result[:,1]
+
+    def row_sum_thresholds(self, pair_mask, weights, thresholds:list):
+
+        """
+        Same as row_sum, restricted to the pairs within each of the thresholds, for several thresholds at once.
+        pair_mask should not include a threshold. Each pair is summed only once over all the thresholds: 
+        thresholds are processed in increasing order and the sums of each threshold are accumulated on the sums of the previous one, 
+        adding only the pairs between the two cutoffs (see row_cutoff). 
+        The sums are not computed as differences of a global cumulative sum, which would lose precision and break ties between cells.
+
+        Return:
+        dictionary {threshold: (sum of the weights of the destinations of each source, number of destinations of each source)}, 
+        with numpy.ndarray of length n_cells as in row_sum
+        """
+
+        self.sort_rows()
+        values=np.where(pair_mask, weights[self.indices], 0)
+        sums=np.zeros(self.n_cells, dtype=np.float64)
+        counts=np.zeros(self.n_cells, dtype=np.int64)
+        previous=self.indptr[:-1]
+        result={}
+        for threshold in sorted(set(thresholds)):
+            cut=self.row_cutoff(threshold)
+            sums=sums+segment_sum(values, previous, cut)
+            counts=counts+segment_sum(pair_mask, previous, cut).astype(np.int64)
+            result[threshold]=(sums, counts)
+            previous=cut
+        return {threshold:result[threshold] for threshold in thresholds}
+
+    def to_dataframe(self, pair_mask=None):
+
+        """ Long table of distances with columns ['source', 'dest', 'dist'], optionally restricted to the pairs in pair_mask """
+
+        if pair_mask is None:
+            pair_mask=np.ones(len(self.data), dtype=bool)
+        return pd.DataFrame({'source':self.row_ids()[pair_mask], 'dest':self.indices[pair_mask], 'dist':self.data[pair_mask].astype(np.float64)})
+
+
+
+def segment_sum(values, start, end):
+
+    """ Sum of values[start[i]:end[i]] for each i (0 for empty segments) """
+
+    values=np.asarray(values, dtype=np.float64)
+    start=np.asarray(start, dtype=np.int64)
+    end=np.asarray(end, dtype=np.int64)
+    result=np.zeros(len(start), dtype=np.float64)
+    nonempty=end>start
+    if nonempty.any():
+        bounds=np.column_stack([start[nonempty], end[nonempty]]).ravel()
+        result[nonempty]=np.add.reduceat(np.append(values, 0), bounds)[::2]
+    return result
+
+
+
+""" Binary per-city distance files """
+
+#Layout of the file: DISTANCE_FILE_MAGIC, length of the header (uint64), header (JSON), sections.
+#The sections are the CSR structure of the distances: 'indptr' (int64, one element per cell id + 1), 'indices' (int32, destination cell ids)
+#and one uint16 section per distance column, storing round(value*scale). Missing values (pair not routable) are stored as DISTANCE_FILE_MISSING.
+#Each section starts at a multiple of DISTANCE_FILE_ALIGNMENT: uncompressed sections are memory-mapped, compressed sections ('zstd' or 'lz4') 
+#are stored as independent blocks listed in the header.
+DISTANCE_FILE_MAGIC=b'ATGDIST1'
+DISTANCE_FILE_MISSING=np.iinfo(np.uint16).max
+DISTANCE_FILE_ALIGNMENT=64
+
+def read_distance_header(filename:str):
+
+    """
+    Read the header of a distance file (see write_distance_file)
+    -------------------------------------------------------
+
+    Parameters:
+
+    filename: name of the distance file
+
+    -------------------------------------------------------
+
+    Return:
+    dictionary with keys 'n_rows', 'n_cols', 'n_cells', 'n_pairs', 'codec', 'sorted_by', 'columns' (column:scale) and 'sections' (name:{'dtype', 'offset', 'length', 'blocks'})
+    """
+
+    with open(filename, 'rb') as file:
+        if file.read(len(DISTANCE_FILE_MAGIC))!=DISTANCE_FILE_MAGIC:
+            raise Exception(f"{filename} is not a distance file")
+        length=int(np.frombuffer(file.read(8), dtype='<u8')[0])
+        return json.loads(file.read(length).decode('utf-8'))
+
+
+def read_distance_section(filename:str, header:dict, name:str):
+
+    """
+    Read one section of a distance file. Uncompressed sections are memory-mapped (read-only), compressed sections are decompressed block by block
+    -------------------------------------------------------
+
+    Parameters:
+
+    filename: name of the distance file
+    header: header of the file (from read_distance_header)
+    name: name of the section ('indptr', 'indices' or the name of a distance column)
+
+    -------------------------------------------------------
+
+    Return:
+    numpy.ndarray
+    """
+
+    section=header['sections'][name]
+    dtype=np.dtype(section['dtype'])
+    if header['codec']=='none':
+        if section['length']==0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(filename, dtype=dtype, mode='r', offset=section['offset'], shape=(section['length'],))
+
+    values=np.empty(section['length'], dtype=dtype)
+    position=0
+    with open(filename, 'rb') as file:
+        for offset, size, length in section['blocks']:
+            file.seek(offset)
+            block=pa.decompress(file.read(size), decompressed_size=length*dtype.itemsize, codec=header['codec'], asbytes=True)
+            values[position:position+length]=np.frombuffer(block, dtype=dtype)
+            position+=length
+    return values
+
+
+def read_distance_file(filename:str, column:str='walk_minutes', dtype=np.float32):
+
+    """
+    Read one distance column of a distance file as a DistanceMatrix, without building any pandas object
+    -------------------------------------------------------
+
+    Parameters:
+
+    filename: name of the distance file (see write_distance_file)
+    column: distance column to read (ex: 'walk_minutes', 'geodesic_minutes')
+    dtype: type of the distances of the DistanceMatrix (see DistanceMatrix.from_dataframe)
+
+    -------------------------------------------------------
+
+    Description:
+
+    Step 1: Read the header and the CSR structure (memory-mapped if the file is not compressed). Row ids are the cell ids of the grid of the header.
+    Step 2: Read the distance column and convert it back from its integer representation (value/scale). 
+            Missing pairs are dropped, as in DistanceMatrix.from_dataframe. If no pair is missing, indices are not copied.
+
+    -------------------------------------------------------
+
+    Return:
+    DistanceMatrix (rows sorted by distance if the file is sorted on column)
+    """
+
+    #Step 1:
+    header=read_distance_header(filename)
+    if column not in header['columns']:
+        raise Exception(f"Column {column} not in {filename}. Available columns: {list(header['columns'])}")
+    indptr=read_distance_section(filename, header, 'indptr')
+    indices=read_distance_section(filename, header, 'indices')
+
+    #Step 2:
+    values=read_distance_section(filename, header, column)
+    missing=(values==DISTANCE_FILE_MISSING)
+    if missing.any():
+        kept=np.concatenate([[0], np.cumsum(missing==False, dtype=np.int64)])
+        indptr=kept[indptr]
+        indices=indices[missing==False]
+        values=values[missing==False]
+    data=(values/header['columns'][column]).astype(dtype)
+
+    return DistanceMatrix(indptr, indices, data, sorted_rows=(header['sorted_by']==column))
@@ -0,0 +1,113 @@
+#Import standard libraries needed for the Data Processing and Cleaning
+from .basic import *
+
+
+#########################################################################################
+###                                   Grid utils                                      ###
+###    Cells of the population grid are identified by their (x,y) position in the     ###
+###    raster (both starting from 1) or by the id: id = y + n_rows*(x-1)              ###
+#########################################################################################
+
+def cell_id(x, y, n_rows:int):
+
+    """
+    Compute the cell id from the position of the cell in the grid
+    -------------------------------------------------------
+
+    Parameters:
+
+    x: column of the cell in the grid (starting from 1). Scalar, list, numpy.ndarray or pandas.Series
+    y: row of the cell in the grid (starting from 1). Scalar, list, numpy.ndarray or pandas.Series
+    n_rows: number of rows of the grid
+
+    -------------------------------------------------------
+
+    Return:
+    numpy.ndarray of int64
+    """
+
+    x=np.asarray(x, dtype=np.int64)
+    y=np.asarray(y, dtype=np.int64)
+    return y+n_rows*(x-1)
+
+
+def cell_xy(ids, n_rows:int):
+
+    """
+    Compute the position of the cell in the grid from the cell id (inverse of cell_id)
+    -------------------------------------------------------
+
+    Parameters:
+
+    ids: cell ids. Scalar, list, numpy.ndarray or pandas.Series
+    n_rows: number of rows of the grid
+
+    -------------------------------------------------------
+
+    Return:
+    tuple of numpy.ndarray of int64 (x, y)
+    """
+
+    ids=np.asarray(ids, dtype=np.int64)
+    x=(ids-1)//n_rows+1
+    y=ids-n_rows*(x-1)
+    return x, y
+
+
+def cell_in_grid(x, y, n_rows:int, n_cols:int=None):
+
+    """
+    Check whether the positions fall within the grid
+    -------------------------------------------------------
+
+    Parameters:
+
+    x: column of the cell in the grid (starting from 1)
+    y: row of the cell in the grid (starting from 1)
+    n_rows: number of rows of the grid
+    n_cols: number of columns of the grid. If None, the columns are not bounded from above
+
+    -------------------------------------------------------
+
+    Return:
+    numpy.ndarray of bool
+    """
+
+    x=np.asarray(x, dtype=np.int64)
+    y=np.asarray(y, dtype=np.int64)
+    inside=(x>=1) & (y>=1) & (y<=n_rows)
+    if n_cols is not None:
+        inside&=(x<=n_cols)
+    return inside
+
+
+def cell_neighbours(ids, n_rows:int, n_cols:int=None, diagonal:bool=True):
+
+    """
+    Identify the neighbours of each cell
+    -------------------------------------------------------
+
+    Parameters:
+
+    ids: cell ids
+    n_rows: number of rows of the grid
+    n_cols: number of columns of the grid. If None, the columns are not bounded from above
+    diagonal: if True, return the 8 neighbours of each cell (Moore neighbourhood), otherwise the 4 neighbours sharing an edge (von Neumann neighbourhood)
+
+    -------------------------------------------------------
+
+    Return:
+    numpy.ndarray of int64 with one row per cell and one column per neighbour. Neighbours falling outside the grid are set to -1
+    """
+
+    if diagonal==True:
+        shifts=np.array([(-1,-1), (-1,0), (-1,1), (0,-1), (0,1), (1,-1), (1,0), (1,1)])
+    else:
+        shifts=np.array([(-1,0), (0,-1), (0,1), (1,0)])
+
+    x, y=cell_xy(ids, n_rows)
+    x_neighbours=x.reshape(-1,1)+shifts[:,0]
+    y_neighbours=y.reshape(-1,1)+shifts[:,1]
+    neighbours=cell_id(x_neighbours, y_neighbours, n_rows)
+    neighbours[~cell_in_grid(x_neighbours, y_neighbours, n_rows, n_cols)]=-1
+    return neighbours
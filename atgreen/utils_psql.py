@@ -1,8 +1,51 @@
 from .basic import *
 import psycopg2 
 import subprocess
-from sqlalchemy import create_engine, Float
+import hashlib
+import csv
+from io import StringIO
+from sqlalchemy import create_engine, Float, text
 from geoalchemy2 import Geometry, WKTElement
+from .utils_cache import *
+
+#Engines shared by all the functions of the package, one for each database and process (see get_engine)
+_engines={}
+
+def get_engine(db_params:dict, pool_size:int=5, max_overflow:int=10):
+    
+    """
+    Return the SQLAlchemy engine for the database in db_params, creating it at the first call.
+    The engine keeps a pool of connections, checked with a pre-ping before use, so that the connection is not re-established for each query.
+    Engines are never shared across processes: a forked worker process starts with no engine and creates its own ones.
+    -------------------------------------------------------  
+    
+    Parameters:
+    
+    db_params: dictionary with info to access db
+    pool_size: number of connections kept open in the pool
+    max_overflow: number of connections that can be opened in addition to the pool when all the pooled connections are in use
+    
+    -------------------------------------------------------  
+    
+    Return:
+    sqlalchemy.engine.Engine
+    """
+    
+    key=(db_params['db_user'], db_params['db_password'], db_params['db_host'], str(db_params['db_port']), db_params['db_name'], os.getpid())
+    if key not in _engines:
+        _engines[key]=create_engine(f"postgresql+psycopg2://{db_params['db_user']}:{db_params['db_password']}@{db_params['db_host']}:{db_params['db_port']}/{db_params['db_name']}", 
+                                    pool_size=pool_size, max_overflow=max_overflow, pool_pre_ping=True)
+    return _engines[key]
+
+def reset_engines():
+    
+    """ Drop the engines inherited from the parent process, without closing the connections still used by the parent """
+    
+    for engine in _engines.values():
+        engine.dispose(close=False)
+    _engines.clear()
+
+os.register_at_fork(after_in_child=reset_engines)
 
 def getListOfAreas(db_params:dict):
     
@@ -22,13 +65,12 @@ def getListOfAreas(db_params:dict):
     
     """
     
-    engine=create_engine(f"postgresql+psycopg2://{db_params['db_user']}:{db_params['db_password']}@{db_params['db_host']}:{db_params['db_port']}/{db_params['db_name']}")
+    engine=get_engine(db_params)
     
     sql="""SELECT DISTINCT city 
            FROM public.cities_boundary
         """
     to_return=list(pd.read_sql_query(sql,engine)['city'])
-    engine.dispose()
     
     return to_return
 
@@ -55,12 +97,43 @@ def dict2psql(dict_to_pass:dict, tablename:str, key_name:str, value_name:str, db
     empty
     """
     
-    engine=create_engine(f"postgresql+psycopg2://{db_params['db_user']}:{db_params['db_password']}@{db_params['db_host']}:{db_params['db_port']}/{db_params['db_name']}")
+    engine=get_engine(db_params)
     df=pd.DataFrame({key_name: list(dict_to_pass.keys()), value_name: list(dict_to_pass.values())})
     df.to_sql(tablename, con=engine,**kwargs)
-    engine.dispose()
     
-def df2psql(df:pd.DataFrame, tablename:str, db_params:dict, **kwargs):
+def psql_insert_copy(table, conn, keys, data_iter):
+    
+    """
+    Insertion method for pandas.dataframe.to_sql() streaming each chunk of rows through PostgreSQL COPY ... FROM STDIN (CSV format), 
+    instead of INSERT statements. Missing values are loaded as NULL.
+    -------------------------------------------------------  
+    
+    Parameters:
+    
+    table: pandas.io.sql.SQLTable
+    conn: sqlalchemy connection
+    keys: list of column names
+    data_iter: iterable over the rows of the chunk
+    
+    -------------------------------------------------------  
+    
+    Return:
+    empty
+    """
+    
+    buffer=StringIO()
+    csv.writer(buffer).writerows(data_iter)
+    buffer.seek(0)
+    
+    columns=', '.join([f'"{k}"' for k in keys])
+    if table.schema:
+        table_name=f'"{table.schema}"."{table.name}"'
+    else:
+        table_name=f'"{table.name}"'
+    with conn.connection.cursor() as cur:
+        cur.copy_expert(sql=f"COPY {table_name} ({columns}) FROM STDIN WITH (FORMAT csv)", file=buffer)
+
+def df2psql(df:pd.DataFrame, tablename:str, db_params:dict, bulk:bool=False, indexes:dict=None, **kwargs):
     
     """
     Load dataframe as table in sql
@@ -71,6 +144,8 @@ def df2psql(df:pd.DataFrame, tablename:str, db_params:dict, **kwargs):
     df=pandas dataframe
     tablename=name of the table
     db_params= dictionary with info to access db
+    bulk= if True, load the rows with COPY (see psql_insert_copy) in chunks of 'chunksize' rows (default to 100,000)
+    indexes= optional dictionary {index name: column} of indexes to create once all the rows are loaded
     **kwargs= optional argument from pandas.dataframe.to_sql()
     
     -------------------------------------------------------  
@@ -79,11 +154,18 @@ def df2psql(df:pd.DataFrame, tablename:str, db_params:dict, **kwargs):
     empty
     """
     
-    engine=create_engine(f"postgresql+psycopg2://{db_params['db_user']}:{db_params['db_password']}@{db_params['db_host']}:{db_params['db_port']}/{db_params['db_name']}")
+    engine=get_engine(db_params)
+    if bulk==True:
+        kwargs.setdefault('chunksize', 100000)
+        kwargs['method']=psql_insert_copy
     df.to_sql(tablename, con=engine,**kwargs)
-    engine.dispose()
     
-def gdf2psql(gdf:gpd.GeoDataFrame, tablename:str, db_params:dict, **kwargs):
+    #Create indexes after the load, so that they are not updated row by row
+    if indexes is not None:
+        for index_name, column in indexes.items():
+            generate_indexes4table(index_name, kwargs.get('schema', 'public'), tablename, column, db_params)
+    
+def gdf2psql(gdf:gpd.GeoDataFrame, tablename:str, db_params:dict, bulk:bool=False, indexes:dict=None, **kwargs):
     
     """
     Load dataframe as table in sql
@@ -94,6 +176,8 @@ def gdf2psql(gdf:gpd.GeoDataFrame, tablename:str, db_params:dict, **kwargs):
     gdf=geopandas dataframe
     tablename=name of the table
     db_params= dictionary with info to access db
+    bulk= if True, load the rows with COPY (see psql_insert_copy) in chunks of 'chunksize' rows (default to 100,000). Geometries are sent as WKB, converted at once for the whole column
+    indexes= optional dictionary {index name: column} of indexes to create once all the rows are loaded
     **kwargs= optional argument from pandas.dataframe.to_sql()
     
     -------------------------------------------------------  
@@ -102,18 +186,29 @@ def gdf2psql(gdf:gpd.GeoDataFrame, tablename:str, db_params:dict, **kwargs):
     empty
     """
     
-    engine=create_engine(f"postgresql+psycopg2://{db_params['db_user']}:{db_params['db_password']}@{db_params['db_host']}:{db_params['db_port']}/{db_params['db_name']}")
+    engine=get_engine(db_params)
 
 
     # Use 'dtype' to specify column's type
     # For the geom column, we will use GeoAlchemy's type 'Geometry'
     if 'geom' in list(gdf.columns):
-        gdf['geom'] = gdf['geom'].apply(lambda geom: WKTElement(geom.wkt, srid=4326))
-        gdf.to_sql(tablename, con=engine,dtype={'geom': Geometry('Multipolygon', srid=4326)} ,**kwargs)
+        geom_col='geom'
+    else:
+        geom_col='geometry'
+    if bulk==True:
+        # Hex-encoded EWKB, parsed directly by PostGIS during COPY
+        gdf=pd.DataFrame(gdf.copy(deep=False))
+        gdf[geom_col]=shapely.to_wkb(shapely.set_srid(gdf[geom_col].values, 4326), hex=True, include_srid=True)
+        kwargs.setdefault('chunksize', 100000)
+        kwargs['method']=psql_insert_copy
     else:
-        gdf['geometry'] = gdf['geometry'].apply(lambda geom: WKTElement(geom.wkt, srid=4326))
-        gdf.to_sql(tablename, con=engine,dtype={'geometry': Geometry('Multipolygon', srid=4326)} ,**kwargs)
-    engine.dispose()
+        gdf[geom_col] = gdf[geom_col].apply(lambda geom: WKTElement(geom.wkt, srid=4326))
+    gdf.to_sql(tablename, con=engine,dtype={geom_col: Geometry('Multipolygon', srid=4326)} ,**kwargs)
+    
+    #Create indexes after the load, so that they are not updated row by row
+    if indexes is not None:
+        for index_name, column in indexes.items():
+            generate_indexes4table(index_name, kwargs.get('schema', 'public'), tablename, column, db_params)
 
 
 def rast2sql(input_dir:str, filename:str, output_dir:str, tablename:str, mode:str="c", raster_dim:tuple=(256,256), raster_format:str='tiff', crs:str='4326'):
@@ -192,12 +287,8 @@ def sqlRasterTable2db(tablename:str, directory:str, db_params: dict, schema:str=
             raise Exception("The requested command was unsuccessfull. Please check input arguments.")
     else:
         ### Generate tmp table in public
-        conn = psycopg2.connect(
-        dbname=db_params['db_name'], user=db_params['db_user'], password=db_params['db_password'], host=db_params['db_host'])
-        conn.autocommit=True
-        with conn.cursor() as cur: 
-            cur.execute(f"""CREATE TABLE public."{tablename}" AS SELECT * FROM "{schema}"."{tablename}" LIMIT 0 """)
-        conn.close()
+        with get_engine(db_params).connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.exec_driver_sql(f"""CREATE TABLE public."{tablename}" AS SELECT * FROM "{schema}"."{tablename}" LIMIT 0 """)
         
         cmd="PGPASSWORD=%s psql -h localhost --user=%s  --dbname=%s --file=%s.sql" %( db_params['db_password'], db_params['db_user'], db_params['db_name'], directory+"/"+tablename)
         print(cmd)
@@ -205,17 +296,13 @@ def sqlRasterTable2db(tablename:str, directory:str, db_params: dict, schema:str=
         if res.returncode!=0:
             raise Exception("The requested command was unsuccessfull. Please check input arguments.")
         
-        conn = psycopg2.connect(
-               dbname=db_params['db_name'], user=db_params['db_user'], password=db_params['db_password'], host=db_params['db_host'])
-        conn.autocommit=True
-        with conn.cursor() as cur: 
-            cur.execute(f"""
+        with get_engine(db_params).connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.exec_driver_sql(f"""
                 INSERT INTO "{schema}"."{tablename}"
                 SELECT ROW_NUMBER() OVER (ORDER by rid) + (SELECT MAX(rid) FROM "{schema}"."{tablename}") AS rid, rast, filename
                 FROM public."{tablename}"
                 """)  
-            cur.execute(f"""DROP TABLE public."{tablename}" """)
-        conn.close()
+            conn.exec_driver_sql(f"""DROP TABLE public."{tablename}" """)
       
     return res
 
@@ -263,7 +350,7 @@ def query4cityboundary(city: str, db_params:dict, buffer:float=0, table_name:str
     gpd.geodataframe with CRS:4326
     """
     
-    engine=create_engine(f"postgresql+psycopg2://{db_params['db_user']}:{db_params['db_password']}@{db_params['db_host']}:{db_params['db_port']}/{db_params['db_name']}")
+    engine=get_engine(db_params)
     #Only keep thing that fall within reasonable size from city boundary 
     sql =f"""
         SELECT st_transform(st_buffer(st_setsrid(st_transform({table_name}.geom, _ST_BestSRID({table_name}.geom)), _ST_BestSRID({table_name}.geom)),{buffer}), 4326) as geom
@@ -271,10 +358,40 @@ def query4cityboundary(city: str, db_params:dict, buffer:float=0, table_name:str
         WHERE {table_name}.city='{city}'
         """ 
     boundary=gpd.GeoDataFrame.from_postgis(sql,engine, crs='EPSG:4326')
-    engine.dispose()
     
     return boundary
 
+
+def query4citiesboundary(cities: list, db_params:dict, buffer:float=0, table_name:str='cities_boundary'):
+    
+    """ 
+    Return the boundaries of many cities at once, with given buffer in meters (see query4cityboundary)
+    ------------------------------------------------------- 
+    
+    Parameters:
+    
+    cities: list of names of the cities as from DB
+    db_params: dictionary with parameters to read from database
+    buffer: Buffer in meters
+    table_name: name reading table
+    
+    ------------------------------------------------------- 
+    
+    Return: 
+    gpd.geodataframe with columns city, geom and CRS:4326
+    """
+    
+    engine=get_engine(db_params)
+    cities_sql=', '.join(["'"+str(city).replace("'", "''")+"'" for city in cities])
+    sql =f"""
+        SELECT {table_name}.city, st_transform(st_buffer(st_setsrid(st_transform({table_name}.geom, _ST_BestSRID({table_name}.geom)), _ST_BestSRID({table_name}.geom)),{buffer}), 4326) as geom
+        FROM {table_name}
+        WHERE {table_name}.city IN ({cities_sql})
+        """ 
+    boundaries=gpd.GeoDataFrame.from_postgis(sql,engine, crs='EPSG:4326')
+    
+    return boundaries
+
         
 
 def query4esa2polygons(city: str, codes: list, db_params: dict):
@@ -307,7 +424,7 @@ def query4esa2polygons(city: str, codes: list, db_params: dict):
 
     
     #Establish connection to database     
-    engine=create_engine(f"postgresql+psycopg2://{db_params['db_user']}:{db_params['db_password']}@{db_params['db_host']}:{db_params['db_port']}/{db_params['db_name']}")
+    engine=get_engine(db_params)
        
     sql =f"""
         SELECT (ST_DumpAsPolygons(ST_Reclass(rast,1,'{cond}','1BB',0), 1, TRUE)).* 
@@ -316,7 +433,6 @@ def query4esa2polygons(city: str, codes: list, db_params: dict):
         """ 
     
     gdf=gpd.GeoDataFrame.from_postgis(sql,engine)
-    engine.dispose()
     
     return gdf
 
@@ -356,7 +472,7 @@ def query4esa2grid(city: str, codes: list, db_params: dict, min_park_size: float
         raise Exception('Up to three codes at once permitted.')
            
     #Establish connection to database     
-    engine=create_engine(f"postgresql+psycopg2://{db_params['db_user']}:{db_params['db_password']}@{db_params['db_host']}:{db_params['db_port']}/{db_params['db_name']}")
+    engine=get_engine(db_params)
 
     sql =f"""
     SELECT final.x, final.y, final.green_size/10^4 as green_size , final.size_intersection/10^4 as size_intersection
@@ -384,7 +500,6 @@ def query4esa2grid(city: str, codes: list, db_params: dict, min_park_size: float
     """
 
     df=pd.read_sql_query(sql,engine)
-    engine.dispose()
     
     return df
 
@@ -414,7 +529,7 @@ def query4osm2polygons(city: str, osm_feature:str, osm_which:list, db_params: di
     osm_classes_table_dict={'category':'osm_mask_categories','osm_key':'osm_mask_keys', 'osm_value':'osm_mask_values', 'osm_element':'osm_mask_elements'}
 
     #Establish connection to database     
-    engine=create_engine(f"postgresql+psycopg2://{db_params['db_user']}:{db_params['db_password']}@{db_params['db_host']}:{db_params['db_port']}/{db_params['db_name']}")
+    engine=get_engine(db_params)
     
     if len(osm_which)==1:
         sql =f"""
@@ -436,7 +551,6 @@ def query4osm2polygons(city: str, osm_feature:str, osm_which:list, db_params: di
             """ 
     
     gdf=gpd.GeoDataFrame.from_postgis(sql,engine)
-    engine.dispose()
     
     return gdf
 
@@ -464,10 +578,6 @@ def query4osm2grid(city: str, osm_feature:str, osm_which:list, db_params: dict,
     pd.DataFrame
     """
              
-    #Establish connection to database     
-    engine=create_engine(f"postgresql+psycopg2://{db_params['db_user']}:{db_params['db_password']}@{db_params['db_host']}:{db_params['db_port']}/{db_params['db_name']}")
-
-
     #Define admitted values 
     valid_features=['category','osm_key', 'osm_value', 'osm_element']
     if osm_feature not in valid_features:
@@ -477,7 +587,7 @@ def query4osm2grid(city: str, osm_feature:str, osm_which:list, db_params: dict,
     osm_classes_table_dict={'category':'osm_mask_categories','osm_key':'osm_mask_keys', 'osm_value':'osm_mask_values', 'osm_element':'osm_mask_elements'}
 
     #Establish connection to database     
-    engine=create_engine(f"postgresql+psycopg2://{db_params['db_user']}:{db_params['db_password']}@{db_params['db_host']}:{db_params['db_port']}/{db_params['db_name']}")
+    engine=get_engine(db_params)
     
     if len(osm_which)==1:
         subquery=f"""SELECT value
@@ -514,63 +624,58 @@ def query4osm2grid(city: str, osm_feature:str, osm_which:list, db_params: dict,
     """
          
     df=pd.read_sql_query(sql,engine)
-    engine.dispose()
     
     return df
 
-def query4grid(city: str, db_params: dict):
+def query4grid(city: str, db_params: dict, cache_dir:str=None, cache_version:str=None):
     
     """
-    Extract polygon of ESA data for selected land cover codes and perform unary_union of all adjacent geometries
+    Extract pixels from the population raster, with flag 'inbound' for pixels intersecting the city boundary.
+    The query is read-only, hence it can be run concurrently for several cities on the same database.
     ------------------------------------------------------- 
     
     Parameters:
     city: city_name
-    codes: World cover codes to extract
     db_params: db parameters to establish connection
+    cache_dir: if provided, directory of the local cache. The result is read from the cache if available, otherwise it is queried and saved to the cache
+    cache_version: version of the source tables (ex: from table_version), used to invalidate the cache. If None, the cached file is used as it is, without accessing the database
     
     ------------------------------------------------------- 
     Return:
     geopandas.GeoDataFrame. 
     """
     
+    if cache_dir is not None:
+        filename=cache_filename(cache_dir, 'query4grid', [city], cache_version)
+        if os.path.exists(filename):
+            return read_cache(filename)
+    
     #Establish connection to database     
-    engine=create_engine(f"postgresql+psycopg2://{db_params['db_user']}:{db_params['db_password']}@{db_params['db_host']}:{db_params['db_port']}/{db_params['db_name']}")
+    engine=get_engine(db_params)
        
+    #The inbound flag is computed in the same read-only query (no intermediate table), so that several grids can be queried concurrently
     sql =f"""
-        CREATE TABLE for_export1 AS 
-        SELECT (ST_PixelAsPolygons(rast, 1, TRUE)).* 
-        FROM ghs_pop
-        WHERE ghs_pop.filename='{city}.tiff';
-        
-        ALTER TABLE for_export1 ADD COLUMN inbound int;
-        UPDATE for_export1 SET inbound=0;
-        
-        UPDATE for_export1
-        SET inbound = 1 
-        FROM cities_boundary
-        WHERE ST_Intersects(for_export1.geom, cities_boundary.geom)
-        AND cities_boundary.city ='{city}';
-   
-        SELECT * FROM for_export1
+        SELECT pixels.*, 
+               CASE WHEN EXISTS (SELECT 1
+                                 FROM cities_boundary
+                                 WHERE cities_boundary.city ='{city}'
+                                 AND ST_Intersects(pixels.geom, cities_boundary.geom))
+                    THEN 1 ELSE 0 END AS inbound
+        FROM (SELECT (ST_PixelAsPolygons(rast, 1, TRUE)).* 
+              FROM ghs_pop
+              WHERE ghs_pop.filename='{city}.tiff') AS pixels
         """ 
     
     gdf=gpd.GeoDataFrame.from_postgis(sql,engine).rename(columns={'val':'population'})
-    engine.dispose()
     #Set population to 0 if negative or not inbound
     gdf.loc[(gdf['inbound']==0) | (gdf['population']<0), 'population']=0
     
-    #Drop table
-    conn = psycopg2.connect(
-        dbname=db_params['db_name'], user=db_params['db_user'], password=db_params['db_password'], host=db_params['db_host'])
-    conn.autocommit=True
-    with conn.cursor() as cur: 
-        cur.execute(f"""DROP TABLE for_export1""")
-    conn.close()
+    if cache_dir is not None:
+        write_cache(gdf, filename)
 
     return gdf
 
-def query4grid_unmasked(city: str, db_params: dict):
+def query4grid_unmasked(city: str, db_params: dict, cache_dir:str=None, cache_version:str=None):
     
     """
     Extract pixel from raster, unmasked
@@ -580,6 +685,8 @@ def query4grid_unmasked(city: str, db_params: dict):
     
     city: city_name
     db_params: db parameters to establish connection
+    cache_dir: if provided, directory of the local cache. The result is read from the cache if available, otherwise it is queried and saved to the cache
+    cache_version: version of the source tables (ex: from table_version), used to invalidate the cache. If None, the cached file is used as it is, without accessing the database
     
     ------------------------------------------------------- 
     
@@ -588,8 +695,13 @@ def query4grid_unmasked(city: str, db_params: dict):
     geopandas.GeoDataFrame. 
     """
     
+    if cache_dir is not None:
+        filename=cache_filename(cache_dir, 'query4grid_unmasked', [city], cache_version)
+        if os.path.exists(filename):
+            return read_cache(filename)
+    
     #Establish connection to database     
-    engine=create_engine(f"postgresql+psycopg2://{db_params['db_user']}:{db_params['db_password']}@{db_params['db_host']}:{db_params['db_port']}/{db_params['db_name']}")
+    engine=get_engine(db_params)
        
     sql =f"""
         SELECT (ST_PixelAsPolygons(rast, 1, FALSE)).* 
@@ -598,11 +710,13 @@ def query4grid_unmasked(city: str, db_params: dict):
         """ 
     
     gdf=gpd.GeoDataFrame.from_postgis(sql,engine).rename(columns={'val':'population'})
-    engine.dispose()
+    
+    if cache_dir is not None:
+        write_cache(gdf, filename)
     
     return gdf
 
-def queryRemappedGreen(city:str , tablename:str , col_prefix: int, min_park_size:float, min_intersection:float, db_params: dict):
+def queryRemappedGreen(city:str , tablename:str , col_prefix: int, min_park_size:float, min_intersection:float, db_params: dict, cache_dir:str=None, cache_version:str=None):
     
     """
     Extract tables with remapped green information
@@ -616,6 +730,32 @@ def queryRemappedGreen(city:str , tablename:str , col_prefix: int, min_park_size
     min_park_size: minimum size (in hectares) of the parks to be extrcted
     min_intersection: minimum size (in hectares) of the intersection between cell and park, for the cell to be characterized as green
     db_params: db parameters to establish connection
+    cache_dir: if provided, directory of the local cache. The result is read from the cache if available, otherwise it is queried and saved to the cache
+    cache_version: version of the source tables (ex: from table_version), used to invalidate the cache. If None, the cached file is used as it is, without accessing the database
+    
+    ------------------------------------------------------- 
+    
+    Return:
+    pandas.DataFrame
+    """
+
+    df=queryRemappedGreenTable(city, tablename, db_params, cache_dir, cache_version)
+    
+    return filterRemappedGreen(df, col_prefix, min_park_size, min_intersection)
+
+def queryRemappedGreenTable(city:str , tablename:str , db_params: dict, cache_dir:str=None, cache_version:str=None):
+    
+    """
+    Extract tables with remapped green information, for all the remapped combinations and with no filtering
+    ------------------------------------------------------- 
+    
+    Parameters:
+    
+    city: city_name
+    tablename: name of the table for extraction
+    db_params: db parameters to establish connection
+    cache_dir: if provided, directory of the local cache. The result is read from the cache if available, otherwise it is queried and saved to the cache
+    cache_version: version of the source tables (ex: from table_version), used to invalidate the cache. If None, the cached file is used as it is, without accessing the database
     
     ------------------------------------------------------- 
     
@@ -623,7 +763,12 @@ def queryRemappedGreen(city:str , tablename:str , col_prefix: int, min_park_size
     pandas.DataFrame
     """
 
-    engine=create_engine(f"postgresql+psycopg2://{db_params['db_user']}:{db_params['db_password']}@{db_params['db_host']}:{db_params['db_port']}/{db_params['db_name']}")
+    if cache_dir is not None:
+        filename=cache_filename(cache_dir, 'queryRemappedGreenTable', [city, tablename], cache_version)
+        if os.path.exists(filename):
+            return read_cache(filename)
+    
+    engine=get_engine(db_params)
        
     sql =f"""
         SELECT *
@@ -631,15 +776,37 @@ def queryRemappedGreen(city:str , tablename:str , col_prefix: int, min_park_size
         WHERE city='{city}'
         """  
     df=pd.read_sql(sql, engine)
-    engine.dispose()
     
-    df=df[df[f"{col_prefix}gs"]>=min_park_size]
-    df=df[df[f"{col_prefix}si"]>=min_intersection]
+    if cache_dir is not None:
+        write_cache(df, filename)
+    
+    return df
+
+def filterRemappedGreen(df:pd.DataFrame, col_prefix: int, min_park_size:float, min_intersection:float):
+    
+    """
+    Filter remapped green information (from queryRemappedGreenTable) for one combination
+    ------------------------------------------------------- 
+    
+    Parameters:
+    
+    df: remapped green information, as from queryRemappedGreenTable
+    col_prefix: column to extract
+    min_park_size: minimum size (in hectares) of the parks to be extrcted
+    min_intersection: minimum size (in hectares) of the intersection between cell and park, for the cell to be characterized as green
+    
+    ------------------------------------------------------- 
+    
+    Return:
+    pandas.DataFrame
+    """
+    
+    df=df[(df[f"{col_prefix}gs"]>=min_park_size) & (df[f"{col_prefix}si"]>=min_intersection)].copy()
     df['green']=1
     df.rename(columns={f"{col_prefix}gs":"gs",f"{col_prefix}si":"si" }, inplace=True)
     return df[['id','x','y','green', 'gs', 'si']]
 
-def queryDistances(city:str , which_distances:str, db_params: dict):
+def queryDistances(city:str , which_distances:str, db_params: dict, cache_dir:str=None, cache_version:str=None):
     """
     Extract distances
     ------------------------------------------------------- 
@@ -649,6 +816,8 @@ def queryDistances(city:str , which_distances:str, db_params: dict):
     city: city_name
     which_distances: type of distance to be extracted (geodesic vs street-network)
     db_params: db parameters to establish connection
+    cache_dir: if provided, directory of the local cache. The result is read from the cache if available, otherwise it is queried and saved to the cache
+    cache_version: version of the source tables (ex: from table_version), used to invalidate the cache. If None, the cached file is used as it is, without accessing the database
     
     ------------------------------------------------------- 
     
@@ -656,20 +825,103 @@ def queryDistances(city:str , which_distances:str, db_params: dict):
     pandas.DataFrame
     """
 
+    if cache_dir is not None:
+        filename=cache_filename(cache_dir, 'queryDistances', [city, which_distances], cache_version)
+        if os.path.exists(filename):
+            return read_cache(filename)
     
     dist_dict={'street-network':'walk_minutes', 'geodesic':'geodesic_minutes'}
-    engine=create_engine(f"postgresql+psycopg2://{db_params['db_user']}:{db_params['db_password']}@{db_params['db_host']}:{db_params['db_port']}/{db_params['db_name']}")   
+    engine=get_engine(db_params)
     sql =f"""
         SELECT source, dest, {dist_dict[which_distances]} as dist
         FROM distances."{city}"
         """  
     df=pd.read_sql(sql, engine)
-    engine.dispose()
+    
+    if cache_dir is not None:
+        write_cache(df, filename)
     
     return df
 
 
 
+def queryAggregatedIndex(city:str, index:str, tablename:str, col_prefix:str, min_park_size:float, min_intersection:float, which_distances:str, db_params:dict, threshold:float=None, index_storage_name:str='index'):
+    
+    """
+    Compute the minimum distance or the exposure index in the database, returning only one row per source cell
+    ------------------------------------------------------- 
+    
+    Parameters:
+    
+    city: city_name
+    index: 'minimum_distance' or 'exposure'
+    tablename: name of the table with the remapped green ('osm.osm2grid' or 'esa.esa2grid')
+    col_prefix: column to use (as in queryRemappedGreen)
+    min_park_size: minimum size (in hectares) of the parks
+    min_intersection: minimum size (in hectares) of the intersection between cell and park, for the cell to be characterized as green
+    which_distances: type of distance (geodesic vs street-network)
+    db_params: db parameters to establish connection
+    threshold: time threshold (in minutes). Only required for the exposure index
+    index_storage_name: name of the column where the index is stored
+    
+    ------------------------------------------------------- 
+    
+    Description:
+    
+    Step 1: Filter the remapped green with min_park_size and min_intersection (same as filterRemappedGreen)
+    Step 2: Join the distances with the green cells on the destination and aggregate by source: 
+            minimum distance for 'minimum_distance', sum of the green area within the threshold for 'exposure'.
+            Distances are stored in tenths of minutes and converted to minutes, as in the python computation.
+    
+    The filter on the cells within the city boundary is not applied here (the grid is a raster, not a table): 
+    the result is to be filtered on the 'inbound' flag of the grid (see accessibility_index_pipeline).
+    
+    ------------------------------------------------------- 
+    
+    Return:
+    pandas.DataFrame with columns ['id', index_storage_name]
+    """
+    
+    if index not in ['minimum_distance', 'exposure']:
+        raise Exception("Value for the parameter 'index' should be in ['minimum_distance', 'exposure']")
+    if index=='exposure' and threshold is None:
+        raise Exception("A threshold is required for the exposure index")
+    
+    dist_dict={'street-network':'walk_minutes', 'geodesic':'geodesic_minutes'}
+    dist=dist_dict[which_distances]
+    
+    #Step 1:
+    green=f"""
+        SELECT id, "{col_prefix}si" AS si
+        FROM {tablename}
+        WHERE city=:city AND "{col_prefix}gs">=:min_park_size AND "{col_prefix}si">=:min_intersection
+        """
+    
+    #Step 2:
+    if index=='minimum_distance':
+        sql=f"""
+            SELECT d.source AS id, MIN(d.{dist})::double precision/10 AS value
+            FROM distances."{city}" AS d
+            JOIN ({green}) AS g ON d.dest=g.id
+            WHERE d.{dist} IS NOT NULL
+            GROUP BY d.source
+            """
+    else:
+        sql=f"""
+            SELECT d.source AS id, SUM(g.si) AS value
+            FROM distances."{city}" AS d
+            JOIN ({green}) AS g ON d.dest=g.id
+            WHERE d.{dist}::double precision/10<=:threshold
+            GROUP BY d.source
+            """
+    
+    params={'city':city, 'min_park_size':min_park_size, 'min_intersection':min_intersection, 'threshold':threshold}
+    engine=get_engine(db_params)
+    df=pd.read_sql(text(sql), engine, params=params)
+    
+    return df.rename(columns={'value':index_storage_name})
+
+
 def query4raster(city: str, db_params: dict, table:str, schema:str, band:int):
     
     """
@@ -689,7 +941,7 @@ def query4raster(city: str, db_params: dict, table:str, schema:str, band:int):
     """
     
     #Establish connection to database     
-    engine=create_engine(f"postgresql+psycopg2://{db_params['db_user']}:{db_params['db_password']}@{db_params['db_host']}:{db_params['db_port']}/{db_params['db_name']}")
+    engine=get_engine(db_params)
        
     sql =f"""
         SELECT (ST_PixelAsPolygons(rast, {str(band)}, TRUE)).* 
@@ -701,34 +953,106 @@ def query4raster(city: str, db_params: dict, table:str, schema:str, band:int):
 
     return gdf
 
-def query4table(table, schema, db_params, geographic=False):
-    engine=create_engine(f"postgresql+psycopg2://{db_params['db_user']}:{db_params['db_password']}@{db_params['db_host']}:{db_params['db_port']}/{db_params['db_name']}")    
+def query4table(table, schema, db_params, geographic=False, cache_dir:str=None, cache_version:str=None):
+    if cache_dir is not None:
+        filename=cache_filename(cache_dir, 'query4table', [table, schema, geographic], cache_version)
+        if os.path.exists(filename):
+            return read_cache(filename)
+    
+    engine=get_engine(db_params)
 
     sql=f"""
         SELECT * FROM {schema}."{table}"   
         """
     if geographic==False:
-        return pd.read_sql(sql, engine)
+        df=pd.read_sql(sql, engine)
     else:
-        return gpd.read_postgis(sql,engine)
+        df=gpd.read_postgis(sql,engine)
+        
+    if cache_dir is not None:
+        write_cache(df, filename)
+    return df
+    
+def query4filteredtable(table, schema, db_params, where_col, where_val, geographic=False, cache_dir:str=None, cache_version:str=None):
+    if cache_dir is not None:
+        filename=cache_filename(cache_dir, 'query4filteredtable', [table, schema, where_col, where_val, geographic], cache_version)
+        if os.path.exists(filename):
+            return read_cache(filename)
     
-def query4filteredtable(table, schema, db_params, where_col, where_val, geographic=False):
-    engine=create_engine(f"postgresql+psycopg2://{db_params['db_user']}:{db_params['db_password']}@{db_params['db_host']}:{db_params['db_port']}/{db_params['db_name']}")    
+    engine=get_engine(db_params)
 
     sql=f"""
         SELECT * FROM {schema}.{table} WHERE {table}.{where_col}='{where_val}'
         """
     if geographic==False:
-        return pd.read_sql(sql, engine)
+        df=pd.read_sql(sql, engine)
     else:
-        return gpd.read_postgis(sql,engine)
+        df=gpd.read_postgis(sql,engine)
+        
+    if cache_dir is not None:
+        write_cache(df, filename)
+    return df
 
 def generate_indexes4table(index_name:str, schema:str, tablename:str, column:str, db_params:dict):
-    conn = psycopg2.connect(
-        dbname=db_params['db_name'], user=db_params['db_user'], password=db_params['db_password'], host=db_params['db_host'])
-    conn.autocommit=True
-    with conn.cursor() as cur: 
-        cur.execute(f"""CREATE INDEX IF NOT EXISTS {index_name} ON "{schema}"."{tablename}"({column})""")
-    conn.close()
+    with get_engine(db_params).connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.exec_driver_sql(f"""CREATE INDEX IF NOT EXISTS {index_name} ON "{schema}"."{tablename}"({column})""")
+
+
+def generate_composite_index4table(index_name:str, schema:str, tablename:str, columns:list, db_params:dict, include:list=None):
+    
+    """
+    Generate an index on several columns of a table, optionally with additional (non-key) columns stored in the index to allow index-only scans
+    ------------------------------------------------------- 
+    
+    Parameters:
     
+    index_name: name of the index
+    schema: schema of the table
+    tablename: name of the table
+    columns: list of the key columns, in order
+    db_params: db parameters to establish connection
+    include: list of the columns stored in the index but not used as keys
+    
+    ------------------------------------------------------- 
+    
+    Return:
+    empty
+    """
+    
+    sql=f"""CREATE INDEX IF NOT EXISTS {index_name} ON "{schema}"."{tablename}"({', '.join(f'"{column}"' for column in columns)})"""
+    if include:
+        sql+=f""" INCLUDE ({', '.join(f'"{column}"' for column in include)})"""
+    with get_engine(db_params).connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.exec_driver_sql(sql)
+
+
+def table_version(tables:list, db_params:dict):
+
+    """
+    Return a version string for a list of tables, to be passed as cache_version to invalidate the cache when the content of the tables changes.
+    The version is a hash of the content of the tables: number of rows and sum of the md5 hashes of the rows (independent of the order of the rows).
+    The tables are fully scanned, hence the version should be computed once (ex: at the beginning of a run) and passed to all the queries.
+    -------------------------------------------------------
+
+    Parameters:
+
+    tables: list of tables, provided as 'schema.table' (or 'table' for tables in the public schema)
+    db_params: db parameters to establish connection
+
+    -------------------------------------------------------
+
+    Return:
+    str
+    """
+
+    engine=get_engine(db_params)
+    versions=[]
+    for table in tables:
+        schema, name=table.split('.', 1) if '.' in table else ('public', table)
+        sql=f"""
+            SELECT COUNT(*) AS n_rows, SUM(('x'||SUBSTR(MD5(t::text), 1, 16))::bit(64)::bigint::numeric)::text AS checksum
+            FROM "{schema}"."{name.strip('"')}" AS t
+            """
+        versions.append(pd.read_sql(sql, engine).to_dict('records'))
 
+    return hashlib.md5(repr(versions).encode('utf-8')).hexdigest()
@@ -0,0 +1,66 @@
+// Compute walking durations block by block, loading the osrm graph only once.
+// Usage: node run_blocks.js <coordinates file> <osrm file name> <plan file> <output file>
+// - coordinates file: one "long,lat" line per coordinate
+// - plan file: one JSON object per line {"sources":[...], "destinations":[...]} with the positions of the coordinates of the block
+// - output file: for each block, the durations (in seconds) as float32 in row-major order (sources x destinations). Unroutable pairs are NaN.
+// - status file (<output file>.status): one line per block, "ok" or "error: <message>" if the block could not be computed.
+//   The script exits with code 1 if any block failed.
+const OSRM = require("osrm");
+const fs = require("fs");
+const readline = require("readline");
+
+const coordinates = fs.readFileSync(process.argv[2], 'utf8').trim().split('\n').map(line => line.split(',').map(Number));
+// teaching the bindings to use the osrm graph prepared in the previous step
+const osrm = new OSRM(process.argv[3] + ".osrm");
+const output = fs.createWriteStream(process.argv[5]);
+const status = fs.createWriteStream(process.argv[5] + ".status");
+
+// https://github.com/Project-OSRM/osrm-backend/blob/master/docs/nodejs/api.md
+const table = (options) => new Promise((resolve, reject) => {
+  osrm.table(options, (err, result) => err ? reject(err) : resolve(result));
+});
+const write = (stream, buffer) => new Promise((resolve) => {
+  stream.write(buffer) ? resolve() : stream.once('drain', resolve);
+});
+const end = (stream) => new Promise((resolve) => stream.end(resolve));
+
+async function main() {
+  let failed = 0;
+  const plan = readline.createInterface({ input: fs.createReadStream(process.argv[4]), crlfDelay: Infinity });
+  for await (const line of plan) {
+    if (!line) continue;
+    const block = JSON.parse(line);
+    const n_sources = block.sources.length;
+    const n_destinations = block.destinations.length;
+    // only the coordinates of the block are sent, sources first and destinations after
+    const blockCoordinates = block.sources.concat(block.destinations).map(i => coordinates[i]);
+    const durations = new Float32Array(n_sources * n_destinations).fill(NaN);
+    let error = null;
+    try {
+      const result = await table({
+        coordinates: blockCoordinates,
+        sources: [...Array(n_sources).keys()],
+        destinations: [...Array(n_destinations).keys()].map(j => n_sources + j),
+        annotations: ["duration"],
+        radiuses: Array(blockCoordinates.length).fill(10000)});
+      result.durations.forEach((row, i) => row.forEach((d, j) => {
+        if (d !== null) durations[i * n_destinations + j] = d;
+      }));
+    } catch (err) {
+      // keep the block in the output (as NaN) so that the offsets of the following blocks are preserved, and record the failure
+      console.error(err);
+      error = String(err).replace(/\n/g, " ");
+      failed += 1;
+    }
+    await write(output, Buffer.from(durations.buffer));
+    await write(status, error === null ? "ok\n" : "error: " + error + "\n");
+  }
+  await end(output);
+  await end(status);
+  if (failed > 0) {
+    console.error(failed + " blocks failed");
+    process.exitCode = 1;
+  }
+}
+
+main().catch(err => { console.error(err); process.exit(1); });
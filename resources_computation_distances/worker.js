@@ -0,0 +1,48 @@
+// Long-lived routing worker: the osrm graph is loaded once and requests are served until stdin is closed.
+// Usage: node worker.js <osrm file name>
+// - request (stdin): one JSON object per line {"coordinates":[[long,lat],...], "sources":[...], "destinations":[...]}
+// - response (stdout): one JSON line {"n_sources":..., "n_destinations":..., "error":...} followed by the durations (in seconds)
+//   as n_sources*n_destinations float32 (little-endian) in row-major order. Unroutable pairs are NaN.
+const OSRM = require("osrm");
+const readline = require("readline");
+
+// teaching the bindings to use the osrm graph prepared in the previous step
+const osrm = new OSRM(process.argv[2] + ".osrm");
+
+// https://github.com/Project-OSRM/osrm-backend/blob/master/docs/nodejs/api.md
+const table = (options) => new Promise((resolve, reject) => {
+  osrm.table(options, (err, result) => err ? reject(err) : resolve(result));
+});
+const write = (buffer) => new Promise((resolve) => {
+  process.stdout.write(buffer) ? resolve() : process.stdout.once('drain', resolve);
+});
+
+async function main() {
+  const requests = readline.createInterface({ input: process.stdin, crlfDelay: Infinity });
+  for await (const line of requests) {
+    if (!line) continue;
+    const request = JSON.parse(line);
+    const sources = request.sources || [...Array(request.coordinates.length).keys()];
+    const destinations = request.destinations || [...Array(request.coordinates.length).keys()];
+    const durations = new Float32Array(sources.length * destinations.length).fill(NaN);
+    let error = null;
+    try {
+      const result = await table({
+        coordinates: request.coordinates,
+        sources: sources,
+        destinations: destinations,
+        annotations: ["duration"],
+        radiuses: Array(request.coordinates.length).fill(10000)});
+      result.durations.forEach((row, i) => row.forEach((d, j) => {
+        if (d !== null) durations[i * destinations.length + j] = d;
+      }));
+    } catch (err) {
+      error = String(err);
+    }
+    const header = JSON.stringify({ n_sources: sources.length, n_destinations: destinations.length, error: error }) + "\n";
+    await write(Buffer.from(header, 'utf8'));
+    await write(Buffer.from(durations.buffer));
+  }
+}
+
+main().catch(err => { console.error(err); process.exit(1); });
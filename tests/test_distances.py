@@ -0,0 +1,105 @@
+""" Consistency of the indices computed on a DistanceMatrix with the ones computed on the pandas tables of distances """
+import numpy as np
+import pandas as pd
+import atgreen.indices
+from atgreen.indices import minimum_distance_index, exposure_index, load_sweep_distances, compute_sweep
+from atgreen.processing_distances import write_distance_file, distance_file2dataframe
+from atgreen.utils_distances import DistanceMatrix
+from atgreen.utils_grid import cell_id
+
+
+def synthetic_distances(n_rows:int=40, n_cols:int=30, seed:int=0):
+
+    """
+    Build a synthetic grid, remapped green and distances. Distances are off the 0.1 grid
+    (0.01 resolution, as the distances of the database divided by 10, and a share of values with full precision), with missing pairs.
+    -------------------------------------------------------
+
+    Return:
+    grid, green_grid, distances
+    """
+
+    rng=np.random.default_rng(seed)
+    x, y=np.meshgrid(np.arange(1, n_cols+1), np.arange(1, n_rows+1), indexing='ij')
+    grid=pd.DataFrame({'x':x.ravel(), 'y':y.ravel(), 'inbound':(rng.random(x.size)<0.8).astype(int)})
+    grid['id']=grid['y']+n_rows*(grid['x']-1)
+
+    green_cells=rng.choice(len(grid), len(grid)//6, replace=False)
+    green_grid=pd.DataFrame({'id':grid['id'].values[green_cells], 'green':1, 'si':rng.random(len(green_cells))*0.08})
+
+    source=np.repeat(grid['id'].values, 40)
+    distances=pd.DataFrame({'source':source, 'dest':rng.choice(grid['id'].values, len(source))}).drop_duplicates()
+    distances['dist']=np.round(rng.random(len(distances))*400, 1)/10
+    full_precision=rng.random(len(distances))<0.2
+    distances.loc[full_precision, 'dist']=rng.random(full_precision.sum())*40
+    distances.loc[rng.random(len(distances))<0.05, 'dist']=np.nan
+
+    return grid, green_grid, distances.reset_index(drop=True)
+
+
+def test_minimum_distance_exact():
+    for seed in range(3):
+        grid, green_grid, distances=synthetic_distances(seed=seed)
+        reference=minimum_distance_index(grid, green_grid, distances, 'index').sort_values('id').reset_index(drop=True)
+        result=minimum_distance_index(grid, green_grid, DistanceMatrix.from_dataframe(distances, dtype=np.float64), 'index')
+        assert np.array_equal(reference['id'].values, result['id'].values)
+        assert np.array_equal(reference['index'].values, result['index'].values)
+
+
+def test_minimum_distance_float32_not_quantized():
+    distances=pd.DataFrame({'source':[1, 1, 2], 'dest':[3, 4, 3], 'dist':[0.58, 1.23, 14.87]})
+    matrix=DistanceMatrix.from_dataframe(distances)
+    minimum=matrix.row_min(matrix.pair_mask([1, 2], [3, 4]))
+    assert minimum.dtype==np.float64
+    assert np.array_equal(minimum[[1, 2]], np.float32([0.58, 14.87]).astype(np.float64))
+
+
+def test_exposure_consistent():
+    for seed in range(3):
+        grid, green_grid, distances=synthetic_distances(seed=seed)
+        matrix=DistanceMatrix.from_dataframe(distances, dtype=np.float64)
+        for threshold in [0.58, 5, 15.07]:
+            reference=exposure_index(grid, green_grid, distances, threshold, 'index').sort_values('id')
+            reference=reference[reference['index']>0].reset_index(drop=True)
+            result=exposure_index(grid, green_grid, matrix, threshold, 'index').sort_values('id')
+            result=result[result['index']>0].reset_index(drop=True)
+            assert np.array_equal(reference['id'].values, result['id'].values)
+            assert np.allclose(reference['index'].values, result['index'].values, rtol=1e-12, atol=0)
+
+
+def test_sweep_distance_file_consistent_with_database(tmp_path, monkeypatch):
+    n_rows, n_cols=30, 20
+    rng=np.random.default_rng(0)
+    x, y=np.meshgrid(np.arange(1, n_cols+1), np.arange(1, n_rows+1), indexing='ij')
+    grid=pd.DataFrame({'x':x.ravel(), 'y':y.ravel(), 'population':rng.integers(0, 50, x.size).astype(float), 'inbound':(rng.random(x.size)<0.8).astype(int)})
+    grid['id']=cell_id(grid['x'], grid['y'], n_rows)
+    green_cells=rng.choice(len(grid), len(grid)//5, replace=False)
+    green_table=pd.DataFrame({'id':grid['id'].values[green_cells], 'x':grid['x'].values[green_cells], 'y':grid['y'].values[green_cells], 
+                              '0_gs':rng.random(len(green_cells))*5, '0_si':rng.random(len(green_cells))*0.08})
+
+    #Distances as computed by the distance notebook (walking durations in seconds, converted to minutes)
+    source=rng.choice(len(grid), 8000)
+    dest=rng.choice(len(grid), 8000)
+    df=pd.DataFrame({'x_source':grid['x'].values[source], 'y_source':grid['y'].values[source], 'x_dest':grid['x'].values[dest], 'y_dest':grid['y'].values[dest]})
+    df=df.drop_duplicates(['x_source', 'y_source', 'x_dest', 'y_dest']).reset_index(drop=True)
+    df['walk_minutes']=rng.random(len(df))*2400/60
+    df['geodesic_minutes']=rng.random(len(df))*2400/60
+    df.loc[rng.random(len(df))<0.05, 'walk_minutes']=np.nan
+    write_distance_file(df, f"{tmp_path}/city.atgd", n_rows, n_cols)
+
+    #Same distances as loaded on the database (see 00.05.02) and read by queryDistances
+    db=distance_file2dataframe(f"{tmp_path}/city.atgd")
+    db=pd.DataFrame({'source':cell_id(db['x_source'], db['y_source'], n_rows), 'dest':cell_id(db['x_dest'], db['y_dest'], n_rows), 'dist':np.round(db['walk_minutes'], 1)})
+    monkeypatch.setattr(atgreen.indices, 'queryDistances', lambda *args, **kwargs: db.copy())
+
+    index_params_list=[{'index':'minimum_distance', 'source':'ESA', 'distances':'street-network', 'min_park_size':1, 'min_intersection':0.01, 'time_threshold':1, 'index_storage_name':'md'},
+                       {'index':'exposure', 'source':'ESA', 'distances':'street-network', 'min_park_size':1, 'min_intersection':0.01, 'time_threshold':1, 'exposure_target':0.1, 'index_storage_name':'ex1'},
+                       {'index':'exposure', 'source':'ESA', 'distances':'street-network', 'min_park_size':1, 'min_intersection':0.01, 'time_threshold':2.5, 'exposure_target':0.1, 'index_storage_name':'ex25'}]
+    finals=[]
+    for distances_dir in [None, str(tmp_path)]:
+        distances=load_sweep_distances('city', 'street-network', n_rows, None, distances_dir=distances_dir)
+        sweep_inputs={'grid':grid, 'n_rows':n_rows, 'greencombinations':None, 'green_tables':{'ESA':green_table}, 'distances':{'street-network':distances}, 'cells_unmasked':None}
+        finals.append(compute_sweep(sweep_inputs, index_params_list))
+
+    assert (finals[0]['md']>0).any()
+    pd.testing.assert_frame_equal(finals[0], finals[1], check_exact=True)
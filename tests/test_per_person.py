@@ -0,0 +1,53 @@
+""" Numeric equivalence of the per-person index kernels (per_person_index and per_person_index_sparse) on synthetic grids """
+import numpy as np
+import pandas as pd
+from atgreen.indices import per_person_index, per_person_index_sparse
+from atgreen.utils_distances import DistanceMatrix
+
+
+def synthetic_city(n_rows:int=40, n_cols:int=30, seed:int=0):
+
+    """
+    Build a synthetic city: population grid, unmasked grid, remapped green and distances (in minutes, rounded to 0.1, with missing pairs)
+    -------------------------------------------------------
+
+    Return:
+    grid, grid_unmasked, green_grid, distances, n_rows
+    """
+
+    rng=np.random.default_rng(seed)
+    x, y=np.meshgrid(np.arange(1, n_cols+1), np.arange(1, n_rows+1), indexing='ij')
+    x=x.ravel()
+    y=y.ravel()
+
+    grid=pd.DataFrame({'x':x, 'y':y, 'population':rng.integers(0, 50, len(x)).astype(float), 'inbound':(rng.random(len(x))<0.8).astype(int)})
+    grid.loc[grid['inbound']==0, 'population']=0
+    grid['id']=grid['y']+n_rows*(grid['x']-1)
+
+    #Population outside the boundary, with no-data cells (-200)
+    grid_unmasked=pd.DataFrame({'x':x, 'y':y, 'population':np.where(rng.random(len(x))<0.1, -200, rng.integers(0, 50, len(x))).astype(float)})
+    grid_unmasked.loc[grid['inbound']==1, 'population']=grid.loc[grid['inbound']==1, 'population'].values
+
+    green_cells=rng.choice(len(x), len(x)//6, replace=False)
+    green_grid=pd.DataFrame({'id':grid['id'].values[green_cells], 'x':x[green_cells], 'y':y[green_cells], 'green':1,
+                             'gs':rng.random(len(green_cells))*20, 'si':rng.random(len(green_cells))*0.08})
+
+    source=np.repeat(grid['id'].values, 40)
+    distances=pd.DataFrame({'source':source, 'dest':rng.choice(grid['id'].values, len(source))}).drop_duplicates()
+    distances['dist']=np.round(rng.random(len(distances))*40, 1)
+    distances.loc[rng.random(len(distances))<0.05, 'dist']=np.nan
+
+    return grid, grid_unmasked, green_grid, distances.reset_index(drop=True), n_rows
+
+
+def test_per_person_kernels_equivalent():
+    for seed in range(3):
+        grid, grid_unmasked, green_grid, distances, n_rows=synthetic_city(seed=seed)
+        for threshold in [5, 15, 30]:
+            reference=per_person_index(grid, grid_unmasked.copy(), green_grid, distances, threshold, 'index', n_rows).reset_index(drop=True)
+            assert reference['index'].notnull().all()
+            for dist in [distances, DistanceMatrix.from_dataframe(distances)]:
+                for kernel in [per_person_index, per_person_index_sparse]:
+                    result=kernel(grid, grid_unmasked.copy(), green_grid, dist, threshold, 'index', n_rows).reset_index(drop=True)
+                    assert np.array_equal(reference['id'].values, result['id'].values)
+                    assert np.allclose(reference['index'].values, result['index'].values, rtol=1e-9, atol=0)